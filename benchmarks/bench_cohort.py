@@ -0,0 +1,174 @@
+# Copyright (c) 2017. Mount Sinai School of Medicine
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Time the cohort pipeline on synthetic cohorts from `cohorts.random`, by cohort
+size and number of variants per patient: loading variants, effects and
+neoantigens with a cold (empty) and a warm cache, `as_dataframe` with every
+built-in count column, variant filtering, bootstrap AUC and survival analysis.
+
+Run with asv (`asv run`; `asv continuous <release tag> HEAD` compares a change
+against a release), or directly: `python -m benchmarks.bench_cohort`.
+"""
+
+from __future__ import print_function
+
+import tempfile
+import timeit
+from os import makedirs, path
+from shutil import rmtree
+
+from numpy.random import seed
+
+from cohorts.functions import (
+    variant_count, snv_count, indel_count, deletion_count, insertion_count,
+    effect_count, nonsynonymous_snv_count, missense_snv_count, nonsynonymous_indel_count,
+    nonsynonymous_deletion_count, nonsynonymous_insertion_count, exonic_variant_count,
+    exonic_snv_count, exonic_indel_count, exonic_deletion_count, exonic_insertion_count,
+    frameshift_count, missense_snv_and_nonsynonymous_indel_count, neoantigen_count)
+from cohorts.random import random_cohort, generate_random_missense_variants, generate_simple_vcf
+from cohorts.varcode_utils import filter_variants
+from cohorts.variant_filters import variant_qc_filter
+
+SIZES = [10, 50]
+VARIANTS_PER_PATIENT = [10, 100]
+
+# The built-in count functions that don't need RNA.
+COUNT_FUNCTIONS = [
+    variant_count, snv_count, indel_count, deletion_count, insertion_count,
+    effect_count, nonsynonymous_snv_count, missense_snv_count, nonsynonymous_indel_count,
+    nonsynonymous_deletion_count, nonsynonymous_insertion_count, exonic_variant_count,
+    exonic_snv_count, exonic_indel_count, exonic_deletion_count, exonic_insertion_count,
+    frameshift_count, missense_snv_and_nonsynonymous_indel_count, neoantigen_count]
+
+FIXTURE_DIR = path.join(tempfile.gettempdir(), "cohorts-benchmarks")
+
+def fixture_vcf_dir(size, n_variants):
+    """
+    Write random missense VCFs for `size` patients, once: generating the variants
+    (by rejection sampling on their effects) takes far longer than loading them.
+    """
+    vcf_dir = path.join(FIXTURE_DIR, "vcfs-%d-%d" % (size, n_variants))
+    done_path = path.join(vcf_dir, "DONE")
+    if not path.exists(done_path):
+        if not path.exists(vcf_dir):
+            makedirs(vcf_dir)
+        seed(size * 1000 + n_variants)
+        for i in range(size):
+            generate_simple_vcf(path.join(vcf_dir, "patient_%d_mutect.vcf" % i),
+                                generate_random_missense_variants(num_variants=n_variants))
+        open(done_path, "w").close()
+    return vcf_dir
+
+def make_cohort(size, n_variants, cache_dir):
+    cohort = random_cohort(size=size, cache_dir=cache_dir,
+                           show_progress=False, print_filter=False, print_provenance=False)
+    vcf_dir = fixture_vcf_dir(size, n_variants)
+    for patient in cohort:
+        patient.variants = [path.join(vcf_dir, "patient_%s_mutect.vcf" % patient.id)]
+    return cohort
+
+class CohortBenchmark(object):
+    params = [SIZES, VARIANTS_PER_PATIENT]
+    param_names = ["size", "variants_per_patient"]
+    # Cold benchmarks are only cold once, so run each once per setup.
+    number = 1
+    repeat = 3
+    warmup_time = 0
+    timeout = 600
+
+    def setup(self, size, n_variants):
+        self.cache_dir = tempfile.mkdtemp()
+        self.cohort = make_cohort(size, n_variants, self.cache_dir)
+
+    def teardown(self, size, n_variants):
+        rmtree(self.cache_dir, ignore_errors=True)
+
+class LoadCold(CohortBenchmark):
+    """Loading from the input VCFs into an empty cache."""
+    def time_load_variants(self, size, n_variants):
+        self.cohort.load_variants()
+
+    def time_load_effects(self, size, n_variants):
+        self.cohort.load_effects()
+
+    def time_load_neoantigens(self, size, n_variants):
+        self.cohort.load_neoantigens()
+
+class LoadWarm(CohortBenchmark):
+    """Loading from a cache written by an earlier run."""
+    def setup(self, size, n_variants):
+        CohortBenchmark.setup(self, size, n_variants)
+        self.cohort.load_neoantigens()
+        self.cohort.load_effects()
+
+    def time_load_variants(self, size, n_variants):
+        self.cohort.load_variants()
+
+    def time_load_effects(self, size, n_variants):
+        self.cohort.load_effects()
+
+    def time_load_neoantigens(self, size, n_variants):
+        self.cohort.load_neoantigens()
+
+class Analysis(CohortBenchmark):
+    """Computations over a cohort whose cache is warm."""
+    def setup(self, size, n_variants):
+        LoadWarm.setup(self, size, n_variants)
+        self.variants = self.cohort.load_variants()
+
+    def time_as_dataframe_counts(self, size, n_variants):
+        self.cohort.as_dataframe(on={count_function.__name__: count_function
+                                     for count_function in COUNT_FUNCTIONS})
+
+    def time_filter_variants(self, size, n_variants):
+        for patient in self.cohort:
+            filter_variants(variant_collection=self.variants[patient.id], patient=patient,
+                            filter_fn=variant_qc_filter, min_tumor_depth=5, min_normal_depth=5,
+                            min_tumor_vaf=0.1, max_normal_vaf=0.5, min_tumor_alt_depth=2)
+
+    def time_bootstrap_auc(self, size, n_variants):
+        self.cohort.bootstrap_auc(on=missense_snv_count, pred_col="benefit", n_bootstrap=1000,
+                                  random_state=0)
+
+    def time_survival_results(self, size, n_variants):
+        self.cohort.plot_survival(on=missense_snv_count, how="os", skip_plot=True)
+
+    def time_plot_survival(self, size, n_variants):
+        import matplotlib
+        matplotlib.use("Agg")
+        import matplotlib.pyplot as plt
+        self.cohort.plot_survival(on=missense_snv_count, how="os")
+        plt.close("all")
+
+if __name__ == "__main__":
+    for suite_class in [LoadCold, LoadWarm, Analysis]:
+        for size in SIZES:
+            for n_variants in VARIANTS_PER_PATIENT:
+                for name in sorted(dir(suite_class)):
+                    if not name.startswith("time_"):
+                        continue
+                    suite = suite_class()
+
+                    def run():
+                        suite.setup(size, n_variants)
+                        try:
+                            start = timeit.default_timer()
+                            getattr(suite, name)(size, n_variants)
+                            return timeit.default_timer() - start
+                        finally:
+                            suite.teardown(size, n_variants)
+                    seconds = min(run() for _ in range(suite_class.repeat))
+                    print("%-10s %-26s size=%-4d variants=%-4d %10.3f s" % (
+                        suite_class.__name__, name, size, n_variants, seconds))
@@ -0,0 +1,49 @@
+# Copyright (c) 2017. Mount Sinai School of Medicine
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Time `import cohorts` in a fresh interpreter, and list the heavy dependencies it loads.
+
+Run with asv (`asv run`), or directly: `python -m benchmarks.bench_import`.
+"""
+
+from __future__ import print_function
+
+import json
+import subprocess
+import sys
+import timeit
+
+# Only imported on first use: plotting, PolyPhen, expressed neoantigens and statistics.
+LAZY_MODULES = ["matplotlib", "seaborn", "sqlalchemy", "vap", "pysam", "isovar",
+                "topiary", "mhctools", "lifelines", "patsy", "sklearn"]
+
+def imported_lazy_modules():
+    """Return the `LAZY_MODULES` that `import cohorts` loads in a fresh interpreter."""
+    code = "import json, sys; import cohorts; print(json.dumps([m for m in %r if m in sys.modules]))" % (
+        LAZY_MODULES,)
+    return json.loads(subprocess.check_output([sys.executable, "-c", code]).decode("utf-8"))
+
+def timeraw_import_cohorts():
+    return "import cohorts"
+
+def track_lazy_modules_imported():
+    return len(imported_lazy_modules())
+track_lazy_modules_imported.unit = "modules"
+
+if __name__ == "__main__":
+    seconds = min(timeit.repeat(
+        lambda: subprocess.check_call([sys.executable, "-c", "import cohorts"]), number=1, repeat=5))
+    print("import cohorts: %.2f s" % seconds)
+    print("lazy modules imported: %s" % (imported_lazy_modules() or "none"))
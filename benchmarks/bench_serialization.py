@@ -0,0 +1,87 @@
+# Copyright (c) 2017. Mount Sinai School of Medicine
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Compare cached VariantCollection/EffectCollection size and load time across
+serializer settings, against the plain pickles written by older versions.
+
+Run with asv (`asv run`), or directly: `python -m benchmarks.bench_serialization`.
+"""
+
+from __future__ import print_function
+
+import pickle
+import timeit
+from os import path
+
+from varcode import load_vcf_fast
+
+from cohorts.serialization import CacheSerializer
+
+VCF_PATH = path.join(path.dirname(__file__), "..", "test", "data", "vcf_template_1.vcf")
+
+SERIALIZERS = {
+    "legacy": None,
+    "protocol-highest": CacheSerializer(),
+    "lz4": CacheSerializer(compression="lz4"),
+    "zstd": CacheSerializer(compression="zstd"),
+    "compact": CacheSerializer(compact=True),
+    "compact-zstd": CacheSerializer(compact=True, compression="zstd"),
+}
+
+def dumps(serializer_name, obj):
+    serializer = SERIALIZERS[serializer_name]
+    if serializer is None:
+        return pickle.dumps(obj)
+    return serializer.dumps(obj)
+
+def loads(serializer_name, data):
+    serializer = SERIALIZERS[serializer_name]
+    if serializer is None:
+        return pickle.loads(data)
+    return serializer.loads(data)
+
+class CacheSerialization(object):
+    params = [sorted(SERIALIZERS.keys()), ["variants", "effects"]]
+    param_names = ["serializer", "collection"]
+
+    def setup(self, serializer_name, collection):
+        variants = load_vcf_fast(VCF_PATH)
+        obj = variants if collection == "variants" else variants.effects()
+        try:
+            self.data = dumps(serializer_name, obj)
+        except ValueError:
+            # Optional compression package isn't installed.
+            raise NotImplementedError()
+
+    def time_load(self, serializer_name, collection):
+        loads(serializer_name, self.data)
+
+    def track_size(self, serializer_name, collection):
+        return len(self.data)
+    track_size.unit = "bytes"
+
+if __name__ == "__main__":
+    suite = CacheSerialization()
+    for collection in suite.params[1]:
+        for serializer_name in suite.params[0]:
+            try:
+                suite.setup(serializer_name, collection)
+            except NotImplementedError:
+                print("%-10s %-18s skipped (missing package)" % (collection, serializer_name))
+                continue
+            seconds = min(timeit.repeat(
+                lambda: suite.time_load(serializer_name, collection), number=10, repeat=3)) / 10
+            print("%-10s %-18s %10d bytes %10.2f ms" % (
+                collection, serializer_name, suite.track_size(serializer_name, collection), seconds * 1000))
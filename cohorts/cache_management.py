@@ -0,0 +1,123 @@
+# Copyright (c) 2017. Mount Sinai School of Medicine
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Size accounting and LRU/TTL eviction for a Cohort's cache_dir.
+
+Cache entries are laid out as <cache_dir>/<cache_name>/<patient_id>/<file_name>.
+Entries whose file name carries a filter hash (e.g. `union-variants.<hash>.pkl`)
+are derived from a base artifact (`union-variants.pkl`) and are cheap to
+rebuild, so eviction removes them first.
+"""
+
+import os
+import re
+import time
+from os import path
+
+import pandas as pd
+
+# Files that describe a patient's cache directory rather than being cache entries.
+METADATA_FILE_NAMES = ["PROVENANCE", "INPUTS"]
+
+_FILTERED_FILE_NAME = re.compile(r"^[^.]+-variants\.(?P<filter_hash>.+)\.pkl$")
+
+USAGE_COLUMNS = ["cache_name", "patient_id", "file_name", "filter_hash",
+                 "bytes", "last_access", "path"]
+
+def filter_hash_of(file_name):
+    """Return the filter hash in a cache file name, or None for base artifacts."""
+    match = _FILTERED_FILE_NAME.match(file_name)
+    return match.group("filter_hash") if match else None
+
+def touch_access_time(file_path):
+    """
+    Record that a cache entry was used. Mounts often disable or coarsen atime
+    updates on read, so set it explicitly, leaving the mtime unchanged.
+    """
+    try:
+        os.utime(file_path, (time.time(), os.stat(file_path).st_mtime))
+    except OSError:
+        pass
+
+def cache_usage(cache_dir, cache_names):
+    """
+    Scan a cache directory.
+
+    Parameters
+    ----------
+    cache_dir : str
+    cache_names : list
+        Names of the cache subdirectories, e.g. "cached-variants".
+
+    Returns
+    -------
+    DataFrame with one row per cache entry: cache_name, patient_id, file_name,
+    filter_hash, bytes, last_access (a Unix time) and path.
+    """
+    rows = []
+    for cache_name in cache_names:
+        this_cache_dir = path.join(cache_dir, cache_name)
+        if not path.isdir(this_cache_dir):
+            continue
+        for patient_id in os.listdir(this_cache_dir):
+            patient_cache_dir = path.join(this_cache_dir, patient_id)
+            if not path.isdir(patient_cache_dir):
+                continue
+            for file_name in os.listdir(patient_cache_dir):
+                if file_name in METADATA_FILE_NAMES:
+                    continue
+                file_path = path.join(patient_cache_dir, file_name)
+                file_stat = os.stat(file_path)
+                rows.append(dict(
+                    cache_name=cache_name,
+                    patient_id=patient_id,
+                    file_name=file_name,
+                    filter_hash=filter_hash_of(file_name),
+                    bytes=file_stat.st_size,
+                    last_access=max(file_stat.st_atime, file_stat.st_mtime),
+                    path=file_path))
+    return pd.DataFrame.from_records(rows, columns=USAGE_COLUMNS)
+
+def select_evictions(usage, max_bytes=None, ttl_seconds=None, evict_base=False, now=None):
+    """
+    Choose cache entries to evict.
+
+    Entries not accessed within `ttl_seconds` are evicted. Then, while the cache
+    is larger than `max_bytes`, the least recently used entries are evicted:
+    filtered entries first, and base artifacts only if `evict_base` is True.
+    TTL expiry likewise only applies to base artifacts if `evict_base` is True.
+
+    Returns
+    -------
+    The subset of `usage` rows to evict.
+    """
+    now = time.time() if now is None else now
+    is_filtered = usage["filter_hash"].notnull()
+    evictable = usage if evict_base else usage[is_filtered]
+    # Filtered entries sort first, then least recently used.
+    evictable = evictable.assign(
+        _is_base=evictable["filter_hash"].isnull()).sort_values(["_is_base", "last_access"])
+
+    evict = pd.Series(False, index=evictable.index)
+    if ttl_seconds is not None:
+        evict |= evictable["last_access"] < now - ttl_seconds
+    if max_bytes is not None:
+        remaining_bytes = usage["bytes"].sum() - evictable[evict]["bytes"].sum()
+        for i, row in evictable[~evict].iterrows():
+            if remaining_bytes <= max_bytes:
+                break
+            evict[i] = True
+            remaining_bytes -= row["bytes"]
+    return evictable[evict].drop("_is_base", axis=1)
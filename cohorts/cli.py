@@ -0,0 +1,66 @@
+# Copyright (c) 2017. Mount Sinai School of Medicine
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Console entry points.
+
+Cohorts are built in Python, so commands take a "module:function" reference
+to a function that returns the `Cohort` to operate on, e.g.:
+
+    cohorts-precompute my_study.data:init_cohort --stages variants effects --n-jobs 8
+"""
+
+from __future__ import print_function
+
+import argparse
+import importlib
+import sys
+
+from .precompute import STAGES, DEFAULT_STAGES
+
+def load_cohort(cohort_function):
+    """Call the function named by a "module:function" string."""
+    if ":" not in cohort_function:
+        raise ValueError("Expected module:function, got %s" % cohort_function)
+    module_name, function_name = cohort_function.split(":", 1)
+    module = importlib.import_module(module_name)
+    return getattr(module, function_name)()
+
+def precompute_main(args=None):
+    parser = argparse.ArgumentParser(
+        description="Build missing cache entries for a Cohort.")
+    parser.add_argument(
+        "cohort_function",
+        help="module:function returning the Cohort, e.g. my_study.data:init_cohort")
+    parser.add_argument(
+        "--stages", nargs="+", default=DEFAULT_STAGES, choices=list(STAGES.keys()),
+        help="Stages to precompute (default: %s)" % " ".join(DEFAULT_STAGES))
+    parser.add_argument(
+        "--n-jobs", type=int, default=1,
+        help="Number of worker processes")
+    parser.add_argument(
+        "--patients", nargs="+", default=None,
+        help="Only precompute for these patient IDs")
+    parsed = parser.parse_args(args)
+
+    cohort = load_cohort(parsed.cohort_function)
+    patients = None
+    if parsed.patients is not None:
+        patients = [cohort.patient_from_id(patient_id) for patient_id in parsed.patients]
+    stats = cohort.precompute(stages=parsed.stages, n_jobs=parsed.n_jobs, patients=patients)
+    print(stats.to_string(index=False))
+    return 1 if stats["failed"].sum() > 0 else 0
+
+if __name__ == "__main__":
+    sys.exit(precompute_main())
@@ -12,57 +12,65 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-from os import path, makedirs
+from os import path, makedirs, stat, remove, listdir
 from shutil import rmtree
 import pandas as pd
-import seaborn as sb
 import json
 import warnings
 import pprint
 from copy import copy
+from contextlib import contextmanager
 import dill
 import hashlib
 import inspect
 import logging
 import pickle
+import threading
 import numpy as np
 
 # pylint doesn't like this line
 # pylint: disable=no-name-in-module
 from types import FunctionType
 
-import vap  ## vcf-annotate-polyphen
-from sqlalchemy import create_engine
-
-from pyensembl import cached_release
-
 import varcode
 from varcode import EffectCollection, VariantCollection
-from mhctools import NetMHCcons, EpitopeCollection
-from topiary import predict_epitopes_from_variants, epitopes_to_dataframe
-from topiary.sequence_helpers import contains_mutant_residues
-from isovar.allele_reads import reads_overlapping_variants
-from isovar.protein_sequences import reads_generator_to_protein_sequences_generator, protein_sequences_generator_to_dataframe
-from pysam import AlignmentFile
-from scipy.stats import pearsonr
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
 from tqdm import tqdm
 
 from .dataframe_loader import DataFrameLoader
-from .utils import DataFrameHolder, first_not_none_param, filter_not_null, InvalidDataError, strip_column_names as _strip_column_names, get_logger, get_cache_dir
-from .provenance import compare_provenance
+from .utils import DataFrameHolder, first_not_none_param, filter_not_null, InvalidDataError, strip_column_names as _strip_column_names, get_logger, get_cache_dir, thread_map
+from .provenance import compare_provenance, provenance_diff
+from .serialization import CacheSerializer
+from .fingerprint import file_fingerprint, fingerprints_match
+from .io.gcloud_cache import GoogleStorageCache, is_gs_uri
+from .cache_management import cache_usage, filter_hash_of, select_evictions, touch_access_time
+from .precompute import precompute, cache_diff
+from .expression import (transcript_gene_names, read_kallisto_abundance, kallisto_gene_counts, read_cufflinks,
+                         ExpressionMatrix, EXPRESSION_MATRIX_SOURCES)
+from .isovar_utils import (windowed_protein_sequences_dataframe, isovar_cache_file_name,
+                           parse_isovar_cache_file_name, trim_protein_sequences,
+                           expressed_variants_file_name, expressed_variant_index,
+                           mutant_binding_predictions,
+                           DEFAULT_ISOVAR_PARAMETERS)
 from .survival import plot_kmf
 from .plot import mann_whitney_plot, fishers_exact_plot, roc_curve_plot, stripboxplot, CorrelationResults
 from .model import cohort_coxph, cohort_bootstrap_auc, cohort_mean_bootstrap_auc
+from .screen import screen
+from .cutpoint import cutpoint_scan, maxstat_test
 from .collection import Collection
 from .varcode_utils import (filter_variants, filter_effects,
                             filter_neoantigens, filter_polyphen)
 from .variant_filters import no_filter
-from .styling import set_styling
 from . import variant_filters
 
 logger = get_logger(__name__, level=logging.INFO)
 
+# Number of patients' expressed variant indexes kept in memory per Cohort.
+EXPRESSED_VARIANTS_MEMO_SIZE = 64
+
+# Number of joined DataFrames kept in memory per Cohort by as_dataframe.
+DATAFRAME_MEMO_SIZE = 8
+
 class Cohort(Collection):
     """
     Represents a cohort of `Patient`s.
@@ -121,6 +129,49 @@ class Cohort(Collection):
         What word to use for "benefit" when plotting.
     merge_type : {"union", "intersection"}, optional
         Use this method to merge multiple variant sets for a single patient, default "union"
+    pickle_protocol : int, optional
+        Pickle protocol used for cached variants and effects. Defaults to the highest available.
+    cache_compression : {None, "lz4", "zstd"}, optional
+        Compress pickled cache files. Requires the `lz4` or `zstandard` package.
+    compact_cache : bool
+        Cache variants and effects using a compact struct-of-arrays encoding rather than
+        pickling varcode objects directly. This shrinks cache files; the varcode objects
+        are still rebuilt on every load. See `serialization.CacheSerializer`.
+    fingerprint_content : bool
+        Cache entries record the path, size and mtime of the input files they were computed
+        from, and are recomputed when those change. If True, also record a hash of each input's
+        contents (slow for large BAMs), so that files that are only touched or re-copied
+        don't invalidate the cache.
+    cache_max_bytes : int, optional
+        On-disk quota for `cache_dir`. When a write takes the cache above it, least recently
+        used filtered entries (e.g. `*-variants.<filter hash>.pkl`) are evicted. See `evict_cache`.
+    cache_ttl_days : float, optional
+        When evicting, also remove filtered entries that have not been used in this many days.
+    isovar_n_jobs : int
+        Number of worker processes used to run isovar over a patient's RNA BAM. Variants
+        are split into genomic windows, each processed with its own handle on the (indexed) BAM.
+    isovar_window_size : int, optional
+        Size in bases of the windows used by isovar workers. Defaults to one window per contig.
+    isovar_reuse_longer_sequences : bool
+        Isovar output is cached per set of parameters. If True, serve a request for shorter
+        protein sequences (i.e. shorter epitopes) by trimming cached output computed with
+        longer ones, rather than re-reading the RNA BAM. Off by default: trimmed output only
+        approximates a fresh isovar run. See `isovar_utils.trim_protein_sequences`.
+    io_n_jobs : int
+        Number of threads used to read per-patient input files, such as Kallisto and Cufflinks
+        quantifications and Pageant coverage.
+    gs_cache_dir : str, optional
+        Patient and Sample inputs (variants, bam_path_rna, kallisto_path, cufflinks_path) may be
+        gs:// URIs. They are downloaded to, and read from, this local cache, and only downloaded
+        again when they change. Defaults to a "gs-inputs" directory in `cache_dir`.
+    gs_cache_max_bytes : int, optional
+        Size limit of the gs:// input cache; least recently used inputs are evicted beyond it.
+    gs_prefetch : int
+        When loading inputs patient by patient, download the gs:// inputs of this many
+        upcoming patients in the background.
+    gs_bam_range_reads : bool
+        Rather than downloading gs:// RNA BAMs, transfer only their index and the blocks
+        holding reads at the patient's variants (see `GoogleStorageCache.bam_region_path`).
     """
     def __init__(self,
                  patients,
@@ -134,7 +185,7 @@ class Cohort(Collection):
                  join_with=None,
                  join_how="inner",
                  filter_fn=None,
-                 mhc_class=NetMHCcons,
+                 mhc_class=None,
                  normalized_per_mb=False,
                  min_coverage_normal_depth=0,
                  min_coverage_tumor_depth=0,
@@ -147,7 +198,21 @@ class Cohort(Collection):
                  pageant_dir_fn=None,
                  additional_maf_cols=None,
                  benefit_plot_name="Benefit",
-                 merge_type="union"):
+                 merge_type="union",
+                 pickle_protocol=None,
+                 cache_compression=None,
+                 compact_cache=False,
+                 fingerprint_content=False,
+                 cache_max_bytes=None,
+                 cache_ttl_days=None,
+                 isovar_n_jobs=1,
+                 isovar_window_size=None,
+                 isovar_reuse_longer_sequences=False,
+                 io_n_jobs=4,
+                 gs_cache_dir=None,
+                 gs_cache_max_bytes=None,
+                 gs_prefetch=2,
+                 gs_bam_range_reads=True):
         Collection.__init__(
             self,
             elements=patients)
@@ -183,11 +248,43 @@ class Cohort(Collection):
         self.additional_maf_cols = additional_maf_cols
         self.benefit_plot_name = benefit_plot_name
         self.merge_type = merge_type
+        self.cache_serializer = CacheSerializer(
+            protocol=pickle_protocol,
+            compression=cache_compression,
+            compact=compact_cache)
+        self.fingerprint_content = fingerprint_content
+        self.cache_max_bytes = cache_max_bytes
+        self.cache_ttl_days = cache_ttl_days
+        self.isovar_n_jobs = isovar_n_jobs
+        self.isovar_window_size = isovar_window_size
+        self.isovar_reuse_longer_sequences = isovar_reuse_longer_sequences
+        self.io_n_jobs = io_n_jobs
+        self.gs_cache_dir = gs_cache_dir if gs_cache_dir is not None else path.join(self.cache_dir, "gs-inputs")
+        self.gs_cache_max_bytes = gs_cache_max_bytes
+        self.gs_prefetch = gs_prefetch
+        self.gs_bam_range_reads = gs_bam_range_reads
+        self._gs_cache = None
+        # Running totals of cache bytes, and of those in filtered entries (which
+        # eviction can remove); None until the cache is first scanned.
+        self._cache_bytes = None
+        self._cache_filtered_bytes = None
+        self._cache_quota_warned = False
+        # Guards the totals, INPUTS and PROVENANCE files and eviction, as patients'
+        # entries may be saved from several threads (see `io_n_jobs`).
+        self._cache_lock = threading.RLock()
         self._genome = None
 
+        # Memoized by _as_dataframe_unmodified; see clear_dataframe_cache.
+        self._dataframe_memo = OrderedDict()
+        self._df_loader_memo = {}
+
         self.verify_id_uniqueness()
         self.verify_survival()
         self.dataframe_hash = None
+        self._provenance = None
+        self._json_file_index = {}
+        self._expressed_variants = OrderedDict()
+        self._patient_to_mb = {}
 
         self.cache_names = {"variant": "cached-variants",
                             "effect": "cached-effects",
@@ -195,7 +292,11 @@ class Cohort(Collection):
                             "neoantigen": "cached-neoantigens",
                             "expressed_neoantigen": "cached-expressed-neoantigens",
                             "polyphen": "cached-polyphen-annotations",
-                            "isovar": "cached-isovar-output"}
+                            "isovar": "cached-isovar-output",
+                            "kallisto": "cached-kallisto-gene-counts",
+                            "cufflinks": "cached-cufflinks",
+                            "ensembl_coverage": "cached-ensembl-coverage",
+                            "expression_matrix": "cached-expression-matrix"}
 
         if print_filter:
             print("Applying %s filter by default" % self.filter_fn.__name__ if
@@ -203,7 +304,7 @@ class Cohort(Collection):
         if print_provenance:
             pprint.pprint(self.summarize_data_sources())
 
-        set_styling()
+        self._styled = False
 
     def filter(self, filter_fn):
         new_cohort = copy(self)
@@ -264,15 +365,39 @@ class Cohort(Collection):
                 row[clinical_col] = getattr(patient, clinical_col)
 
             patient_rows.append(row)
+
+        # Patient rows are cheap to build, so they're part of the key: changing a
+        # patient's attributes or additional_data in place invalidates the memo.
+        patient_key = tuple(tuple((col, repr(value)) for (col, value) in row.items())
+                            for row in patient_rows)
+        # Loaders without a fingerprint are reloaded on every call, so nothing they
+        # contribute to is memoized.
+        fingerprints = [df_loader.fingerprint() if df_loader.fingerprint is not None else None
+                        for df_loader in df_loaders]
+        memoize = all(df_loader.fingerprint is not None for df_loader in df_loaders)
+        memo_key = (patient_key, tuple(zip(df_loaders, fingerprints)), join_how)
+        if memoize and memo_key in self._dataframe_memo:
+            self._dataframe_memo.move_to_end(memo_key)
+            df, self.dataframe_hash = self._dataframe_memo[memo_key]
+            return df.copy()
+
         df = pd.DataFrame.from_records(patient_rows)
 
         # Are any columns duplicated in the DataFrame(s) to be joined?
         # If so, rename those columns to be suffixed by the DataFrameLoader
         # name.
-        df_loader_dfs = {}
+        df_loader_dfs = OrderedDict()
         col_counts = defaultdict(int)
-        for df_loader in df_loaders:
-            df_loader_dfs[df_loader] = df_loader.load_dataframe()
+        for (df_loader, fingerprint) in zip(df_loaders, fingerprints):
+            if df_loader.fingerprint is None:
+                df_loader_dfs[df_loader] = df_loader.load_dataframe()
+                continue
+            # Only the DataFrame for a loader's latest fingerprint is kept.
+            memoized = self._df_loader_memo.get(df_loader)
+            if memoized is None or memoized[0] != fingerprint:
+                memoized = (fingerprint, df_loader.load_dataframe())
+                self._df_loader_memo[df_loader] = memoized
+            df_loader_dfs[df_loader] = memoized[1]
             for col in df_loader_dfs[df_loader].columns:
                 col_counts[col] += 1
         for col, count in col_counts.items():
@@ -280,8 +405,9 @@ class Cohort(Collection):
             if count > 1:
                 for df_loader, loaded_df in df_loader_dfs.items():
                     # Don't rename a column that will be joined on.
-                    if col != "patient_id" and col != df_loader.join_on:
-                        loaded_df.rename(columns={col: "%s_%s" % (col, df_loader.name)}, inplace=True)
+                    if col != "patient_id" and col != df_loader.join_on_right:
+                        df_loader_dfs[df_loader] = loaded_df.rename(
+                            columns={col: "%s_%s" % (col, df_loader.name)})
 
         for df_loader, loaded_df in df_loader_dfs.items():
             old_len_df = len(df)
@@ -297,7 +423,23 @@ class Cohort(Collection):
                 len(df)))
 
         self.dataframe_hash = hash(str(df.sort_values("patient_id")))
-        return df
+        if memoize:
+            self._dataframe_memo[memo_key] = (df, self.dataframe_hash)
+            while len(self._dataframe_memo) > DATAFRAME_MEMO_SIZE:
+                self._dataframe_memo.popitem(last=False)
+        return df.copy()
+
+    def clear_dataframe_cache(self):
+        """
+        Forget the DataFrames memoized by `as_dataframe`: the most recently used
+        `DATAFRAME_MEMO_SIZE` joined cohort DataFrames, and the latest result of each
+        `DataFrameLoader` that has a `fingerprint`. Changes to patients' attributes and
+        `additional_data` and to loaders' fingerprints are detected without this, and
+        loaders without a `fingerprint` are reloaded on every call.
+        """
+        self._dataframe_memo.clear()
+        self._df_loader_memo.clear()
+        self.dataframe_hash = None
 
     def as_dataframe(self, on=None, join_with=None, join_how=None,
                      return_cols=False, rename_cols=False,
@@ -416,26 +558,283 @@ class Cohort(Collection):
         return df_loaders[0].load_dataframe()
 
     def generate_provenance(self):
-        module_names = ["cohorts", "pyensembl", "varcode", "mhctools", "topiary", "isovar", "scipy", "numpy", "pandas"]
-        module_versions = [__import__(module_name).__version__ for module_name in module_names]
-        return dict(zip(module_names, module_versions))
+        """
+        Return the versions of modules used to generate cached data. Module versions
+        don't change within a session, so this is only computed once per Cohort.
+        """
+        if self._provenance is None:
+            module_names = ["cohorts", "pyensembl", "varcode", "mhctools", "topiary", "isovar", "scipy", "numpy", "pandas"]
+            module_versions = [__import__(module_name).__version__ for module_name in module_names]
+            self._provenance = dict(zip(module_names, module_versions))
+        return dict(self._provenance)
+
+    def _load_json_file(self, json_path):
+        """
+        Load a JSON metadata file (e.g. PROVENANCE) from the cache. Parsed files are
+        memoized and only re-read when the file's mtime or size changes.
+        """
+        file_stat = stat(json_path)
+        file_key = (file_stat.st_mtime_ns, file_stat.st_size)
+        memoized = self._json_file_index.get(json_path)
+        if memoized is None or memoized[0] != file_key:
+            with open(json_path, "r") as f:
+                memoized = (file_key, json.load(f))
+            self._json_file_index[json_path] = memoized
+        return copy(memoized[1])
+
+    def _save_json_file(self, json_path, obj):
+        with open(json_path, "w") as f:
+            json.dump(obj, f)
+        file_stat = stat(json_path)
+        self._json_file_index[json_path] = (
+            (file_stat.st_mtime_ns, file_stat.st_size), copy(obj))
 
     def load_provenance(self, patient_cache_dir):
-        with open(path.join(patient_cache_dir, "PROVENANCE"), "r") as f:
-            return json.load(f)
+        return self._load_json_file(path.join(patient_cache_dir, "PROVENANCE"))
 
     def save_provenance(self, patient_cache_dir, provenance):
-        with open(path.join(patient_cache_dir, "PROVENANCE"), "w") as f:
-            json.dump(provenance, f)
+        self._save_json_file(path.join(patient_cache_dir, "PROVENANCE"), provenance)
+
+    def load_input_fingerprints(self, patient_cache_dir):
+        """
+        Load a dictionary of cache file name to the fingerprints of the input files
+        it was computed from. Files cached before fingerprints were recorded are absent.
+        """
+        try:
+            return self._load_json_file(path.join(patient_cache_dir, "INPUTS"))
+        except (IOError, ValueError):
+            return {}
+
+    def input_paths(self, patient, cache):
+        """
+        The input files that a patient's entry in a cache (a key of `cache_names`) is
+        computed from: variant files, plus the RNA BAM for isovar-based caches and the
+        PolyPhen database for PolyPhen annotations. Expression caches are computed from
+        the patient's expression files alone.
+        """
+        if cache in ["kallisto", "cufflinks"]:
+            return [getattr(patient.tumor_sample, "%s_path" % cache)]
+        if cache == "ensembl_coverage":
+            return [self._pageant_coverage_file(patient)]
+        input_paths = [variants for variants in patient.variants_list if type(variants) == str]
+        if cache in ["isovar", "expressed_neoantigen"] and patient.tumor_sample is not None:
+            if patient.tumor_sample.bam_path_rna is not None:
+                input_paths.append(patient.tumor_sample.bam_path_rna)
+        if cache == "polyphen" and self.polyphen_dump_path is not None:
+            input_paths.append(self.polyphen_dump_path)
+        return input_paths
+
+    def input_fingerprints(self, patient, cache):
+        """
+        Fingerprint the `input_paths` of a patient's entry in a cache. gs:// inputs are
+        fingerprinted by their size and generation in the bucket.
+        """
+        return [self.gs_cache.fingerprint(input_path) if is_gs_uri(input_path) else
+                file_fingerprint(input_path, hash_content=self.fingerprint_content)
+                for input_path in self.input_paths(patient, cache)]
+
+    @property
+    def gs_cache(self):
+        """The `GoogleStorageCache` of gs:// inputs, created when first needed."""
+        if self._gs_cache is None:
+            self._gs_cache = GoogleStorageCache(
+                self.gs_cache_dir, max_bytes=self.gs_cache_max_bytes, n_jobs=self.io_n_jobs)
+        return self._gs_cache
+
+    @contextmanager
+    def local_input(self, input_path):
+        """
+        Context manager giving a local path to read an input from: the path itself, or for
+        a gs:// URI, its copy in `gs_cache`, which isn't evicted until the block exits.
+        BAMs are fetched along with their index.
+        """
+        if not is_gs_uri(input_path):
+            yield input_path
+            return
+        companions = [".bai"] if input_path.endswith(".bam") else []
+        local_path = self.gs_cache.local_path(input_path, companions=companions, pin=True)
+        try:
+            yield local_path
+        finally:
+            self.gs_cache.unpin(local_path)
+
+    @contextmanager
+    def _rna_bam(self, patient, variants):
+        """
+        Context manager giving a local path to a patient's RNA BAM (see `local_input`).
+        With `gs_bam_range_reads`, a gs:// BAM is only fetched around `variants`.
+        """
+        bam_path = patient.tumor_sample.bam_path_rna
+        if is_gs_uri(bam_path) and self.gs_bam_range_reads:
+            local_path = self.gs_cache.bam_region_path(
+                bam_path, [(variant.contig, variant.start, max(variant.start, variant.end)) for variant in variants],
+                pin=True)
+            try:
+                yield local_path
+            finally:
+                self.gs_cache.unpin(local_path)
+            return
+        with self.local_input(bam_path) as local_path:
+            yield local_path
 
-    def load_from_cache(self, cache_name, patient_id, file_name):
+    def prefetch_inputs(self, patients, cache):
+        """
+        Start downloading the gs:// inputs of `patients`' entries in a cache (a key of
+        `cache_names`) in the background, skipping entries that are already cached.
+        """
+        gs_uris = []
+        for patient in patients:
+            if self.cache_entry_status(cache, patient) == "ok":
+                continue
+            gs_uris.extend(input_path for input_path in self.input_paths(patient, cache)
+                           if is_gs_uri(input_path))
+        bams = [gs_uri for gs_uri in gs_uris if gs_uri.endswith(".bam")]
+        if len(bams) > 0 and not self.gs_bam_range_reads:
+            self.gs_cache.prefetch(bams, companions=[".bai"])
+        others = [gs_uri for gs_uri in gs_uris if not gs_uri.endswith(".bam")]
+        if len(others) > 0:
+            self.gs_cache.prefetch(others)
+
+    def _iter_with_prefetch(self, patients, cache):
+        """Iterate over patients, prefetching the gs:// inputs of the next `gs_prefetch` of them."""
+        patients = list(patients)
+        for (i, patient) in enumerate(patients):
+            if self.gs_prefetch > 0:
+                self.prefetch_inputs(patients[i + 1:i + 1 + self.gs_prefetch], cache)
+            yield patient
+
+    def cache_entry_status(self, cache, patient, file_name=None):
+        """
+        Return "missing", "stale" (its input files changed since it was cached) or
+        "ok" for a patient's entry in a cache (a key of `cache_names`).
+        """
+        file_name = file_name if file_name is not None else self.cache_file_name(cache)
+        if not self.has_cached(cache, patient.id, file_name):
+            return "missing"
+        recorded = self.load_input_fingerprints(
+            self._patient_cache_dir(self.cache_names[cache], patient.id)).get(file_name)
+        if recorded is not None and not fingerprints_match(
+                recorded, self.input_fingerprints(patient, cache)):
+            return "stale"
+        return "ok"
+
+    def _load_cache_provenance(self, cache_name):
+        """
+        Load a dictionary of patient_id to provenance (or None, if missing) for
+        one cache type. Returns None if the cache directory does not exist.
+        """
+        this_cache_dir = path.join(self.cache_dir, cache_name)
+        if not path.exists(this_cache_dir):
+            return None
+        patient_provenance = {}
+        for patient_id in self._list_patient_ids():
+            try:
+                patient_provenance[patient_id] = self.load_provenance(
+                    patient_cache_dir=path.join(this_cache_dir, patient_id))
+            except (IOError, ValueError):
+                patient_provenance[patient_id] = None
+        return patient_provenance
+
+    def verify_provenance(self, caches=None):
+        """
+        Compare the provenance of every patient in one or more cache types against
+        the current environment, in one pass, warning once per cache type.
+
+        Parameters
+        ----------
+        caches : str or list, optional
+            Keys of `cache_names` to check, e.g. "variant". Defaults to all caches.
+
+        Returns
+        -------
+        Dict of cache name to a dict of patient_id to number of discrepancies,
+        including only caches and patients whose provenance differs.
+        """
+        if caches is None:
+            caches = list(self.cache_names.keys())
+        elif type(caches) == str:
+            caches = [caches]
+        current_provenance = self.generate_provenance()
+        mismatches = {}
+        for cache in caches:
+            cache_name = self.cache_names[cache]
+            patient_provenance = self._load_cache_provenance(cache_name) or {}
+            cache_mismatches = {}
+            item_counts = defaultdict(int)
+            for patient_id, provenance in patient_provenance.items():
+                if not provenance:
+                    continue
+                new_diff, old_diff = provenance_diff(current_provenance, provenance)
+                if len(new_diff) + len(old_diff) > 0:
+                    cache_mismatches[patient_id] = len(new_diff) + len(old_diff)
+                    for key, value in old_diff:
+                        item_counts["%s==%s" % (key, value)] += 1
+            if len(cache_mismatches) > 0:
+                warnings.warn(
+                    "%d of %d patients in %s have provenance differing from the current environment. "
+                    "Cached: %s" % (
+                        len(cache_mismatches),
+                        len(patient_provenance),
+                        cache_name,
+                        ", ".join("%s (%d patients)" % (item, count)
+                                  for (item, count) in sorted(item_counts.items()))),
+                    Warning)
+                mismatches[cache_name] = cache_mismatches
+        return mismatches
+
+    def cache_file_name(self, cache, filter_ok=True, **isovar_parameters):
+        """
+        Return the file name of the unfiltered entry of a cache (a key of `cache_names`)
+        within a patient's cache directory.
+
+        Cufflinks entries depend on `filter_ok` (see `load_cufflinks`). Isovar entries are
+        per set of parameters; any not given in `isovar_parameters` default to
+        `isovar_utils.DEFAULT_ISOVAR_PARAMETERS`.
+        """
+        if cache == "variant":
+            return "%s-variants.pkl" % self.merge_type
+        if cache in ["effect", "nonsynonymous_effect"]:
+            return "%s-effects.pkl" % self.merge_type
+        if cache in ["neoantigen", "expressed_neoantigen"]:
+            return "%s-neoantigens.csv" % self.merge_type
+        if cache == "polyphen":
+            return "polyphen-annotations.csv"
+        if cache == "kallisto":
+            return "kallisto-gene-counts.ens%s.pkl" % self.kallisto_ensembl_version
+        if cache == "cufflinks":
+            return "cufflinks-ok.pkl" if filter_ok else "cufflinks.pkl"
+        if cache == "ensembl_coverage":
+            return "num-loci.tumor%d-normal%d.pkl" % (
+                self.min_coverage_tumor_depth, self.min_coverage_normal_depth)
+        if cache == "isovar":
+            parameters = dict(DEFAULT_ISOVAR_PARAMETERS)
+            parameters.update(isovar_parameters)
+            return isovar_cache_file_name(self.merge_type, **parameters)
+        raise ValueError("Unknown cache %s" % cache)
+
+    def _patient_cache_dir(self, cache_name, patient_id):
+        return path.join(self.cache_dir, cache_name, str(patient_id))
+
+    def has_cached(self, cache, patient_id, file_name=None):
+        """
+        Whether a patient's entry exists in a cache (a key of `cache_names`), without loading it.
+        """
+        file_name = file_name if file_name is not None else self.cache_file_name(cache)
+        return path.exists(path.join(
+            self._patient_cache_dir(self.cache_names[cache], patient_id), file_name))
+
+    def load_from_cache(self, cache_name, patient_id, file_name, inputs=None):
+        """
+        Load a cached object, or return None if it is not cached. If `inputs`
+        (see `input_fingerprints`) is given and differs from the fingerprints
+        recorded when the object was cached, the entry is stale and None is returned.
+        """
         if not self.cache_results:
             return None
 
         logger.debug("loading patient {} data from {} cache: {}".format(patient_id, cache_name, file_name))
 
-        cache_dir = path.join(self.cache_dir, cache_name)
-        patient_cache_dir = path.join(cache_dir, str(patient_id))
+        patient_cache_dir = self._patient_cache_dir(cache_name, patient_id)
         cache_file = path.join(patient_cache_dir, file_name)
 
         if not path.exists(cache_file):
@@ -446,6 +845,15 @@ class Cohort(Collection):
                 raise ValueError("Cache is in an older format (with variant_type). Please re-generate it.")
             return None
 
+        if inputs is not None:
+            recorded = self.load_input_fingerprints(patient_cache_dir).get(file_name)
+            if recorded is not None and not fingerprints_match(recorded, inputs):
+                logger.info("Input files changed since patient {} was cached in {}; recomputing {}".format(
+                    patient_id, cache_name, file_name))
+                return None
+
+        touch_access_time(cache_file)
+
         if self.check_provenance:
             logger.debug("... Checking cache provenance")
             num_discrepant = compare_provenance(
@@ -461,32 +869,68 @@ class Cohort(Collection):
             else:
                 logger.debug("... Loading cache as pickled file")
                 with open(cache_file, "rb") as f:
-                    return pickle.load(f)
+                    return self.cache_serializer.load(f)
         except IOError:
             return None
 
-    def save_to_cache(self, obj, cache_name, patient_id, file_name):
+    def save_to_cache(self, obj, cache_name, patient_id, file_name, inputs=None):
+        """
+        Cache an object. If `inputs` (see `input_fingerprints`) is given, it is
+        recorded so that the entry is invalidated when those input files change.
+        """
         if not self.cache_results:
             return
 
         logger.debug("saving patient {} data to {} cache: {}".format(patient_id, cache_name, file_name))
 
-        cache_dir = path.join(self.cache_dir, cache_name)
-        patient_cache_dir = path.join(cache_dir, str(patient_id))
+        patient_cache_dir = self._patient_cache_dir(cache_name, patient_id)
         cache_file = path.join(patient_cache_dir, file_name)
 
-        if not path.exists(patient_cache_dir):
-            makedirs(patient_cache_dir)
+        makedirs(patient_cache_dir, exist_ok=True)
 
-        if type(obj) == pd.DataFrame:
+        try:
+            previous_bytes = stat(cache_file).st_size
+        except FileNotFoundError:
+            previous_bytes = 0
+        if path.splitext(cache_file)[1] == ".csv":
             obj.to_csv(cache_file, index=False)
         else:
             with open(cache_file, "wb") as f:
-                # Protocol=2 for compatability with Py 2 and 3
-                pickle.dump(obj, f)
+                self.cache_serializer.dump(obj, f)
 
-        provenance = self.generate_provenance()
-        self.save_provenance(patient_cache_dir, provenance)
+        with self._cache_lock:
+            if not path.exists(cache_file):
+                # Already evicted by another thread, which recounted the totals.
+                return
+            provenance = self.generate_provenance()
+            try:
+                existing_provenance = self.load_provenance(patient_cache_dir)
+            except (IOError, ValueError):
+                existing_provenance = None
+            if existing_provenance != provenance:
+                self.save_provenance(patient_cache_dir, provenance)
+
+            if inputs is not None:
+                recorded = self.load_input_fingerprints(patient_cache_dir)
+                if recorded.get(file_name) != inputs:
+                    recorded[file_name] = inputs
+                    self._save_json_file(path.join(patient_cache_dir, "INPUTS"), recorded)
+
+            if self.cache_max_bytes is not None:
+                # Keep running totals rather than rescanning cache_dir on every write.
+                if self._cache_bytes is None:
+                    usage = self.cache_usage()
+                    self._cache_bytes = usage["bytes"].sum()
+                    self._cache_filtered_bytes = usage[usage["filter_hash"].notnull()]["bytes"].sum()
+                else:
+                    added_bytes = stat(cache_file).st_size - previous_bytes
+                    self._cache_bytes += added_bytes
+                    if filter_hash_of(file_name) is not None:
+                        self._cache_filtered_bytes += added_bytes
+                # Only unfiltered entries are left when there are no filtered bytes,
+                # and evict_cache can't reduce the cache until more are written.
+                if self._cache_bytes > self.cache_max_bytes and self._cache_filtered_bytes > 0:
+                    self.evict_cache()
 
     def iter_patients(self, patients):
         if patients is None:
@@ -529,7 +973,7 @@ class Cohort(Collection):
         logger.debug("loading variants with filter_fn: {}".format(filter_fn_name))
         patient_variants = {}
 
-        for patient in self.iter_patients(patients):
+        for patient in self._iter_with_prefetch(self.iter_patients(patients), "variant"):
             variants = self._load_single_patient_variants(patient, filter_fn, **kwargs)
             if variants is not None:
                 patient_variants[patient.id] = variants
@@ -599,7 +1043,8 @@ class Cohort(Collection):
             else:
                 logger.debug("... trying to load filtered variants from cache: {}".format(filtered_cache_file_name))
                 try:
-                    cached = self.load_from_cache(self.cache_names["variant"], patient.id, filtered_cache_file_name)
+                    cached = self.load_from_cache(self.cache_names["variant"], patient.id, filtered_cache_file_name,
+                                                  inputs=self.input_fingerprints(patient, "variant"))
                     if cached is not None:
                         return cached
                 except:
@@ -622,7 +1067,8 @@ class Cohort(Collection):
                                             **kwargs)
         if use_filtered_cache:
             logger.debug("... saving filtered variants to cache: {}".format(filtered_cache_file_name))
-            self.save_to_cache(filtered_variants, self.cache_names["variant"], patient.id, filtered_cache_file_name)
+            self.save_to_cache(filtered_variants, self.cache_names["variant"], patient.id, filtered_cache_file_name,
+                               inputs=self.input_fingerprints(patient, "variant"))
         return filtered_variants
 
     def _load_single_patient_merged_variants(self, patient, use_cache=True):
@@ -633,12 +1079,14 @@ class Cohort(Collection):
         """
         logger.debug("loading merged variants for patient {}".format(patient.id))
         no_variants = False
+        inputs = self.input_fingerprints(patient, "variant")
         try:
             # get merged-variants from cache
             if use_cache:
                 ## load unfiltered variants into list of collections
-                variant_cache_file_name = "%s-variants.pkl" % (self.merge_type)
-                merged_variants = self.load_from_cache(self.cache_names["variant"], patient.id, variant_cache_file_name)
+                variant_cache_file_name = self.cache_file_name("variant")
+                merged_variants = self.load_from_cache(self.cache_names["variant"], patient.id, variant_cache_file_name,
+                                                       inputs=inputs)
                 if merged_variants is not None:
                     return merged_variants
             # get variant collections from file
@@ -650,7 +1098,8 @@ class Cohort(Collection):
                 if type(patient_variants) == str:
                     if ".vcf" in patient_variants:
                         try:
-                            variant_collections.append(varcode.load_vcf_fast(patient_variants))
+                            with self.local_input(patient_variants) as local_path:
+                                variant_collections.append(varcode.load_vcf_fast(local_path))
                         # StopIteration is thrown for empty VCFs. For an empty VCF, don't append any variants,
                         # and don't throw an error. But do record a warning, in case the StopIteration was
                         # thrown for another reason.
@@ -659,11 +1108,12 @@ class Cohort(Collection):
                                 patient.id, str(e)))
                     elif ".maf" in patient_variants:
                         # See variant_stats.maf_somatic_variant_stats
-                        variant_collections.append(
-                            varcode.load_maf(
-                                patient_variants,
-                                optional_cols=optional_maf_cols,
-                                encoding="latin-1"))
+                        with self.local_input(patient_variants) as local_path:
+                            variant_collections.append(
+                                varcode.load_maf(
+                                    local_path,
+                                    optional_cols=optional_maf_cols,
+                                    encoding="latin-1"))
                     else:
                         raise ValueError("Don't know how to read %s" % patient_variants)
                 elif type(patient_variants) == VariantCollection:
@@ -691,7 +1141,8 @@ class Cohort(Collection):
 
         # save merged variants to file
         if use_cache:
-            self.save_to_cache(merged_variants, self.cache_names["variant"], patient.id, variant_cache_file_name)
+            self.save_to_cache(merged_variants, self.cache_names["variant"], patient.id, variant_cache_file_name,
+                               inputs=inputs)
         return merged_variants
 
     def _merge_variant_collections(self, variant_collections, merge_type):
@@ -739,7 +1190,7 @@ class Cohort(Collection):
 
     def _load_single_patient_polyphen(self, patient, filter_fn):
         cache_name = self.cache_names["polyphen"]
-        cached_file_name = "polyphen-annotations.csv"
+        cached_file_name = self.cache_file_name("polyphen")
 
         # Don't filter here, as these variants are used to generate the
         # PolyPhen cache; and cached items are never filtered.
@@ -748,13 +1199,17 @@ class Cohort(Collection):
         if variants is None:
             return None
 
-        cached = self.load_from_cache(cache_name, patient.id, cached_file_name)
+        inputs = self.input_fingerprints(patient, "polyphen")
+        cached = self.load_from_cache(cache_name, patient.id, cached_file_name, inputs=inputs)
         if cached is not None:
             return filter_polyphen(polyphen_df=cached,
                                    variant_collection=variants,
                                    patient=patient,
                                    filter_fn=filter_fn)
 
+        from sqlalchemy import create_engine
+        import vap  ## vcf-annotate-polyphen
+
         engine = create_engine("sqlite:///{}".format(self.polyphen_dump_path))
         conn = engine.connect()
 
@@ -781,7 +1236,7 @@ class Cohort(Collection):
             df = df.append(datum, ignore_index=True)
         df["pos"] = df["pos"].astype("int")
         df["annotation_found"] = df["annotation_found"].astype("bool")
-        self.save_to_cache(df, cache_name, patient.id, cached_file_name)
+        self.save_to_cache(df, cache_name, patient.id, cached_file_name, inputs=inputs)
         return filter_polyphen(polyphen_df=df,
                                variant_collection=variants,
                                patient=patient,
@@ -822,7 +1277,7 @@ class Cohort(Collection):
         return patient_effects
 
     def _load_single_patient_effects(self, patient, only_nonsynonymous, all_effects, filter_fn, **kwargs):
-        cached_file_name = "%s-effects.pkl" % self.merge_type
+        cached_file_name = self.cache_file_name("effect")
         filter_fn_name = self._get_function_name(filter_fn)
         logger.debug("loading effects for patient {} with filter_fn {}".format(patient.id, filter_fn_name))
 
@@ -832,10 +1287,12 @@ class Cohort(Collection):
         if variants is None:
             return None
 
+        inputs = self.input_fingerprints(patient, "effect")
         if only_nonsynonymous:
-            cached = self.load_from_cache(self.cache_names["nonsynonymous_effect"], patient.id, cached_file_name)
+            cached = self.load_from_cache(self.cache_names["nonsynonymous_effect"], patient.id, cached_file_name,
+                                          inputs=inputs)
         else:
-            cached = self.load_from_cache(self.cache_names["effect"], patient.id, cached_file_name)
+            cached = self.load_from_cache(self.cache_names["effect"], patient.id, cached_file_name, inputs=inputs)
         if cached is not None:
             return filter_effects(effect_collection=cached,
                                   variant_collection=variants,
@@ -847,11 +1304,12 @@ class Cohort(Collection):
         effects = variants.effects()
 
         # Save all effects, rather than top priority only. See https://github.com/hammerlab/cohorts/issues/252.
-        self.save_to_cache(effects, self.cache_names["effect"], patient.id, cached_file_name)
+        self.save_to_cache(effects, self.cache_names["effect"], patient.id, cached_file_name, inputs=inputs)
 
         # Save all nonsynonymous effects, rather than top priority only.
         nonsynonymous_effects = effects.drop_silent_and_noncoding()
-        self.save_to_cache(nonsynonymous_effects, self.cache_names["nonsynonymous_effect"], patient.id, cached_file_name)
+        self.save_to_cache(nonsynonymous_effects, self.cache_names["nonsynonymous_effect"], patient.id, cached_file_name,
+                           inputs=inputs)
 
         return filter_effects(
             effect_collection=(
@@ -875,41 +1333,39 @@ class Cohort(Collection):
             Pandas dataframe with Kallisto data for all patients
             columns include patient_id, gene_name, est_counts
         """
-        kallisto_data = pd.concat(
-            [self._load_single_patient_kallisto(patient) for patient in self],
-            copy=False
-        )
-
         if self.kallisto_ensembl_version is None:
             raise ValueError("Required a kallisto_ensembl_version but none was specified")
 
-        ensembl_release = cached_release(self.kallisto_ensembl_version)
-
-        kallisto_data["gene_name"] = \
-            kallisto_data["target_id"].map(lambda t: ensembl_release.gene_name_of_transcript_id(t))
-
-        # sum counts across genes
-        kallisto_data = \
-            kallisto_data.groupby(["patient_id", "gene_name"])[["est_counts"]].sum().reset_index()
-
-        return kallisto_data
+        # Built here rather than in the reader threads, since the pyensembl
+        # database connection can only be used from the thread that opened it.
+        gene_names = transcript_gene_names(self.kallisto_ensembl_version)
+        kallisto_data = pd.concat(
+            thread_map(lambda patient: self._load_single_patient_kallisto_gene_counts(patient, gene_names),
+                       self, n_jobs=self.io_n_jobs),
+            ignore_index=True)
+        return kallisto_data.sort_values(["patient_id", "gene_name"]).reset_index(drop=True)
 
-    def _load_single_patient_kallisto(self, patient):
+    def _load_single_patient_kallisto_gene_counts(self, patient, gene_names):
         """
-        Load Kallisto gene quantification given a patient
-
-        Parameters
-        ----------
-        patient : Patient
+        Load a patient's Kallisto estimated counts, summed across the transcripts of each gene.
 
         Returns
         -------
         data: Pandas dataframe
-            Pandas dataframe of sample's Kallisto data
-            columns include patient_id, target_id, length, eff_length, est_counts, tpm
+            columns include patient_id, gene_name, est_counts
         """
-        data = pd.read_csv(patient.tumor_sample.kallisto_path, sep="\t")
-        data["patient_id"] = patient.id
+        cached_file_name = self.cache_file_name("kallisto")
+        inputs = self.input_fingerprints(patient, "kallisto")
+        data = self.load_from_cache(self.cache_names["kallisto"], patient.id, cached_file_name,
+                                    inputs=inputs)
+        if data is not None:
+            return data
+
+        with self.local_input(patient.tumor_sample.kallisto_path) as local_path:
+            data = kallisto_gene_counts(read_kallisto_abundance(local_path), gene_names)
+        data.insert(0, "patient_id", patient.id)
+        self.save_to_cache(data, self.cache_names["kallisto"], patient.id, cached_file_name,
+                           inputs=inputs)
         return data
 
     def load_cufflinks(self, filter_ok=True):
@@ -927,11 +1383,10 @@ class Cohort(Collection):
             Pandas dataframe with Cufflinks data for all patients
             columns include patient_id, gene_id, gene_short_name, FPKM, FPKM_conf_lo, FPKM_conf_hi
         """
-        return \
-            pd.concat(
-                [self._load_single_patient_cufflinks(patient, filter_ok) for patient in self],
-                copy=False
-        )
+        return pd.concat(
+            thread_map(lambda patient: self._load_single_patient_cufflinks(patient, filter_ok),
+                       self, n_jobs=self.io_n_jobs),
+            ignore_index=True)
 
     def _load_single_patient_cufflinks(self, patient, filter_ok):
         """
@@ -949,14 +1404,73 @@ class Cohort(Collection):
             Pandas dataframe of sample's Cufflinks data
             columns include patient_id, gene_id, gene_short_name, FPKM, FPKM_conf_lo, FPKM_conf_hi
         """
-        data = pd.read_csv(patient.tumor_sample.cufflinks_path, sep="\t")
+        cached_file_name = self.cache_file_name("cufflinks", filter_ok=filter_ok)
+        inputs = self.input_fingerprints(patient, "cufflinks")
+        data = self.load_from_cache(self.cache_names["cufflinks"], patient.id, cached_file_name,
+                                    inputs=inputs)
+        if data is not None:
+            return data
+
+        with self.local_input(patient.tumor_sample.cufflinks_path) as local_path:
+            data = read_cufflinks(local_path, filter_ok=filter_ok)
         data["patient_id"] = patient.id
-
-        if filter_ok:
-            # Filter to OK FPKM counts
-            data = data[data["FPKM_status"] == "OK"]
+        self.save_to_cache(data, self.cache_names["cufflinks"], patient.id, cached_file_name,
+                           inputs=inputs)
         return data
 
+    def expression_matrix(self, source="kallisto"):
+        """
+        Load the cohort's gene expression as a patients x genes `ExpressionMatrix`: float32
+        values, memory-mapped, which can be sliced by gene without loading the whole matrix.
+
+        The matrix is cached in `cache_dir`, and rebuilt when the cohort's patients or their
+        expression files change. If `cache_results` is False, it is built in memory instead.
+
+        Parameters
+        ----------
+        source : {"kallisto", "cufflinks"}
+            Kallisto estimated counts per gene name, or Cufflinks FPKM (OK status only) per gene ID.
+
+        Returns
+        -------
+        ExpressionMatrix
+        """
+        if source not in EXPRESSION_MATRIX_SOURCES:
+            raise ValueError("Unknown expression source %s; expected one of %s" % (
+                source, sorted(EXPRESSION_MATRIX_SOURCES.keys())))
+        metadata = dict(
+            source=source,
+            patient_ids=[str(patient.id) for patient in self],
+            ensembl_version=self.kallisto_ensembl_version if source == "kallisto" else None,
+            inputs=[self.input_fingerprints(patient, source) for patient in self])
+        matrix_dir = None
+        if self.cache_results:
+            matrix_dir = path.join(self.cache_dir, self.cache_names["expression_matrix"], source)
+        if matrix_dir is not None and ExpressionMatrix.exists(matrix_dir):
+            matrix = ExpressionMatrix(matrix_dir)
+            recorded = matrix.metadata
+            if (all(recorded.get(key) == metadata[key] for key in ["source", "patient_ids", "ensembl_version"]) and
+                    all(fingerprints_match(recorded_inputs, inputs) for (recorded_inputs, inputs) in
+                        zip(recorded["inputs"], metadata["inputs"]))):
+                return matrix
+            logger.info("Patients or expression files changed; rebuilding the %s expression matrix" % source)
+
+        if source == "kallisto":
+            if self.kallisto_ensembl_version is None:
+                raise ValueError("Required a kallisto_ensembl_version but none was specified")
+            gene_names = transcript_gene_names(self.kallisto_ensembl_version)
+            load_patient = lambda patient: self._load_single_patient_kallisto_gene_counts(patient, gene_names)
+        else:
+            load_patient = lambda patient: self._load_single_patient_cufflinks(patient, filter_ok=True)
+        gene_column, value_column = EXPRESSION_MATRIX_SOURCES[source]
+        return ExpressionMatrix.build(
+            matrix_dir,
+            patient_ids=metadata["patient_ids"],
+            tables=thread_map(load_patient, self, n_jobs=self.io_n_jobs),
+            gene_column=gene_column,
+            value_column=value_column,
+            metadata=metadata)
+
     def load_neoantigens(self, patients=None, only_expressed=False,
                          epitope_lengths=[8, 9, 10, 11], ic50_cutoff=500,
                          process_limit=10, max_file_records=None,
@@ -964,7 +1478,8 @@ class Cohort(Collection):
         filter_fn = first_not_none_param([filter_fn, self.filter_fn], no_filter)
 
         dfs = {}
-        for patient in self.iter_patients(patients):
+        cache = "expressed_neoantigen" if only_expressed else "neoantigen"
+        for patient in self._iter_with_prefetch(self.iter_patients(patients), cache):
             df_epitopes = self._load_single_patient_neoantigens(
                 patient=patient,
                 only_expressed=only_expressed,
@@ -980,7 +1495,7 @@ class Cohort(Collection):
     def _load_single_patient_neoantigens(self, patient, only_expressed, epitope_lengths,
                                          ic50_cutoff, process_limit, max_file_records,
                                          filter_fn):
-        cached_file_name = "%s-neoantigens.csv" % self.merge_type
+        cached_file_name = self.cache_file_name("neoantigen")
 
         # Don't filter here, as these variants are used to generate the
         # neoantigen cache; and cached items are never filtered.
@@ -992,25 +1507,28 @@ class Cohort(Collection):
             print("HLA alleles did not exist for patient %s" % patient.id)
             return None
 
-        if only_expressed:
-            cached = self.load_from_cache(self.cache_names["expressed_neoantigen"], patient.id, cached_file_name)
-        else:
-            cached = self.load_from_cache(self.cache_names["neoantigen"], patient.id, cached_file_name)
+        cache = "expressed_neoantigen" if only_expressed else "neoantigen"
+        inputs = self.input_fingerprints(patient, cache)
+        cached = self.load_from_cache(self.cache_names[cache], patient.id, cached_file_name, inputs=inputs)
         if cached is not None:
             return filter_neoantigens(neoantigens_df=cached,
                                       variant_collection=variants,
                                       patient=patient,
                                       filter_fn=filter_fn)
 
+        mhc_class = self.mhc_class
+        if mhc_class is None:
+            from mhctools import NetMHCcons
+            mhc_class = NetMHCcons
         try:
-            mhc_model = self.mhc_class(
+            mhc_model = mhc_class(
                 alleles=patient.hla_alleles,
                 epitope_lengths=epitope_lengths,
                 max_file_records=max_file_records,
                 process_limit=process_limit)
         except TypeError:
             # The class may not support max_file_records and process_limit.
-            mhc_model = self.mhc_class(
+            mhc_model = mhc_class(
                 alleles=patient.hla_alleles,
                 epitope_lengths=epitope_lengths)
 
@@ -1019,32 +1537,31 @@ class Cohort(Collection):
                                                          variants=variants,
                                                          epitope_lengths=epitope_lengths)
 
-            # Map from isovar rows to protein sequences
-            isovar_rows_to_protein_sequences = dict([
-                (frozenset(row.to_dict().items()), row["amino_acids"]) for (i, row) in df_isovar.iterrows()])
-
-            # MHC binding prediction
-            epitopes = mhc_model.predict(isovar_rows_to_protein_sequences)
+            # MHC binding prediction, with each protein sequence keyed by its isovar row id
+            df_isovar = df_isovar.reset_index(drop=True)
+            epitopes = mhc_model.predict(dict(enumerate(df_isovar["amino_acids"])))
 
             # Call `get_filtered_isovar_epitopes` in order to only include peptides that
             # overlap a variant; without this filter, when we use
             # protein_sequence_length above, some 8mers generated from a 21mer source will
             # not overlap a variant.
             df_epitopes = self.get_filtered_isovar_epitopes(
-                epitopes, ic50_cutoff=ic50_cutoff).dataframe()
+                epitopes, ic50_cutoff=ic50_cutoff, df_isovar=df_isovar).dataframe()
             # Store chr/pos/ref/alt in the cached DataFrame so we can filter based on
             # the variant later.
-            for variant_column in ["chr", "pos", "ref", "alt"]:
-                # Be consistent with Topiary's output of "start" rather than "pos".
-                # Isovar, on the other hand, outputs "pos".
-                # See https://github.com/hammerlab/topiary/blob/5c12bab3d47bd86d396b079294aff141265f8b41/topiary/converters.py#L50
-                df_column = "start" if variant_column == "pos" else variant_column
-                df_epitopes[df_column] = df_epitopes.source_sequence_key.apply(
-                    lambda key: dict(key)[variant_column])
+            # Be consistent with Topiary's output of "start" rather than "pos".
+            # Isovar, on the other hand, outputs "pos".
+            # See https://github.com/hammerlab/topiary/blob/5c12bab3d47bd86d396b079294aff141265f8b41/topiary/converters.py#L50
+            df_variants = df_isovar[["chr", "pos", "ref", "alt"]].rename(columns={"pos": "start"})
+            df_variants["source_sequence_key"] = df_variants.index
+            df_epitopes["source_sequence_key"] = df_epitopes["source_sequence_key"].astype(np.int64)
+            df_epitopes = df_epitopes.merge(df_variants, on="source_sequence_key", how="left")
             df_epitopes["patient_id"] = patient.id
 
-            self.save_to_cache(df_epitopes, self.cache_names["expressed_neoantigen"], patient.id, cached_file_name)
+            self.save_to_cache(df_epitopes, self.cache_names["expressed_neoantigen"], patient.id, cached_file_name,
+                               inputs=inputs)
         else:
+            from topiary import predict_epitopes_from_variants, epitopes_to_dataframe
             epitopes = predict_epitopes_from_variants(
                 variants=variants,
                 mhc_model=mhc_model,
@@ -1054,44 +1571,71 @@ class Cohort(Collection):
             df_epitopes = epitopes_to_dataframe(epitopes)
             df_epitopes["patient_id"] = patient.id
 
-            self.save_to_cache(df_epitopes, self.cache_names["neoantigen"], patient.id, cached_file_name)
+            self.save_to_cache(df_epitopes, self.cache_names["neoantigen"], patient.id, cached_file_name,
+                               inputs=inputs)
 
         return filter_neoantigens(neoantigens_df=df_epitopes,
                                   variant_collection=variants,
                                   patient=patient,
                                   filter_fn=filter_fn)
 
-    def get_filtered_isovar_epitopes(self, epitopes, ic50_cutoff):
+    def get_filtered_isovar_epitopes(self, epitopes, ic50_cutoff, df_isovar):
         """
         Mostly replicates topiary.build_epitope_collection_from_binding_predictions
 
+        Each binding prediction's `source_sequence_key` is the row id (position) of its
+        source protein sequence in `df_isovar`.
+
         Note: topiary needs to do fancy stuff like subsequence_protein_offset + binding_prediction.offset
         in order to figure out whether a variant is in the peptide because it only has the variant's
         offset into the full protein; but isovar gives us the variant's offset into the protein subsequence
         (dictated by protein_sequence_length); so all we need to do is map that onto the smaller 8-11mer
         peptides generated by mhctools.
         """
-        mutant_binding_predictions = []
-        for binding_prediction in epitopes:
-            peptide = binding_prediction.peptide
-            peptide_offset = binding_prediction.offset
-            isovar_row = dict(binding_prediction.source_sequence_key)
-            is_mutant = contains_mutant_residues(
-                peptide_start_in_protein=peptide_offset,
-                peptide_length=len(peptide),
-                mutation_start_in_protein=isovar_row["variant_aa_interval_start"],
-                mutation_end_in_protein=isovar_row["variant_aa_interval_end"])
-            if is_mutant and binding_prediction.value <= ic50_cutoff:
-                mutant_binding_predictions.append(binding_prediction)
-        return EpitopeCollection(mutant_binding_predictions)
-
-    def load_single_patient_isovar(self, patient, variants, epitope_lengths):
-        # TODO: different epitope lengths, and other parameters, should result in
-        # different caches
-        isovar_cached_file_name = "%s-isovar.csv" % self.merge_type
-        df_isovar = self.load_from_cache(self.cache_names["isovar"], patient.id, isovar_cached_file_name)
+        from mhctools import EpitopeCollection
+        return EpitopeCollection(mutant_binding_predictions(epitopes, df_isovar, ic50_cutoff))
+
+    def load_single_patient_isovar(self, patient, variants, epitope_lengths,
+                                   min_variant_sequence_coverage=3,
+                                   max_protein_sequences_per_variant=1):
+        """
+        Load isovar protein sequences for a patient's variants from the tumor RNA BAM.
+
+        Parameters
+        ----------
+        patient : Patient
+        variants : VariantCollection
+        epitope_lengths : list
+            Lengths of the peptides that will be predicted from the protein sequences.
+        min_variant_sequence_coverage : int
+            Per Alex R.'s suggestion; equivalent to min_reads_supporting_rna_sequence previously.
+        max_protein_sequences_per_variant : int
+            Defaults to 1; otherwise we might have too much neoepitope diversity.
+
+        Results are cached per set of parameters. If `isovar_reuse_longer_sequences` is True,
+        cached output with the same thresholds and a longer protein sequence length is trimmed
+        to serve the request, rather than running isovar again.
+        """
+        # To ensure that e.g. 8-11mers overlap substitutions, we need at least this
+        # sequence length: (max peptide length * 2) - 1
+        # Example:
+        # 123456789AB
+        #           123456789AB
+        # AAAAAAAAAAVAAAAAAAAAA
+        isovar_parameters = dict(
+            protein_sequence_length=(max(epitope_lengths) * 2) - 1,
+            min_variant_sequence_coverage=min_variant_sequence_coverage,
+            max_protein_sequences_per_variant=max_protein_sequences_per_variant)
+        isovar_cached_file_name = self.cache_file_name("isovar", **isovar_parameters)
+        inputs = self.input_fingerprints(patient, "isovar")
+        df_isovar = self.load_from_cache(self.cache_names["isovar"], patient.id, isovar_cached_file_name,
+                                         inputs=inputs)
         if df_isovar is not None:
             return df_isovar
+        if self.isovar_reuse_longer_sequences:
+            df_isovar = self._load_longer_isovar_from_cache(patient, inputs, **isovar_parameters)
+            if df_isovar is not None:
+                return df_isovar
 
         import logging
         logging.disable(logging.INFO)
@@ -1099,39 +1643,151 @@ class Cohort(Collection):
             raise ValueError("Patient %s has no tumor sample" % patient.id)
         if patient.tumor_sample.bam_path_rna is None:
             raise ValueError("Patient %s has no tumor RNA BAM path" % patient.id)
-        rna_bam_file = AlignmentFile(patient.tumor_sample.bam_path_rna)
-
-        # To ensure that e.g. 8-11mers overlap substitutions, we need at least this
-        # sequence length: (max peptide length * 2) - 1
-        # Example:
-        # 123456789AB
-        #           123456789AB
-        # AAAAAAAAAAVAAAAAAAAAA
-        protein_sequence_length = (max(epitope_lengths) * 2) - 1
-        allele_reads_generator = reads_overlapping_variants(
-            variants=variants,
-            samfile=rna_bam_file,
-            min_mapping_quality=1)
-        protein_sequences_generator = reads_generator_to_protein_sequences_generator(
-            allele_reads_generator,
-            protein_sequence_length=protein_sequence_length,
-            # Per Alex R.'s suggestion; equivalent to min_reads_supporting_rna_sequence previously
-            min_variant_sequence_coverage=3,
-            max_protein_sequences_per_variant=1, # Otherwise we might have too much neoepitope diversity
-            variant_sequence_assembly=False)
-        df_isovar = protein_sequences_generator_to_dataframe(protein_sequences_generator)
-        self.save_to_cache(df_isovar, self.cache_names["isovar"], patient.id, isovar_cached_file_name)
+        with self._rna_bam(patient, variants) as bam_path:
+            df_isovar = windowed_protein_sequences_dataframe(
+                variants=variants,
+                bam_path=bam_path,
+                n_jobs=self.isovar_n_jobs,
+                window_size=self.isovar_window_size,
+                min_mapping_quality=1,
+                **isovar_parameters)
+        self.save_to_cache(df_isovar, self.cache_names["isovar"], patient.id, isovar_cached_file_name,
+                           inputs=inputs)
         return df_isovar
 
+    def load_single_patient_expressed_variants(self, patient, variants, epitope_lengths=[8, 9, 10, 11]):
+        """
+        Return the set of `isovar_utils.variant_key` tuples of a patient's variants
+        that have RNA support according to isovar.
+
+        The set is cached alongside the isovar output, and the most recently used
+        `EXPRESSED_VARIANTS_MEMO_SIZE` patients' sets are kept in memory.
+        """
+        isovar_cached_file_name = self.cache_file_name(
+            "isovar", protein_sequence_length=(max(epitope_lengths) * 2) - 1)
+        cached_file_name = expressed_variants_file_name(isovar_cached_file_name)
+        memo_key = (patient.id, cached_file_name)
+        expressed_variants = self._expressed_variants.pop(memo_key, None)
+        if expressed_variants is None:
+            inputs = self.input_fingerprints(patient, "isovar")
+            expressed_variants = self.load_from_cache(
+                self.cache_names["isovar"], patient.id, cached_file_name, inputs=inputs)
+            if expressed_variants is None:
+                df_isovar = self.load_single_patient_isovar(
+                    patient=patient, variants=variants, epitope_lengths=epitope_lengths)
+                expressed_variants = expressed_variant_index(df_isovar)
+                self.save_to_cache(expressed_variants, self.cache_names["isovar"], patient.id,
+                                   cached_file_name, inputs=inputs)
+        self._expressed_variants[memo_key] = expressed_variants
+        while len(self._expressed_variants) > EXPRESSED_VARIANTS_MEMO_SIZE:
+            self._expressed_variants.popitem(last=False)
+        return expressed_variants
+
+    def _load_longer_isovar_from_cache(self, patient, inputs, protein_sequence_length,
+                                       min_variant_sequence_coverage, max_protein_sequences_per_variant):
+        """
+        Find cached isovar output with the same thresholds as requested but a longer
+        protein sequence length, preferring the shortest, and trim it to the requested length.
+        """
+        patient_cache_dir = self._patient_cache_dir(self.cache_names["isovar"], patient.id)
+        if not path.isdir(patient_cache_dir):
+            return None
+        candidates = []
+        for file_name in listdir(patient_cache_dir):
+            parsed = parse_isovar_cache_file_name(file_name)
+            if (parsed is not None and
+                    parsed["merge_type"] == self.merge_type and
+                    parsed["min_variant_sequence_coverage"] == min_variant_sequence_coverage and
+                    parsed["max_protein_sequences_per_variant"] == max_protein_sequences_per_variant and
+                    parsed["protein_sequence_length"] > protein_sequence_length):
+                candidates.append((parsed["protein_sequence_length"], file_name))
+        for (_, file_name) in sorted(candidates):
+            df_isovar = self.load_from_cache(self.cache_names["isovar"], patient.id, file_name, inputs=inputs)
+            if df_isovar is not None:
+                logger.debug("Trimming cached isovar output %s to protein_sequence_length=%d" % (
+                    file_name, protein_sequence_length))
+                return trim_protein_sequences(df_isovar, protein_sequence_length)
+        return None
+
     def load_ensembl_coverage(self):
+        """
+        Load the number of exonic (Ensembl) loci covered at `min_coverage_tumor_depth` and
+        `min_coverage_normal_depth` per patient, from Pageant CoverageDepth output.
+
+        Returns
+        -------
+        DataFrame with columns patient_id, numOnLoci and MB.
+        """
         if self.pageant_coverage_path is None:
             raise ValueError("Need a Pageant CoverageDepth path to load ensembl coverage values")
-        return variant_filters.load_ensembl_coverage(
-            cohort=self,
-            coverage_path=self.pageant_coverage_path,
-            min_normal_depth=self.min_coverage_normal_depth,
+        num_loci = thread_map(self._load_single_patient_num_loci, self, n_jobs=self.io_n_jobs)
+        return variant_filters.ensembl_coverage_dataframe([patient.id for patient in self], num_loci)
+
+    def _pageant_coverage_file(self, patient):
+        pageant_dir_fn = self.pageant_dir_fn if self.pageant_dir_fn is not None else (lambda patient: patient.id)
+        return path.join(self.pageant_coverage_path, pageant_dir_fn(patient), "cdf.csv")
+
+    def _load_single_patient_num_loci(self, patient):
+        cached_file_name = self.cache_file_name("ensembl_coverage")
+        inputs = self.input_fingerprints(patient, "ensembl_coverage")
+        num_loci = self.load_from_cache(self.cache_names["ensembl_coverage"], patient.id, cached_file_name,
+                                        inputs=inputs)
+        if num_loci is not None:
+            return num_loci
+
+        num_loci = variant_filters.load_single_patient_num_loci(
+            self._pageant_coverage_file(patient),
             min_tumor_depth=self.min_coverage_tumor_depth,
-            pageant_dir_fn=self.pageant_dir_fn)
+            min_normal_depth=self.min_coverage_normal_depth)
+        self.save_to_cache(num_loci, self.cache_names["ensembl_coverage"], patient.id, cached_file_name,
+                           inputs=inputs)
+        return num_loci
+
+    def patient_to_mb(self):
+        """
+        Return a dict of patient_id to MB of exonic loci covered (see `load_ensembl_coverage`),
+        used to normalize counts when `normalized_per_mb` is set. Memoized per coverage files
+        (see `pageant_dir_fn`) and depth thresholds.
+        """
+        key = (tuple(self._pageant_coverage_file(patient) for patient in self),
+               self.min_coverage_tumor_depth, self.min_coverage_normal_depth)
+        if key not in self._patient_to_mb:
+            df_coverage = self.load_ensembl_coverage()
+            self._patient_to_mb[key] = dict(zip(df_coverage["patient_id"], df_coverage["MB"]))
+        return self._patient_to_mb[key]
+
+    def precompute(self, stages=None, n_jobs=1, patients=None):
+        """
+        Build every missing or stale cache entry for the given stages, e.g. as a nightly job,
+        so that later calls to `as_dataframe` only read from the cache.
+
+        Parameters
+        ----------
+        stages : list, optional
+            Any of "variants", "effects", "nonsynonymous_effects", "polyphen",
+            "isovar", "neoantigens" and "expressed_neoantigens". Stages they depend
+            on are also run. Defaults to all but "expressed_neoantigens".
+        n_jobs : int
+            Number of worker processes.
+        patients : list, optional
+            Only precompute for these patients.
+
+        Returns
+        -------
+        DataFrame of per-stage counts and throughput. See `precompute.precompute`.
+        """
+        return precompute(self, stages=stages, n_jobs=n_jobs, patients=patients)
+
+    def cache_diff(self, stages=None, patients=None):
+        """
+        List which patients and stages have cache entries that are missing, or stale
+        because their input files changed, and so would be computed by `precompute`.
+
+        Returns
+        -------
+        DataFrame with columns patient_id, stage and status. See `precompute.cache_diff`.
+        """
+        return cache_diff(self, stages=stages, patients=patients)
 
     def clear_caches(self):
         for cache in self.cache_names.keys():
@@ -1139,14 +1795,116 @@ class Cohort(Collection):
 
     def clear_cache(self, cache):
         cache_path = path.join(self.cache_dir, self.cache_names[cache])
-        if path.exists(cache_path):
-            rmtree(cache_path)
+        with self._cache_lock:
+            if path.exists(cache_path):
+                rmtree(cache_path)
+            self._cache_bytes = None
+            self._cache_filtered_bytes = None
+        if cache == "isovar":
+            self._expressed_variants.clear()
+        if cache == "ensembl_coverage":
+            self._patient_to_mb.clear()
+
+    def cache_usage(self):
+        """
+        Return a DataFrame with one row per file in this Cohort's caches: cache_name,
+        patient_id, file_name, filter_hash (None for unfiltered entries), bytes,
+        last_access and path.
+        """
+        return cache_usage(self.cache_dir, list(self.cache_names.values()))
+
+    def cache_stats(self, by="cache_name"):
+        """
+        Summarize cache disk usage.
+
+        Parameters
+        ----------
+        by : str or list
+            Any of "cache_name", "patient_id" and "filter_hash" (where unfiltered
+            entries are labeled "base").
+
+        Returns
+        -------
+        DataFrame of total bytes and number of files per group.
+        """
+        usage = self.cache_usage()
+        usage["filter_hash"] = usage["filter_hash"].fillna("base")
+        return usage.groupby(by).agg({"bytes": "sum", "file_name": "count"}).rename(
+            columns={"file_name": "files"}).reset_index()
+
+    def evict_cache(self, max_bytes=None, ttl_days=None, evict_base=False, dry_run=False):
+        """
+        Evict cache entries: those unused for `ttl_days`, then least recently used
+        ones until the cache fits in `max_bytes`. Filtered entries (which are cheap
+        to rebuild from unfiltered ones) go first; unfiltered entries are kept
+        unless `evict_base` is True.
+
+        Parameters
+        ----------
+        max_bytes : int, optional
+            Defaults to `cache_max_bytes`.
+        ttl_days : float, optional
+            Defaults to `cache_ttl_days`.
+        evict_base : bool
+            Whether unfiltered entries (variants, effects, neoantigens, ...) may be evicted.
+        dry_run : bool
+            Only report what would be evicted.
+
+        Returns
+        -------
+        DataFrame of evicted entries, as in `cache_usage`.
+        """
+        max_bytes = first_not_none_param([max_bytes, self.cache_max_bytes], default=None)
+        ttl_days = first_not_none_param([ttl_days, self.cache_ttl_days], default=None)
+        with self._cache_lock:
+            usage = self.cache_usage()
+            evicted = select_evictions(
+                usage,
+                max_bytes=max_bytes,
+                ttl_seconds=ttl_days * 24 * 3600 if ttl_days is not None else None,
+                evict_base=evict_base)
+            if not dry_run:
+                for file_path in evicted["path"]:
+                    try:
+                        remove(file_path)
+                    except FileNotFoundError:
+                        # Removed by another Cohort sharing this cache_dir.
+                        pass
+                self._forget_input_fingerprints(evicted)
+                remaining = usage.drop(evicted.index)
+                self._cache_bytes = remaining["bytes"].sum()
+                self._cache_filtered_bytes = remaining[remaining["filter_hash"].notnull()]["bytes"].sum()
+                if max_bytes is not None and self._cache_bytes > max_bytes:
+                    # Warn once, rather than on every later write while over quota.
+                    if not self._cache_quota_warned:
+                        logger.warning("Cache is %d bytes after evicting %d files, above its %d byte quota" % (
+                            self._cache_bytes, len(evicted), max_bytes))
+                        self._cache_quota_warned = True
+                else:
+                    self._cache_quota_warned = False
+            return evicted
+
+    def _forget_input_fingerprints(self, evicted):
+        """Remove the recorded input fingerprints (see `save_to_cache`) of evicted entries."""
+        for patient_cache_dir, entries in evicted.groupby(evicted["path"].map(path.dirname)):
+            recorded = self.load_input_fingerprints(patient_cache_dir)
+            remaining = {file_name: inputs for (file_name, inputs) in recorded.items()
+                         if file_name not in set(entries["file_name"])}
+            if remaining != recorded:
+                self._save_json_file(path.join(patient_cache_dir, "INPUTS"), remaining)
 
     def cohort_columns(self):
         cohort_dataframe = self.as_dataframe()
         column_types = [cohort_dataframe[col].dtype for col in cohort_dataframe.columns]
         return dict(zip(list(cohort_dataframe.columns), column_types))
 
+    def _set_styling(self):
+        """Apply the cohorts plot styling before this Cohort first plots."""
+        if not self._styled:
+            from .styling import set_styling
+            set_styling()
+            self._styled = True
+
     def plot_col_from_cols(self, cols, only_allow_one=False, plot_col=None):
         if type(cols) == str:
             if plot_col is not None:
@@ -1168,7 +1926,7 @@ class Cohort(Collection):
             raise ValueError("cols need to be a str or a list, but cols are %s" % str(cols))
         return plot_col
 
-    def plot_roc_curve(self, on, bootstrap_samples=100, ax=None, **kwargs):
+    def plot_roc_curve(self, on, bootstrap_samples=100, ax=None, skip_plot=False, **kwargs):
         """Plot an ROC curve for benefit and a given variable
 
         Parameters
@@ -1179,23 +1937,29 @@ class Cohort(Collection):
             Number of boostrap samples to use to compute the AUC
         ax : Axes, default None
             Axes to plot on
+        skip_plot : bool, optional
+            Compute the AUC without plotting
 
         Returns
         -------
         (mean_auc_score, plot): (float, matplotlib plot)
             Returns the average AUC for the given predictor over `bootstrap_samples`
-            and the associated ROC curve
+            and the associated ROC curve (None if `skip_plot`)
         """
         plot_col, df = self.as_dataframe(on, return_cols=True, **kwargs)
         df = filter_not_null(df, "benefit")
         df = filter_not_null(df, plot_col)
         df.benefit = df.benefit.astype(bool)
-        return roc_curve_plot(df, plot_col, "benefit", bootstrap_samples, ax=ax)
+        if not skip_plot:
+            self._set_styling()
+        return roc_curve_plot(df, plot_col, "benefit", bootstrap_samples, ax=ax, skip_plot=skip_plot)
 
     def plot_benefit(self, on, benefit_col="benefit", label="Response", ax=None,
                      alternative="two-sided", boolean_value_map={},
-                     order=None, **kwargs):
+                     order=None, n_permutations=None, random_state=None, skip_plot=False, **kwargs):
         """Plot a comparison of benefit/response in the cohort on a given variable
+
+        See `plot_boolean` for `n_permutations`, `random_state` and `skip_plot`.
         """
         no_benefit_plot_name = "No %s" % self.benefit_plot_name
         boolean_value_map = boolean_value_map or {True: self.benefit_plot_name, False: no_benefit_plot_name}
@@ -1208,6 +1972,9 @@ class Cohort(Collection):
                                  boolean_value_map=boolean_value_map,
                                  order=order,
                                  ax=ax,
+                                 n_permutations=n_permutations,
+                                 random_state=random_state,
+                                 skip_plot=skip_plot,
                                  **kwargs)
 
     def plot_boolean(self,
@@ -1219,6 +1986,9 @@ class Cohort(Collection):
                      order=None,
                      ax=None,
                      alternative="two-sided",
+                     n_permutations=None,
+                     random_state=None,
+                     skip_plot=False,
                      **kwargs):
         """Plot a comparison of `boolean_col` in the cohort on a given variable via
         `on` or `col`.
@@ -1250,6 +2020,14 @@ class Cohort(Collection):
             Axes to plot on
         alternative : str, optional
             Choose the sidedness of the mannwhitneyu or Fisher's Exact test.
+        n_permutations : int, optional
+            For a numeric variable, also run a Mann-Whitney permutation test with
+            this many permutations; see `cohorts.plot.mann_whitney_plot`. (Fisher's
+            Exact test is already exact.)
+        random_state : int, optional
+            Seed for the permutation test.
+        skip_plot : bool, optional
+            Compute the test results without plotting.
 
         Returns
         -------
@@ -1272,6 +2050,8 @@ class Cohort(Collection):
             df[boolean_col] = df[boolean_col].map(lambda v: boolean_value_map[v])
             condition_value = boolean_value_map[True]
 
+        if not skip_plot:
+            self._set_styling()
         if df[plot_col].dtype == "bool":
             results = fishers_exact_plot(
                 data=df,
@@ -1280,7 +2060,8 @@ class Cohort(Collection):
                 condition1_value=condition_value,
                 alternative=alternative,
                 order=order,
-                ax=ax)
+                ax=ax,
+                skip_plot=skip_plot)
         else:
             results = mann_whitney_plot(
                 data=df,
@@ -1289,7 +2070,10 @@ class Cohort(Collection):
                 condition_value=condition_value,
                 alternative=alternative,
                 order=order,
-                ax=ax)
+                ax=ax,
+                n_permutations=n_permutations,
+                random_state=random_state,
+                skip_plot=skip_plot)
         return results
 
     def plot_survival(self,
@@ -1306,7 +2090,10 @@ class Cohort(Collection):
                       color_map=None,
                       label_map=None,
                       color_palette="Set2",
-                      threshold=None, **kwargs):
+                      threshold=None,
+                      n_permutations=None,
+                      random_state=None,
+                      skip_plot=False, **kwargs):
         """Plot a Kaplan Meier survival curve by splitting the cohort into two groups
         Parameters
         ----------
@@ -1322,11 +2109,20 @@ class Cohort(Collection):
             Display the confidence interval around the survival curve
         threshold : int, "median", "median-per-strata" or None (optional)
             Threshold of `col` on which to split the cohort
+        n_permutations : int, optional
+            Also run a logrank permutation test with this many permutations; see
+            `cohorts.survival.plot_kmf`
+        random_state : int, optional
+            Seed for the permutation test
+        skip_plot : bool, optional
+            Compute the survival results without plotting
         """
         assert how in ["os", "pfs"], "Invalid choice of survival plot type %s" % how
         cols, df = self.as_dataframe(on, return_cols=True, **kwargs)
         plot_col = self.plot_col_from_cols(cols=cols, only_allow_one=True)
         df = filter_not_null(df, plot_col)
+        if not skip_plot:
+            self._set_styling()
         results = plot_kmf(
             df=df,
             condition_col=plot_col,
@@ -1345,10 +2141,67 @@ class Cohort(Collection):
             color_palette=color_palette,
             label_map=label_map,
             color_map=color_map,
+            n_permutations=n_permutations,
+            random_state=random_state,
+            skip_plot=skip_plot,
         )
         return results
 
-    def plot_correlation(self, on, x_col=None, plot_type="jointplot", stat_func=pearsonr, show_stat_func=True, plot_kwargs={}, **kwargs):
+    def _survival_arrays(self, on, how, **kwargs):
+        assert how in ["os", "pfs"], "Invalid choice of survival type %s" % how
+        cols, df = self.as_dataframe(on, return_cols=True, **kwargs)
+        col = self.plot_col_from_cols(cols=cols, only_allow_one=True)
+        df = filter_not_null(df, col)
+        censor_col = "deceased" if how == "os" else "progressed_or_deceased"
+        return (df[col].astype(float).values, df[how].values, df[censor_col].astype(bool).values)
+
+    def cutpoint_scan(self, on, how="os", min_group_fraction=0.1, **kwargs):
+        """Compute the logrank statistic of splitting the cohort at every candidate
+        threshold of a variable, without plotting.
+
+        Parameters
+        ----------
+        on : str or function or list or dict
+            See `cohort.load.as_dataframe`
+        how : {"os", "pfs"}, optional
+            Whether to use OS (overall survival) or PFS (progression free survival)
+        min_group_fraction : float
+            Only consider thresholds leaving at least this fraction of patients on each side
+
+        Returns
+        -------
+        DataFrame with one row per threshold; see `cohorts.cutpoint.cutpoint_scan`
+        """
+        values, durations, events = self._survival_arrays(on, how, **kwargs)
+        return cutpoint_scan(values, durations, events, min_group_fraction=min_group_fraction)
+
+    def maxstat(self, on, how="os", n_permutations=1000, min_group_fraction=0.1, random_state=None,
+                **kwargs):
+        """Find the threshold of a variable that best separates survival, with a
+        permutation-adjusted p-value (maximally selected rank statistics).
+
+        Parameters
+        ----------
+        on : str or function or list or dict
+            See `cohort.load.as_dataframe`
+        how : {"os", "pfs"}, optional
+            Whether to use OS (overall survival) or PFS (progression free survival)
+        n_permutations : int
+            Permutations used to adjust the p-value for the search over thresholds
+        min_group_fraction : float
+            Only consider thresholds leaving at least this fraction of patients on each side
+        random_state : int, optional
+            Seed for the permutations
+
+        Returns
+        -------
+        `cohorts.cutpoint.MaxstatResults`; its `threshold` can be passed to `plot_survival`
+        """
+        values, durations, events = self._survival_arrays(on, how, **kwargs)
+        return maxstat_test(values, durations, events, n_permutations=n_permutations,
+                            min_group_fraction=min_group_fraction, random_state=random_state)
+
+    def plot_correlation(self, on, x_col=None, plot_type="jointplot", stat_func=None, show_stat_func=True, plot_kwargs={}, **kwargs):
         """Plot the correlation between two variables.
 
         Parameters
@@ -1360,7 +2213,8 @@ class Cohort(Collection):
         plot_type : str, optional
             Specify "jointplot", "regplot", "boxplot", or "barplot".
         stat_func : function, optional.
-            Specify which function to use for the statistical test.
+            Specify which function to use for the statistical test. Defaults to
+            `scipy.stats.pearsonr`.
         show_stat_func : bool, optional
             Whether or not to show the stat_func result in the plot itself.
         plot_kwargs : dict, optional
@@ -1383,7 +2237,12 @@ class Cohort(Collection):
                 y_col = plot_cols[0]
         series_x = df[x_col]
         series_y = df[y_col]
+        if stat_func is None:
+            from scipy.stats import pearsonr
+            stat_func = pearsonr
         coeff, p_value = stat_func(series_x, series_y)
+        import seaborn as sb
+        self._set_styling()
         if plot_type == "jointplot":
             plot = sb.jointplot(data=df, x=x_col, y=y_col,
                                 stat_func=stat_func if show_stat_func else None,
@@ -1401,11 +2260,50 @@ class Cohort(Collection):
     def coxph(self, on, formula=None, how="pfs"):
         return cohort_coxph(self, on, formula=formula, how=how)
 
-    def bootstrap_auc(self, on, pred_col="is_benefit", n_bootstrap=1000, **kwargs):
-        return cohort_bootstrap_auc(self, on, pred_col=pred_col, n_bootstrap=n_bootstrap)
+    def bootstrap_auc(self, on, pred_col="is_benefit", n_bootstrap=1000, random_state=None, **kwargs):
+        return cohort_bootstrap_auc(self, on, pred_col=pred_col, n_bootstrap=n_bootstrap,
+                                    random_state=random_state)
+
+    def mean_bootstrap_auc(self, on, pred_col="is_benefit", n_bootstrap=1000, random_state=None, **kwargs):
+        return cohort_mean_bootstrap_auc(self, on, pred_col=pred_col, n_bootstrap=n_bootstrap,
+                                         random_state=random_state)
+
+    def screen(self, on, outcomes=["benefit", "os", "pfs"], tests=None, n_jobs=1,
+               n_bootstrap=1000, random_state=None, ci=0.95, correction="fdr_bh", **kwargs):
+        """Test many candidate biomarkers against clinical outcomes, without plotting.
+
+        The cohort DataFrame is built once, and each (column, outcome, test) is then
+        evaluated on it, across `n_jobs` worker processes.
 
-    def mean_bootstrap_auc(self, on, pred_col="is_benefit", n_bootstrap=1000, **kwargs):
-        return cohort_mean_bootstrap_auc(self, on, pred_col=pred_col, n_bootstrap=n_bootstrap)
+        Parameters
+        ----------
+        on : str or function or list or dict
+            See `cohort.load.as_dataframe`. Each resulting column is a candidate.
+        outcomes : list
+            Any of "benefit", "os" and "pfs".
+        tests : list, optional
+            Any of "auc" and "mann_whitney" (for benefit), and "logrank" and "coxph"
+            (for survival). By default, all tests that apply to each outcome.
+        n_jobs : int
+            Number of worker processes.
+        n_bootstrap : int
+            Bootstrap samples for AUC confidence intervals.
+        random_state : int, optional
+            Seed for the bootstrap, for reproducible results.
+        ci : float
+            Confidence level of the intervals.
+        correction : {"fdr_bh", "bonferroni", None}
+            Multiple testing correction applied across all tests.
+
+        Returns
+        -------
+        DataFrame with one row per (feature, outcome, test); see `cohorts.screen.screen`.
+        """
+        cols, df = self.as_dataframe(on, return_cols=True, **kwargs)
+        features = [cols] if type(cols) == str else list(cols)
+        return screen(df, features, outcomes=outcomes, tests=tests, n_jobs=n_jobs,
+                      n_bootstrap=n_bootstrap, random_state=random_state, ci=ci,
+                      correction=correction)
 
     def _list_patient_ids(self):
         """ Utility function to return a list of patient ids in the Cohort
@@ -1446,19 +2344,14 @@ class Cohort(Collection):
         frame for this cohort.
         """
         provenance_summary = {}
-        df = self.as_dataframe()
         for cache in self.cache_names:
             cache_name = self.cache_names[cache]
             cache_provenance = None
             num_discrepant = 0
-            this_cache_dir = path.join(self.cache_dir, cache_name)
-            if path.exists(this_cache_dir):
+            patient_provenance = self._load_cache_provenance(cache_name)
+            if patient_provenance is not None:
                 for patient_id in self._list_patient_ids():
-                    patient_cache_dir = path.join(this_cache_dir, patient_id)
-                    try:
-                        this_provenance = self.load_provenance(patient_cache_dir = patient_cache_dir)
-                    except:
-                        this_provenance = None
+                    this_provenance = patient_provenance[patient_id]
                     if this_provenance:
                         if not(cache_provenance):
                             cache_provenance = this_provenance
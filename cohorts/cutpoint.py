@@ -0,0 +1,140 @@
+# Copyright (c) 2017. Mount Sinai School of Medicine
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Search for the biomarker threshold that best separates survival.
+
+Every candidate threshold splits patients into those above it and the rest, as
+`plot_kmf` does. The survival data are sorted once (see `LogrankStatistic`), and
+the logrank statistics of all candidate splits are computed together. Since the
+best of many splits overstates significance, `maxstat_test` adjusts its p-value
+by permutation (maximally selected rank statistics, as in Lausen and Schumacher).
+"""
+
+from collections import namedtuple
+
+import numpy as np
+import pandas as pd
+
+from .permutation import LogrankStatistic, permuted_labels
+
+def candidate_thresholds(values, min_group_fraction=0.1):
+    """
+    Distinct values of a biomarker that, as thresholds, leave at least
+    `min_group_fraction` of patients on each side.
+    """
+    values = np.asarray(values, dtype=np.float64)
+    thresholds = np.unique(values)
+    n_above = len(values) - np.searchsorted(np.sort(values), thresholds, side="right")
+    min_group_size = max(1, int(np.ceil(min_group_fraction * len(values))))
+    keep = (n_above >= min_group_size) & (len(values) - n_above >= min_group_size)
+    return thresholds[keep]
+
+def cutpoint_scan(values, durations, events, thresholds=None, min_group_fraction=0.1):
+    """
+    Compute the logrank statistic of splitting patients at each candidate threshold.
+
+    Parameters
+    ----------
+    values : array-like
+        The biomarker.
+    durations : array-like
+    events : array-like
+        True where the event was observed, False if censored.
+    thresholds : array-like, optional
+        Defaults to `candidate_thresholds(values, min_group_fraction)`.
+    min_group_fraction : float
+
+    Returns
+    -------
+    DataFrame with one row per threshold: threshold, n_above, n_below, statistic
+    and p_value (unadjusted for the number of thresholds).
+    """
+    from scipy.stats import chi2
+    values = np.asarray(values, dtype=np.float64)
+    if thresholds is None:
+        thresholds = candidate_thresholds(values, min_group_fraction)
+    thresholds = np.asarray(thresholds, dtype=np.float64)
+    labelings = values[np.newaxis, :] > thresholds[:, np.newaxis]
+    statistics = LogrankStatistic(durations, events)(labelings)
+    n_above = labelings.sum(axis=1)
+    return pd.DataFrame({
+        "threshold": thresholds,
+        "n_above": n_above,
+        "n_below": len(values) - n_above,
+        "statistic": statistics,
+        "p_value": chi2.sf(statistics, 1)},
+        columns=["threshold", "n_above", "n_below", "statistic", "p_value"])
+
+class MaxstatResults(namedtuple("MaxstatResults", ["threshold", "statistic", "p_value", "n_permutations", "scan"])):
+    def __str__(self):
+        return "MaxstatResults(threshold=%s, statistic=%s, p_value=%s, n_permutations=%d)" % (
+            self.threshold, self.statistic, self.p_value, self.n_permutations)
+
+    def __repr__(self):
+        return self.__str__()
+
+def maxstat_test(values, durations, events, n_permutations=1000, min_group_fraction=0.1,
+                 random_state=None, batch_size=None):
+    """
+    Find the threshold with the largest logrank statistic, and test it against the
+    largest statistics found when the biomarker is permuted among patients.
+
+    Parameters
+    ----------
+    values : array-like
+        The biomarker.
+    durations : array-like
+    events : array-like
+        True where the event was observed, False if censored.
+    n_permutations : int
+    min_group_fraction : float
+        See `candidate_thresholds`.
+    random_state : int or numpy.random.RandomState, optional
+        Seed or generator for the permutations, for reproducible p-values.
+    batch_size : int, optional
+        Number of permutations evaluated at once. By default, enough for about a
+        million (threshold, patient) labels per batch.
+
+    Returns
+    -------
+    MaxstatResults, with the scan from `cutpoint_scan`
+    """
+    from sklearn.utils import check_random_state
+    values = np.asarray(values, dtype=np.float64)
+    thresholds = candidate_thresholds(values, min_group_fraction)
+    if len(thresholds) == 0:
+        raise ValueError("No threshold leaves %s of patients on each side" % min_group_fraction)
+    scan = cutpoint_scan(values, durations, events, thresholds=thresholds)
+    best = scan["statistic"].values.argmax()
+    statistic = scan["statistic"].values[best]
+
+    statistic_fn = LogrankStatistic(durations, events)
+    random_state = check_random_state(random_state)
+    if batch_size is None:
+        batch_size = max(1, 1000000 // (len(thresholds) * max(1, len(values))))
+    n_at_least = 0
+    for start in range(0, n_permutations, batch_size):
+        permuted_values = permuted_labels(values, min(batch_size, n_permutations - start), random_state)
+        # (permutations x thresholds x patients) labels, scored as one batch.
+        labelings = permuted_values[:, np.newaxis, :] > thresholds[np.newaxis, :, np.newaxis]
+        max_statistics = statistic_fn(labelings.reshape(-1, len(values))).reshape(
+            len(permuted_values), len(thresholds)).max(axis=1)
+        n_at_least += (max_statistics >= statistic - 1e-9 * abs(statistic)).sum()
+    return MaxstatResults(
+        threshold=scan["threshold"].values[best],
+        statistic=statistic,
+        p_value=(n_at_least + 1.0) / (n_permutations + 1.0),
+        n_permutations=n_permutations,
+        scan=scan)
@@ -30,15 +30,22 @@ class DataFrameLoader(object):
     join_on_left: str
         The corresponding column in the `cohorts.Patient.additional_data`
 	to join on, if not the `id` (which is the default).
+    fingerprint : function, optional
+        A function returning a value (e.g. a file's mtime) that changes whenever the
+        `DataFrame` would. A `Cohort` reuses the loaded `DataFrame` across `as_dataframe`
+        calls until this value changes or the Cohort's dataframe cache is cleared.
+        Without it, the `DataFrame` is loaded again on every `as_dataframe` call.
     """
     def __init__(self,
                  name,
                  load_dataframe,
                  join_on=None,
                  join_on_right="patient_id",
-                 join_on_left="patient_id"):
+                 join_on_left="patient_id",
+                 fingerprint=None):
         self.name = name
         self.load_dataframe = load_dataframe
+        self.fingerprint = fingerprint
         if join_on is not None:
             warnings.warn("`join_on` parameter is deprecated. Please use `join_on_right` instead.", DeprecationWarning)
             self.join_on_right = join_on
@@ -0,0 +1,241 @@
+# Copyright (c) 2017. Mount Sinai School of Medicine
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Reading per-patient gene expression quantifications (Kallisto, Cufflinks), and
+storing them as a compact patients x genes matrix.
+"""
+
+import json
+from os import close, makedirs, path, remove, replace
+import tempfile
+
+import numpy as np
+import pandas as pd
+from pyensembl import cached_release
+
+KALLISTO_DTYPES = {"target_id": str, "est_counts": np.float64}
+
+# Columns read from a Cufflinks genes.fpkm_tracking file.
+CUFFLINKS_DTYPES = {
+    "tracking_id": str,
+    "gene_id": str,
+    "gene_short_name": str,
+    "locus": str,
+    "FPKM": np.float64,
+    "FPKM_conf_lo": np.float64,
+    "FPKM_conf_hi": np.float64,
+    "FPKM_status": str,
+}
+
+_transcript_gene_names = {}
+
+def transcript_gene_names(ensembl_version):
+    """
+    Return a Series mapping transcript ID to gene name for an Ensembl release.
+
+    Built with a single query of the pyensembl database, and memoized per release.
+    """
+    if ensembl_version not in _transcript_gene_names:
+        ensembl_release = cached_release(ensembl_version)
+        rows = ensembl_release.db.run_sql_query(
+            "SELECT DISTINCT transcript_id, gene_name FROM transcript")
+        transcript_ids, gene_names = zip(*rows) if len(rows) > 0 else ([], [])
+        _transcript_gene_names[ensembl_version] = pd.Series(
+            gene_names, index=pd.Index(transcript_ids, name="target_id"), name="gene_name")
+    return _transcript_gene_names[ensembl_version]
+
+def read_kallisto_abundance(file_path):
+    """Read the transcript IDs and estimated counts from a Kallisto abundance.tsv."""
+    return pd.read_csv(
+        file_path,
+        sep="\t",
+        usecols=list(KALLISTO_DTYPES.keys()),
+        dtype=KALLISTO_DTYPES)
+
+def kallisto_gene_counts(df_abundance, gene_names):
+    """
+    Sum Kallisto estimated counts across the transcripts of each gene.
+
+    Parameters
+    ----------
+    df_abundance : DataFrame
+        With columns target_id and est_counts.
+    gene_names : Series
+        Transcript ID to gene name, from `transcript_gene_names`.
+
+    Returns
+    -------
+    DataFrame with columns gene_name and est_counts, sorted by gene_name.
+    """
+    df_genes = df_abundance.join(gene_names, on="target_id")
+    unmapped = df_genes["gene_name"].isnull()
+    if unmapped.any():
+        raise ValueError("%d transcript(s) not in the Ensembl release, e.g. %s" % (
+            unmapped.sum(), list(df_genes.loc[unmapped, "target_id"][:5])))
+    return df_genes.groupby("gene_name")[["est_counts"]].sum().reset_index()
+
+def read_cufflinks(file_path, filter_ok=True, chunksize=100000):
+    """
+    Read the `CUFFLINKS_DTYPES` columns of a Cufflinks FPKM tracking file.
+
+    Parameters
+    ----------
+    file_path : str
+    filter_ok : bool, optional
+        If true, only keep rows with FPKM_status == "OK". The file is then read
+        in chunks of `chunksize` rows, filtering each chunk as it is read.
+    """
+    read_kwargs = dict(sep="\t", usecols=list(CUFFLINKS_DTYPES.keys()), dtype=CUFFLINKS_DTYPES)
+    if not filter_ok:
+        return pd.read_csv(file_path, **read_kwargs)
+    chunks = [chunk[chunk["FPKM_status"] == "OK"]
+              for chunk in pd.read_csv(file_path, chunksize=chunksize, **read_kwargs)]
+    return pd.concat(chunks, ignore_index=True)
+
+# Gene and value columns of the per-patient tables that make up an expression matrix.
+EXPRESSION_MATRIX_SOURCES = {
+    "kallisto": ("gene_name", "est_counts"),
+    "cufflinks": ("gene_id", "FPKM"),
+}
+
+class ExpressionMatrix(object):
+    """
+    A patients x genes matrix of float32 expression values, stored in a directory as
+    a memory-mapped array with JSON row (patient) and column (gene) indexes.
+
+    Values are stored gene-major, so that selecting a few genes only reads those
+    genes' values from disk. Genes missing from a patient's quantification are NaN.
+
+    Parameters
+    ----------
+    directory : str
+        Written by `ExpressionMatrix.build`.
+
+    A matrix built without a directory is held in memory instead, and its
+    `directory` is None.
+    """
+    VALUES_FILE_NAME = "values.npy"
+    INDEX_FILE_NAME = "index.json"
+
+    def __init__(self, directory):
+        self.directory = directory
+        with open(path.join(directory, self.INDEX_FILE_NAME)) as f:
+            index = json.load(f)
+        self.patient_ids = pd.Index(index["patient_ids"], name="patient_id")
+        self.gene_names = pd.Index(index["gene_names"], name="gene")
+        self.metadata = index["metadata"]
+        # Opened now, so the values match the index even if the matrix is rebuilt.
+        self._values = np.load(path.join(directory, self.VALUES_FILE_NAME), mmap_mode="r")
+
+    @classmethod
+    def build(cls, directory, patient_ids, tables, gene_column, value_column, metadata=None):
+        """
+        Write an expression matrix from one long-format table per patient.
+
+        Parameters
+        ----------
+        directory : str or None
+            If None, the matrix is built in memory rather than written to disk.
+        patient_ids : list
+        tables : list
+            DataFrames, one per patient in `patient_ids`, with `gene_column` and `value_column`.
+        metadata : dict, optional
+            JSON-serializable description of the matrix's inputs, stored alongside it.
+        """
+        if len(patient_ids) == 0:
+            raise ValueError("Cannot build an expression matrix without patients")
+        tables = [table.groupby(gene_column)[value_column].sum() for table in tables]
+        gene_names = pd.Index(sorted(set().union(*[table.index for table in tables])))
+        if directory is None:
+            values = np.full((len(gene_names), len(patient_ids)), np.nan, dtype=np.float32)
+            for (i, table) in enumerate(tables):
+                values[gene_names.get_indexer(table.index), i] = table.values
+            values.flags.writeable = False
+            matrix = cls.__new__(cls)
+            matrix.directory = None
+            matrix.patient_ids = pd.Index([str(patient_id) for patient_id in patient_ids], name="patient_id")
+            matrix.gene_names = gene_names.rename("gene")
+            matrix.metadata = metadata or {}
+            matrix._values = values
+            return matrix
+        if not path.exists(directory):
+            makedirs(directory)
+        index_path = path.join(directory, cls.INDEX_FILE_NAME)
+        # The index is written last, so a partially written matrix is never opened.
+        if path.exists(index_path):
+            remove(index_path)
+        # Both files are written to temporary files and moved into place, so matrices
+        # already open on the old values (which are memory-mapped) keep reading them.
+        (fd, values_tmp_path) = tempfile.mkstemp(dir=directory, suffix=".tmp")
+        close(fd)
+        values = np.lib.format.open_memmap(
+            values_tmp_path, mode="w+", dtype=np.float32,
+            shape=(len(gene_names), len(patient_ids)))
+        values[:] = np.nan
+        for (i, table) in enumerate(tables):
+            values[gene_names.get_indexer(table.index), i] = table.values
+        values.flush()
+        del values
+        replace(values_tmp_path, path.join(directory, cls.VALUES_FILE_NAME))
+        with open(index_path + ".tmp", "w") as f:
+            json.dump(dict(patient_ids=[str(patient_id) for patient_id in patient_ids],
+                           gene_names=list(gene_names),
+                           metadata=metadata or {}), f)
+        replace(index_path + ".tmp", index_path)
+        return cls(directory)
+
+    @classmethod
+    def exists(cls, directory):
+        return path.exists(path.join(directory, cls.INDEX_FILE_NAME))
+
+    @property
+    def values(self):
+        """The genes x patients array, memory-mapped (or in memory) and read-only."""
+        return self._values
+
+    @property
+    def shape(self):
+        return (len(self.patient_ids), len(self.gene_names))
+
+    def _gene_positions(self, gene_names):
+        positions = self.gene_names.get_indexer(gene_names)
+        if (positions < 0).any():
+            raise ValueError("Genes not in the expression matrix: %s" % (
+                [gene for (gene, position) in zip(gene_names, positions) if position < 0]))
+        return positions
+
+    def genes(self, gene_names):
+        """Return a patients x `gene_names` DataFrame, reading only those genes."""
+        gene_names = list(gene_names)
+        return pd.DataFrame(
+            self.values[self._gene_positions(gene_names)].T,
+            index=self.patient_ids,
+            columns=pd.Index(gene_names, name="gene"))
+
+    def gene(self, gene_name):
+        """Return one gene's values as a Series indexed by patient_id."""
+        return pd.Series(
+            np.array(self.values[self._gene_positions([gene_name])[0]]),
+            index=self.patient_ids,
+            name=gene_name)
+
+    def patient(self, patient_id):
+        """Return one patient's values as a Series indexed by gene."""
+        position = self.patient_ids.get_loc(str(patient_id))
+        return pd.Series(np.array(self.values[:, position]), index=self.gene_names, name=str(patient_id))
+
+    def to_dataframe(self):
+        """Return the whole patients x genes matrix as a DataFrame."""
+        return pd.DataFrame(np.asarray(self.values).T, index=self.patient_ids, columns=self.gene_names)
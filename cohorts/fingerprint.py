@@ -0,0 +1,68 @@
+# Copyright (c) 2017. Mount Sinai School of Medicine
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Fingerprints of the input files (VCFs, MAFs, BAMs, ...) that a cache entry was
+computed from, used to detect cache entries that are stale.
+"""
+
+import hashlib
+from os import path, stat
+
+_content_hashes = {}
+
+def content_hash(file_path, block_size=1 << 20):
+    """SHA-1 of a file's contents, memoized on (path, mtime, size)."""
+    file_stat = stat(file_path)
+    key = (file_path, file_stat.st_mtime_ns, file_stat.st_size)
+    if key not in _content_hashes:
+        sha1 = hashlib.sha1()
+        with open(file_path, "rb") as f:
+            for block in iter(lambda: f.read(block_size), b""):
+                sha1.update(block)
+        _content_hashes[key] = sha1.hexdigest()
+    return _content_hashes[key]
+
+def file_fingerprint(file_path, hash_content=False):
+    """
+    Return a dict fingerprint of a file: its path, size and mtime and, if
+    `hash_content` is True, the SHA-1 of its contents. Size and mtime are None
+    for files that do not exist (or are not local).
+    """
+    fingerprint = {"path": file_path, "size": None, "mtime": None}
+    if path.exists(file_path):
+        file_stat = stat(file_path)
+        fingerprint["size"] = file_stat.st_size
+        fingerprint["mtime"] = file_stat.st_mtime_ns
+        if hash_content:
+            fingerprint["sha1"] = content_hash(file_path)
+    return fingerprint
+
+def fingerprints_match(recorded, current):
+    """
+    Whether two lists of fingerprints describe the same inputs.
+
+    Only fields present in both are compared, so that entries recorded with or
+    without content hashes stay valid when that setting changes. If both have a
+    content hash, a changed mtime alone (e.g. a re-copied file) is not a mismatch.
+    """
+    if len(recorded) != len(current):
+        return False
+    for recorded_fingerprint, current_fingerprint in zip(recorded, current):
+        keys = set(recorded_fingerprint.keys()) & set(current_fingerprint.keys())
+        if "sha1" in keys:
+            keys.discard("mtime")
+        if any(recorded_fingerprint[key] != current_fingerprint[key] for key in keys):
+            return False
+    return True
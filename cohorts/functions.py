@@ -21,7 +21,6 @@ from functools import wraps
 import numpy as np
 import pandas as pd
 from varcode.effects import Substitution, FrameShift
-from varcode.common import memoize
 from varcode.effects.effect_classes import Exonic
 import inspect
 
@@ -65,10 +64,8 @@ def count_function(func):
         return np.nan
     return wrapper
 
-@memoize
 def get_patient_to_mb(cohort):
-    patient_to_mb = dict(cohort.as_dataframe(join_with="ensembl_coverage")[["patient_id", "MB"]].to_dict("split")["data"])
-    return patient_to_mb
+    return cohort.patient_to_mb()
 
 def count_variants_function_builder(function_name, filterable_variant_function=None):
     """
@@ -0,0 +1,393 @@
+# Copyright (c) 2017. Mount Sinai School of Medicine
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+A local read-through cache of Google Storage objects, so that gs:// inputs
+(VCFs, MAFs, BAMs, expression quantifications) can be read like local files.
+
+Objects are stored by content, as <cache_dir>/objects/<key>/<file name>, where
+the key is derived from the object's checksum and size; identical objects
+under different URIs are stored once. An object's key is looked up from its
+metadata in the bucket (once per URI per `GoogleStorageCache`), so it is only
+downloaded again when its contents change. BAMs can also be fetched in part,
+into sparse stand-ins under <cache_dir>/sparse/<key>/ (see `bam_region_path`).
+
+Objects in use are pinned with a shared lock on <cache_dir>/locks/<key>, which
+eviction (by any thread or process) respects.
+"""
+
+import hashlib
+import os
+import shutil
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from os import path
+
+from .gcloud_storage import GoogleStorageIO, GoogleStorageIOError
+from ..cache_management import touch_access_time
+from ..utils import get_logger
+
+logger = get_logger(__name__)
+
+OBJECTS_DIR_NAME = "objects"
+SPARSE_DIR_NAME = "sparse"
+LOCKS_DIR_NAME = "locks"
+# Partial downloads, their resume state and locks, and state files being written.
+IN_PROGRESS_SUFFIXES = (".part", ".part.json", ".part.lock", ".tmp")
+
+def is_gs_uri(file_path):
+    return isinstance(file_path, str) and file_path.startswith("gs://")
+
+class GoogleStorageCache(object):
+    """
+    Parameters
+    ----------
+    cache_dir : str
+    max_bytes : int, optional
+        When a download takes the cache above this size, least recently used
+        objects are evicted.
+    gcio : GoogleStorageIO, optional
+        Defaults to one with the default gcloud credentials.
+    n_jobs : int
+        Number of objects downloaded at once by `prefetch`.
+    download_kwargs : dict, optional
+        Passed to `GoogleStorageIO.download_to_path`.
+
+    Object metadata (generation, size) is looked up once per URI per
+    `GoogleStorageCache`; call `forget` to check the bucket again.
+
+    A path returned by `local_path` may be evicted by a later download; pass
+    `pin=True` to protect it until `unpin` is called.
+    """
+    def __init__(self, cache_dir, max_bytes=None, gcio=None, n_jobs=4, download_kwargs=None):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self._gcio = gcio
+        self.n_jobs = n_jobs
+        self.download_kwargs = download_kwargs or {}
+        self._metadata = {}
+        self._reset_threads()
+
+    def _reset_threads(self):
+        self._pid = os.getpid()
+        self._lock = threading.RLock()
+        self._pending = {}
+        self._executor = None
+        # Key to [pin count, lock file] of objects pinned by this process.
+        self._pins = {}
+        self._key_locks = {}
+
+    def _check_fork(self):
+        # A forked worker process inherits locks, and futures of downloads,
+        # from threads that it doesn't have. Its copies of the parent's pins
+        # are dropped; the parent's lock files stay locked.
+        if self._pid != os.getpid():
+            self._reset_threads()
+
+    def _lock_path(self, key):
+        return path.join(self.cache_dir, LOCKS_DIR_NAME, key)
+
+    def _open_lock(self, key, operation):
+        """
+        Open a key's lock file and flock it, or return None if a non-blocking
+        `operation` fails.
+        """
+        import fcntl
+        lock_path = self._lock_path(key)
+        os.makedirs(path.dirname(lock_path), exist_ok=True)
+        while True:
+            lock_file = open(lock_path, "a")
+            try:
+                fcntl.flock(lock_file, operation)
+            except (IOError, OSError):
+                lock_file.close()
+                return None
+            # Eviction removes lock files, possibly after we opened this one.
+            try:
+                if path.samestat(os.fstat(lock_file.fileno()), os.stat(lock_path)):
+                    return lock_file
+            except OSError:
+                pass
+            lock_file.close()
+
+    def _pin(self, key):
+        import fcntl
+        with self._lock:
+            pin = self._pins.get(key)
+            if pin is None:
+                self._pins[key] = [1, self._open_lock(key, fcntl.LOCK_SH)]
+            else:
+                pin[0] += 1
+
+    def _unpin(self, key):
+        with self._lock:
+            pin = self._pins[key]
+            pin[0] -= 1
+            if pin[0] == 0:
+                del self._pins[key]
+                pin[1].close()
+
+    def unpin(self, local_path):
+        """
+        Release a pin taken by `local_path(..., pin=True)` or
+        `bam_region_path(..., pin=True)` on the file at `local_path`.
+        """
+        self._unpin(path.basename(path.dirname(local_path)))
+
+    @property
+    def gcio(self):
+        if self._gcio is None:
+            self._gcio = GoogleStorageIO()
+        return self._gcio
+
+    @property
+    def objects_dir(self):
+        return path.join(self.cache_dir, OBJECTS_DIR_NAME)
+
+    @property
+    def sparse_dir(self):
+        return path.join(self.cache_dir, SPARSE_DIR_NAME)
+
+    def metadata(self, gsuri):
+        """
+        Return a dict of the object's generation, size and content checksum,
+        or None if there is no such object.
+        """
+        with self._lock:
+            if gsuri in self._metadata:
+                return self._metadata[gsuri]
+        blob = self.gcio.get_blob(gsuri)
+        metadata = None if blob is None else {
+            "generation": blob.generation,
+            "size": blob.size,
+            "checksum": getattr(blob, "md5_hash", None) or getattr(blob, "crc32c", None)}
+        with self._lock:
+            self._metadata[gsuri] = metadata
+        return metadata
+
+    def fingerprint(self, gsuri):
+        """
+        An input fingerprint (see `fingerprint.file_fingerprint`) of a gs:// object,
+        from its metadata rather than a local copy.
+        """
+        metadata = self.metadata(gsuri)
+        return {"path": gsuri,
+                "size": metadata["size"] if metadata else None,
+                "generation": metadata["generation"] if metadata else None}
+
+    def forget(self, gsuri=None):
+        """Drop memoized metadata of one URI, or of all of them."""
+        with self._lock:
+            if gsuri is None:
+                self._metadata = {}
+            else:
+                self._metadata.pop(gsuri, None)
+
+    def _key(self, gsuri, metadata):
+        content = metadata["checksum"] or "%s#%s" % (gsuri, metadata["generation"])
+        return hashlib.sha1(("%s:%s" % (content, metadata["size"])).encode("utf-8")).hexdigest()
+
+    def local_path(self, gsuri, companions=(), pin=False):
+        """
+        Return the path of a local copy of a gs:// object, downloading it unless
+        the cached copy is of the object's current generation.
+
+        Parameters
+        ----------
+        gsuri : str
+        companions : list
+            Suffixes of files that must sit next to the object, e.g. [".bai"] for
+            a BAM index. Those that exist are downloaded along with it.
+        pin : bool
+            Protect the object from eviction until `unpin` is called with the
+            returned path.
+        """
+        self._check_fork()
+        with self._lock:
+            future = self._pending.get((gsuri, tuple(companions)))
+        if future is not None:
+            if not pin:
+                return future.result()
+            # Wait for the prefetch, and then pin what it fetched (or try again).
+            future.exception()
+        return self._fetch(gsuri, tuple(companions), pin=pin)
+
+    def _fetch(self, gsuri, companions, pin=False):
+        metadata = self.metadata(gsuri)
+        if metadata is None:
+            raise GoogleStorageIOError("No such file on Google Storage: '{}'".format(gsuri))
+        key = self._key(gsuri, metadata)
+        local_path = path.join(self.objects_dir, key, path.basename(gsuri))
+        with self._lock:
+            # Different URIs with the same contents are downloaded to the same place.
+            key_lock = self._key_locks.setdefault(key, threading.Lock())
+        # Objects are pinned while they are downloaded, and then if requested.
+        self._pin(key)
+        fetched = False
+        try:
+            with key_lock:
+                downloaded = self._download(gsuri, local_path, companions)
+            touch_access_time(local_path)
+            if downloaded:
+                self.evict()
+            fetched = True
+        finally:
+            if not (pin and fetched):
+                self._unpin(key)
+        return local_path
+
+    def _download(self, gsuri, local_path, companions):
+        """Download an object and its companions, unless present. Return whether any were downloaded."""
+        downloaded = False
+        if not path.exists(local_path):
+            os.makedirs(path.dirname(local_path), exist_ok=True)
+            logger.info("Downloading %s to the local cache" % gsuri)
+            self.gcio.download_to_path(gsuri, local_path, **self.download_kwargs)
+            downloaded = True
+        for suffix in companions:
+            companion_path = local_path + suffix
+            if not path.exists(companion_path) and self.metadata(gsuri + suffix) is not None:
+                self.gcio.download_to_path(gsuri + suffix, companion_path, **self.download_kwargs)
+                downloaded = True
+        return downloaded
+
+    def bam_region_path(self, gsuri, regions, pin=False):
+        """
+        Return the path of a local stand-in for a gs:// BAM that only holds the
+        alignments overlapping `regions`, and its index (see
+        `gcloud_range.fetch_bam_regions`). Regions are added to it as they are
+        requested. If the whole BAM is already cached, its path is returned.
+
+        Parameters
+        ----------
+        gsuri : str
+        regions : list
+            (contig, start, end) tuples, 1-based and inclusive.
+        pin : bool
+            Protect the file from eviction until `unpin` is called with the
+            returned path.
+        """
+        from .gcloud_range import fetch_bam_regions
+        metadata = self.metadata(gsuri)
+        if metadata is None:
+            raise GoogleStorageIOError("No such file on Google Storage: '{}'".format(gsuri))
+        key = self._key(gsuri, metadata)
+        whole_path = path.join(self.objects_dir, key, path.basename(gsuri))
+        with self._lock:
+            key_lock = self._key_locks.setdefault(key, threading.Lock())
+        self._pin(key)
+        fetched = False
+        try:
+            if path.exists(whole_path) and path.exists(whole_path + ".bai"):
+                local_path = whole_path
+                touch_access_time(local_path)
+            else:
+                local_path = path.join(self.sparse_dir, key, path.basename(gsuri))
+                with key_lock:
+                    os.makedirs(path.dirname(local_path), exist_ok=True)
+                    n_bytes = fetch_bam_regions(self.gcio, gsuri, local_path, regions)
+                    logger.info("Fetched %d bytes of %s for %d regions" % (n_bytes, gsuri, len(regions)))
+                touch_access_time(local_path)
+                self.evict()
+            fetched = True
+        finally:
+            if not (pin and fetched):
+                self._unpin(key)
+        return local_path
+
+    def prefetch(self, gsuris, companions=()):
+        """
+        Start downloading objects in background threads; `local_path` then
+        waits for those downloads rather than starting its own.
+        """
+        companions = tuple(companions)
+        self._check_fork()
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.n_jobs)
+            for gsuri in gsuris:
+                pending_key = (gsuri, companions)
+                if pending_key not in self._pending:
+                    future = self._executor.submit(self._fetch, gsuri, companions)
+                    future.add_done_callback(lambda future, pending_key=pending_key: self._done(pending_key, future))
+                    self._pending[pending_key] = future
+
+    def _done(self, pending_key, future):
+        if future.exception() is not None:
+            # local_path will try again, and report the error, if the object is used.
+            logger.debug("Prefetching %s failed: %s" % (pending_key[0], future.exception()))
+        with self._lock:
+            if self._pending.get(pending_key) is future:
+                del self._pending[pending_key]
+
+    def usage(self):
+        """
+        Return a list of (last access time, bytes, key, directory) of cached objects,
+        both whole and sparse. Bytes are those allocated on disk, which for sparse
+        BAMs is much less than their size.
+        """
+        entries = []
+        for directory in [self.objects_dir, self.sparse_dir]:
+            if not path.isdir(directory):
+                continue
+            for key in os.listdir(directory):
+                object_dir = path.join(directory, key)
+                n_bytes = 0
+                last_access = 0
+                # Objects may be evicted, and in-flight downloads' partial and
+                # lock files come and go, while this runs.
+                try:
+                    file_names = os.listdir(object_dir)
+                except FileNotFoundError:
+                    continue
+                for file_name in file_names:
+                    if file_name.endswith(IN_PROGRESS_SUFFIXES):
+                        continue
+                    try:
+                        file_stat = os.stat(path.join(object_dir, file_name))
+                    except FileNotFoundError:
+                        continue
+                    n_bytes += min(file_stat.st_size, getattr(file_stat, "st_blocks", 0) * 512 or file_stat.st_size)
+                    last_access = max(last_access, file_stat.st_atime, file_stat.st_mtime)
+                entries.append((last_access, n_bytes, key, directory))
+        return entries
+
+    def evict(self, keep=()):
+        """
+        Remove least recently used objects until the cache is within `max_bytes`,
+        other than those pinned (by any process) and those with keys in `keep`.
+        """
+        import fcntl
+        if self.max_bytes is None:
+            return []
+        with self._lock:
+            entries = sorted(self.usage())
+            total_bytes = sum(n_bytes for (_, n_bytes, _, _) in entries)
+            evicted = []
+            for (_, n_bytes, key, directory) in entries:
+                if total_bytes <= self.max_bytes:
+                    break
+                if key in keep:
+                    continue
+                lock_file = self._open_lock(key, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                if lock_file is None:
+                    continue
+                try:
+                    shutil.rmtree(path.join(directory, key), ignore_errors=True)
+                    os.remove(self._lock_path(key))
+                finally:
+                    lock_file.close()
+                total_bytes -= n_bytes
+                evicted.append(key)
+            return evicted
@@ -0,0 +1,396 @@
+# Copyright (c) 2017. Mount Sinai School of Medicine
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Reading parts of Google Storage objects without downloading them.
+
+`GoogleStorageRangeFile` is a seekable, read-only file object over ranged reads,
+with a cache of fixed-size blocks and read-ahead for sequential reads; it can be
+handed to readers that take file objects, e.g. `vcf.Reader(fsock=...)`.
+
+pysam (htslib) needs a path, so for a BAM, `fetch_bam_regions` writes a sparse
+local stand-in instead: a file of the BAM's size holding only the header, the
+end-of-file marker and the BGZF blocks that the BAM index lists for the
+requested regions. With the index next to it, pysam reads those regions from
+it as from the full BAM.
+"""
+
+import gzip
+import io
+import json
+import os
+import struct
+import zlib
+from collections import OrderedDict
+
+from .gcloud_storage import GoogleStorageIOError
+
+DEFAULT_BLOCK_SIZE = 1 << 20
+DEFAULT_CACHE_BLOCKS = 64
+DEFAULT_READ_AHEAD = 4
+
+# BGZF blocks are at most this many bytes, compressed.
+MAX_BGZF_BLOCK_SIZE = 1 << 16
+BGZF_EOF = bytes(bytearray([
+    0x1f, 0x8b, 0x08, 0x04, 0x00, 0x00, 0x00, 0x00, 0x00, 0xff, 0x06, 0x00, 0x42, 0x43,
+    0x02, 0x00, 0x1b, 0x00, 0x03, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00]))
+# The BAI pseudo-bin holding per-reference metadata rather than chunks.
+BAI_PSEUDO_BIN = 37450
+
+class GoogleStorageRangeFile(io.RawIOBase):
+    """
+    A read-only, seekable file object over a Google Storage object.
+
+    The object is read in blocks of `block_size` bytes, keeping the last
+    `cache_blocks` of them. When reads are sequential, the following
+    `read_ahead` blocks are fetched in the same request.
+
+    Parameters
+    ----------
+    gcio : GoogleStorageIO
+    gsuri : str
+    block_size : int
+    cache_blocks : int
+    read_ahead : int
+    """
+    def __init__(self, gcio, gsuri, block_size=DEFAULT_BLOCK_SIZE, cache_blocks=DEFAULT_CACHE_BLOCKS,
+                 read_ahead=DEFAULT_READ_AHEAD):
+        io.RawIOBase.__init__(self)
+        self.gcio = gcio
+        self.gsuri = gsuri
+        self.blob = gcio.get_blob(gsuri)
+        if not self.blob:
+            raise GoogleStorageIOError("No such file on Google Storage: '{}'".format(gsuri))
+        self.size = self.blob.size or 0
+        self.block_size = block_size
+        self.cache_blocks = max(cache_blocks, read_ahead + 1)
+        self.read_ahead = read_ahead
+        self._blocks = OrderedDict()
+        self._position = 0
+        self._last_block = None
+        # Transfer statistics.
+        self.n_requests = 0
+        self.bytes_transferred = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            position = offset
+        elif whence == io.SEEK_CUR:
+            position = self._position + offset
+        elif whence == io.SEEK_END:
+            position = self.size + offset
+        else:
+            raise ValueError("Invalid whence: %s" % whence)
+        if position < 0:
+            raise ValueError("Negative seek position %d" % position)
+        self._position = position
+        return position
+
+    def _fetch_blocks(self, first, last):
+        """Fetch blocks first to last (inclusive) with one ranged read."""
+        start = first * self.block_size
+        end = min((last + 1) * self.block_size, self.size) - 1
+        data = self.gcio.download_range(self.blob, start, end)
+        self.n_requests += 1
+        self.bytes_transferred += len(data)
+        for index in range(first, last + 1):
+            offset = (index - first) * self.block_size
+            self._blocks[index] = data[offset:offset + self.block_size]
+        while len(self._blocks) > self.cache_blocks:
+            self._blocks.popitem(last=False)
+
+    def _block(self, index):
+        if index in self._blocks:
+            self._blocks.move_to_end(index)
+        else:
+            last = index
+            if self._last_block is not None and index == self._last_block + 1:
+                last = index + self.read_ahead
+            n_blocks = (self.size + self.block_size - 1) // self.block_size
+            last = min(last, n_blocks - 1)
+            # Don't fetch blocks that are already cached.
+            while last > index and last in self._blocks:
+                last -= 1
+            self._fetch_blocks(index, last)
+        self._last_block = index
+        return self._blocks[index]
+
+    def readinto(self, buffer):
+        n = min(len(buffer), max(0, self.size - self._position))
+        written = 0
+        while written < n:
+            (index, offset) = divmod(self._position + written, self.block_size)
+            block = self._block(index)
+            chunk = block[offset:offset + n - written]
+            buffer[written:written + len(chunk)] = chunk
+            written += len(chunk)
+        self._position += written
+        return written
+
+    def read_range(self, start, end):
+        """Return bytes `start` to `end` (exclusive), through the block cache."""
+        self.seek(start)
+        return self.read(end - start)
+
+def open_gs(gcio, gsuri, mode="r", decompress=False, **kwargs):
+    """
+    Open a Google Storage object for streaming reads, with `GoogleStorageRangeFile`
+    underneath. In text mode ("r"), returns a text stream. The object's bytes are
+    returned as they are, unless `decompress` is True, in which case
+    gzip-compressed (including bgzipped) objects ending in .gz are decompressed.
+    """
+    if "w" in mode or "a" in mode or "+" in mode:
+        raise ValueError("Streaming Google Storage files are read-only, not '%s'" % mode)
+    stream = io.BufferedReader(GoogleStorageRangeFile(gcio, gsuri, **kwargs))
+    if decompress and gsuri.endswith(".gz"):
+        stream = gzip.GzipFile(fileobj=stream, mode="rb")
+    if "b" in mode:
+        return stream
+    return io.TextIOWrapper(stream)
+
+def read_bgzf_block(fileobj, offset):
+    """
+    Read the BGZF block at compressed `offset`.
+
+    Returns
+    -------
+    (decompressed data, compressed size of the block)
+    """
+    fileobj.seek(offset)
+    header = fileobj.read(12)
+    if len(header) < 12 or header[:4] != b"\x1f\x8b\x08\x04":
+        raise ValueError("No BGZF block at offset %d" % offset)
+    (xlen,) = struct.unpack("<H", header[10:12])
+    extra = fileobj.read(xlen)
+    block_size = None
+    position = 0
+    while position < xlen:
+        (si1, si2, slen) = struct.unpack("<BBH", extra[position:position + 4])
+        if (si1, si2) == (66, 67):
+            (block_size,) = struct.unpack("<H", extra[position + 4:position + 6])
+            block_size += 1
+        position += 4 + slen
+    if block_size is None:
+        raise ValueError("No BGZF block size at offset %d" % offset)
+    compressed = fileobj.read(block_size - 12 - xlen)
+    return (zlib.decompress(compressed[:-8], -15), block_size)
+
+def read_bam_header(fileobj):
+    """
+    Read the reference names of a BAM, and the compressed offset just past the
+    BGZF blocks holding its header.
+    """
+    data = b""
+    offset = 0
+
+    def require(n_bytes):
+        nonlocal data, offset
+        while len(data) < n_bytes:
+            (block, block_size) = read_bgzf_block(fileobj, offset)
+            data += block
+            offset += block_size
+
+    require(8)
+    if data[:4] != b"BAM\x01":
+        raise ValueError("Not a BAM file")
+    (l_text,) = struct.unpack("<i", data[4:8])
+    require(12 + l_text)
+    (n_ref,) = struct.unpack("<i", data[8 + l_text:12 + l_text])
+    position = 12 + l_text
+    reference_names = []
+    for _ in range(n_ref):
+        require(position + 4)
+        (l_name,) = struct.unpack("<i", data[position:position + 4])
+        require(position + 8 + l_name)
+        reference_names.append(data[position + 4:position + 3 + l_name].decode("ascii"))
+        position += 8 + l_name
+    return (reference_names, offset)
+
+def read_bai(data):
+    """
+    Parse a BAM index.
+
+    Returns
+    -------
+    A list with, for each reference, a (dict of bin to list of (begin, end) virtual
+    offsets, list of linear index offsets) tuple.
+    """
+    if data[:4] != b"BAI\x01":
+        raise ValueError("Not a BAM index")
+    (n_ref,) = struct.unpack_from("<i", data, 4)
+    position = 8
+    references = []
+    for _ in range(n_ref):
+        (n_bin,) = struct.unpack_from("<i", data, position)
+        position += 4
+        bins = {}
+        for _ in range(n_bin):
+            (bin_number, n_chunk) = struct.unpack_from("<Ii", data, position)
+            position += 8
+            chunks = struct.unpack_from("<%dQ" % (2 * n_chunk), data, position)
+            position += 16 * n_chunk
+            if bin_number != BAI_PSEUDO_BIN:
+                bins[bin_number] = list(zip(chunks[::2], chunks[1::2]))
+        (n_intv,) = struct.unpack_from("<i", data, position)
+        position += 4
+        intervals = list(struct.unpack_from("<%dQ" % n_intv, data, position))
+        position += 8 * n_intv
+        references.append((bins, intervals))
+    return references
+
+def reg2bins(begin, end):
+    """The BAI bins that may hold alignments overlapping [begin, end), 0-based."""
+    end -= 1
+    bins = [0]
+    for (shift, offset) in [(26, 1), (23, 9), (20, 73), (17, 585), (14, 4681)]:
+        bins.extend(range(offset + (begin >> shift), offset + (end >> shift) + 1))
+    return bins
+
+def bai_chunks(reference_index, begin, end):
+    """
+    The (begin, end) virtual offset chunks of a reference's index that hold
+    alignments overlapping [begin, end), 0-based. As in htslib, chunks are
+    clipped to start no earlier than the linear index allows.
+    """
+    (bins, intervals) = reference_index
+    min_offset = intervals[min(begin >> 14, len(intervals) - 1)] if len(intervals) > 0 else 0
+    chunks = []
+    for bin_number in reg2bins(begin, end):
+        chunks.extend((max(chunk_begin, min_offset), chunk_end)
+                      for (chunk_begin, chunk_end) in bins.get(bin_number, [])
+                      if chunk_end > min_offset)
+    return sorted(chunks)
+
+def merge_ranges(ranges):
+    """Merge overlapping or adjacent [start, end) byte ranges."""
+    merged = []
+    for (start, end) in sorted(ranges):
+        if len(merged) > 0 and start <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([start, end])
+    return merged
+
+def subtract_ranges(ranges, have):
+    """The parts of [start, end) `ranges` not covered by the merged ranges `have`."""
+    missing = []
+    for (start, end) in merge_ranges(ranges):
+        for (have_start, have_end) in have:
+            if have_end <= start or have_start >= end:
+                continue
+            if have_start > start:
+                missing.append([start, have_start])
+            start = max(start, have_end)
+            if start >= end:
+                break
+        if start < end:
+            missing.append([start, end])
+    return missing
+
+def bam_region_byte_ranges(reference_names, header_end, size, bai, regions):
+    """
+    The compressed byte ranges of a BAM that hold its header, its EOF marker and
+    the alignments overlapping `regions`.
+
+    Parameters
+    ----------
+    reference_names : list
+    header_end : int
+        As from `read_bam_header`.
+    size : int
+        Size of the BAM.
+    bai : list
+        As from `read_bai`.
+    regions : list
+        (contig, start, end) tuples, 1-based and inclusive. Contigs are matched to the
+        BAM's reference names with or without a "chr" prefix.
+    """
+    reference_ids = {}
+    for (i, name) in enumerate(reference_names):
+        reference_ids[name] = i
+        reference_ids.setdefault(name[3:] if name.startswith("chr") else "chr" + name, i)
+    ranges = [[0, header_end], [max(0, size - len(BGZF_EOF)), size]]
+    for (contig, start, end) in regions:
+        reference_id = reference_ids.get(str(contig))
+        if reference_id is None or reference_id >= len(bai):
+            continue
+        for (chunk_begin, chunk_end) in bai_chunks(bai[reference_id], max(0, start - 1), end):
+            # The chunk ends within the BGZF block at its end's compressed offset.
+            ranges.append([chunk_begin >> 16,
+                           min(size, (chunk_end >> 16) + MAX_BGZF_BLOCK_SIZE)])
+    return merge_ranges(ranges)
+
+def fetch_bam_regions(gcio, gsuri, local_path, regions, index_suffix=".bai"):
+    """
+    Write a sparse local stand-in for a gs:// BAM that holds the alignments
+    overlapping `regions` (see `bam_region_byte_ranges`), along with its index.
+
+    The byte ranges fetched are recorded next to it, so regions requested later
+    only transfer what is missing. If the BAM's generation changes, it is
+    started afresh.
+
+    Returns
+    -------
+    The number of bytes of the BAM transferred.
+    """
+    bam_file = GoogleStorageRangeFile(gcio, gsuri, block_size=MAX_BGZF_BLOCK_SIZE, read_ahead=0)
+    state_path = local_path + ".ranges.json"
+    index_path = local_path + index_suffix
+    state = {}
+    if os.path.exists(state_path) and os.path.exists(local_path) and os.path.exists(index_path):
+        with open(state_path) as f:
+            state = json.load(f)
+    if state.get("generation") != bam_file.blob.generation:
+        gcio.download_to_path(gsuri + index_suffix, index_path)
+        (reference_names, header_end) = read_bam_header(bam_file)
+        state = {"generation": bam_file.blob.generation, "reference_names": reference_names,
+                 "header_end": header_end, "ranges": []}
+        with open(local_path, "wb") as f:
+            f.truncate(bam_file.size)
+    with open(index_path, "rb") as f:
+        bai = read_bai(f.read())
+
+    ranges = bam_region_byte_ranges(state["reference_names"], state["header_end"], bam_file.size,
+                                    bai, regions)
+    missing = subtract_ranges(ranges, state["ranges"])
+    n_bytes = 0
+    with open(local_path, "r+b") as f:
+        for (start, end) in missing:
+            # The header was already read through the block cache; the rest is fetched exactly.
+            if end <= state["header_end"]:
+                data = bam_file.read_range(start, end)
+            else:
+                data = gcio.download_range(bam_file.blob, start, end - 1)
+                n_bytes += len(data)
+            if len(data) != end - start:
+                raise GoogleStorageIOError(
+                    "Short read of bytes {}-{} of {}: got {} bytes".format(start, end - 1, gsuri, len(data)))
+            f.seek(start)
+            f.write(data)
+    state["ranges"] = merge_ranges(state["ranges"] + missing)
+    with open(state_path + ".tmp", "w") as f:
+        json.dump(state, f)
+    os.replace(state_path + ".tmp", state_path)
+    # htslib warns about indexes older than their BAM.
+    os.utime(index_path, None)
+    return bam_file.bytes_transferred + n_bytes
@@ -1,13 +1,32 @@
+import base64
+import json
+import logging
 import os
+import struct
 import tempfile
+import threading
+import time
 from contextlib import contextmanager
 from urllib.parse import urlparse
 
-from google.cloud import storage
+from ..utils import thread_map
 
 
+logger = logging.getLogger(__name__)
+
 _GOOGLE_STORAGE_SCHEMA = "gs"
 
+# Downloads are split into slices of this many bytes, fetched in parallel
+# with ranged reads and retried independently.
+DEFAULT_SLICE_SIZE = 64 << 20
+DEFAULT_DOWNLOAD_N_JOBS = 8
+# Uploads are sent in chunks of this many bytes (a multiple of 256 KiB, as
+# the API requires).
+DEFAULT_UPLOAD_CHUNK_SIZE = 64 << 20
+DEFAULT_MAX_RETRIES = 3
+# HTTP status codes of failures that are worth retrying.
+TRANSIENT_STATUS_CODES = [408, 429, 500, 502, 503, 504]
+
 ## Things that can go here ##
 class GoogleStorageEnvironmentError(EnvironmentError): pass
 class GoogleStorageValueError(ValueError): pass
@@ -15,6 +34,160 @@ class GoogleStorageIOError(IOError): pass
 ## End of things that can go wrong
 
 
+def _crc32c_table():
+    table = []
+    for i in range(256):
+        crc = i
+        for _ in range(8):
+            crc = (crc >> 1) ^ (0x82F63B78 if crc & 1 else 0)
+        table.append(crc)
+    return table
+
+
+def _crc32c_update_python(crc, data, _table=_crc32c_table()):
+    crc ^= 0xFFFFFFFF
+    for byte in bytearray(data):
+        crc = _table[(crc ^ byte) & 0xFF] ^ (crc >> 8)
+    return crc ^ 0xFFFFFFFF
+
+
+_crc32c_update = None
+
+
+def _crc32c_update_function():
+    """
+    Return a function (crc, data) -> crc, preferring a native CRC32C
+    implementation: google-crc32c (installed along with recent
+    google-cloud-storage releases) or crc32c.
+    """
+    global _crc32c_update
+    if _crc32c_update is not None:
+        return _crc32c_update
+    try:
+        import google_crc32c
+        _crc32c_update = lambda crc, data: google_crc32c.extend(crc, data)
+        return _crc32c_update
+    except ImportError:
+        pass
+    try:
+        import crc32c
+        _crc32c_update = lambda crc, data: crc32c.crc32c(data, crc)
+        return _crc32c_update
+    except ImportError:
+        pass
+    logger.warning("No native CRC32C package found (pip install google-crc32c); "
+                   "checksums of large files will be slow")
+    _crc32c_update = _crc32c_update_python
+    return _crc32c_update
+
+
+def crc32c_of_file(localpath, block_size=8 << 20):
+    """
+    The CRC32C checksum of a local file, base64-encoded the way Google
+    Storage reports it in `Blob.crc32c`.
+    """
+    update = _crc32c_update_function()
+    crc = 0
+    with open(localpath, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            crc = update(crc, block)
+    return base64.b64encode(struct.pack(">I", crc)).decode("ascii")
+
+
+def _is_transient(error):
+    """
+    Whether a failed request may succeed if retried: connection failures and
+    timeouts, rate limiting and server errors, but not e.g. NotFound or Forbidden.
+    """
+    if isinstance(error, (ConnectionError, TimeoutError)):
+        return True
+    # google.api_core exceptions carry the HTTP status as `code`, and requests'
+    # HTTPError on its response.
+    code = getattr(error, "code", None)
+    if code is None:
+        code = getattr(getattr(error, "response", None), "status_code", None)
+    if code is not None:
+        return code in TRANSIENT_STATUS_CODES
+    try:
+        import requests
+        if isinstance(error, (requests.exceptions.ConnectionError, requests.exceptions.Timeout)):
+            return True
+    except ImportError:
+        pass
+    try:
+        from google.auth.exceptions import TransportError
+        return isinstance(error, TransportError)
+    except ImportError:
+        return False
+
+
+def _with_retries(fn, max_retries, description):
+    """Call `fn`, retrying transient failures with exponential backoff."""
+    for attempt in range(max_retries + 1):
+        try:
+            return fn()
+        except GoogleStorageIOError:
+            raise
+        except Exception as e:
+            if not _is_transient(e):
+                raise GoogleStorageIOError("Failed to {}: {}".format(description, e))
+            if attempt == max_retries:
+                raise GoogleStorageIOError(
+                    "Failed to {} after {} attempts: {}".format(description, attempt + 1, e))
+            logger.warning("Failed to %s (attempt %d), retrying: %s", description, attempt + 1, e)
+            time.sleep(min(2 ** attempt, 30))
+
+
+def _upload_offset(response):
+    """
+    The number of bytes of a resumable upload that Google Storage has
+    committed, from its response to a chunk or status request, or None
+    once the upload is complete.
+    """
+    if response.status_code in (200, 201):
+        return None
+    if response.status_code != 308:
+        response.raise_for_status()
+        raise GoogleStorageIOError(
+            "Unexpected response to a resumable upload: {}".format(response.status_code))
+    # "Range: bytes=0-<last committed byte>", absent if nothing is committed yet.
+    committed = response.headers.get("Range")
+    return 0 if committed is None else int(committed.rsplit("-", 1)[1]) + 1
+
+
+@contextmanager
+def _exclusive_lock(lock_path):
+    """
+    Hold an exclusive lock on `lock_path`, across both threads and processes,
+    removing the lock file on release. Yields whether another holder had to be
+    waited for.
+    """
+    import fcntl
+    waited = False
+    while True:
+        lock_file = open(lock_path, "a")
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except (IOError, OSError):
+            waited = True
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+        # The previous holder may have removed the file after we opened it.
+        try:
+            if os.path.samestat(os.fstat(lock_file.fileno()), os.stat(lock_path)):
+                break
+        except OSError:
+            pass
+        lock_file.close()
+    try:
+        yield waited
+    finally:
+        try:
+            os.remove(lock_path)
+        except OSError:
+            pass
+        lock_file.close()
+
+
 class GoogleStorageIO:
     """
     This is a simple, light-weight wrapper aound Google Cloud's SDK
@@ -38,12 +211,22 @@ class GoogleStorageIO:
     More information on the auth procedures:
         https://cloud.google.com/docs/authentication/
     """
-    def __init__(self, *args, **kwargs):
+    def __init__(self, *args, client=None, **kwargs):
         """
         You can pass authentication related configuration directly down to
         gcloud client, so if the default automated auth method doesn't work
         this will help you go with other options: CREDs, service accounts, etc.
+
+        client: an already configured client (or a stand-in with the same
+                get_bucket/blob API, e.g. for tests); other arguments are
+                then ignored.
         """
+        self._buckets = {}
+        self._buckets_lock = threading.Lock()
+        if client is not None:
+            self._client = client
+            return
+        from google.cloud import storage
         try:
             self._client = storage.Client(*args, **kwargs)
         except Exception as e:
@@ -66,13 +249,28 @@ class GoogleStorageIO:
 
     def list_files(self, gsuri, **kwargs):
         bucket_name, gs_rel_path = self.parse_uri(gsuri)
-        bucket = self._client.get_bucket(bucket_name)
+        bucket = self.get_bucket(bucket_name)
         return bucket.list_blobs(**kwargs)
 
 
     @client.setter
     def client(self, new_client):
         self._client = new_client
+        with self._buckets_lock:
+            self._buckets = {}
+
+
+    def get_bucket(self, bucket_name):
+        """
+        Bucket handles are looked up once (one API call) and then reused.
+        """
+        with self._buckets_lock:
+            bucket = self._buckets.get(bucket_name)
+        if bucket is None:
+            bucket = self._client.get_bucket(bucket_name)
+            with self._buckets_lock:
+                bucket = self._buckets.setdefault(bucket_name, bucket)
+        return bucket
 
 
     def parse_uri(self, gsuri):
@@ -86,58 +284,199 @@ class GoogleStorageIO:
         return (bucket_name, gs_rel_path)
 
 
-    def upload_file(self, localpath, gsuri):
+    def upload_file(self, localpath, gsuri, chunk_size=DEFAULT_UPLOAD_CHUNK_SIZE,
+                    max_retries=DEFAULT_MAX_RETRIES, verify=True):
+        """
+        Upload a local file through a resumable upload session, in chunks of
+        `chunk_size` bytes. When a chunk fails transiently, the session is
+        asked how many bytes it has committed and the upload continues from
+        there, up to `max_retries` times in a row. If `verify`, compare the
+        uploaded object's CRC32C checksum to the local file's.
+        """
         # And now request the handles for bucket and the file
         bucket_name, rel_path = self.parse_uri(gsuri)
-        bucket = self.client.get_bucket(bucket_name)
-        ublob = storage.Blob(rel_path, bucket)
-        ublob.upload_from_filename(localpath)
+        bucket = self.get_bucket(bucket_name)
+        ublob = bucket.blob(rel_path, chunk_size=chunk_size)
+        description = "upload {} to {}".format(localpath, gsuri)
+        size = os.path.getsize(localpath)
+        session_url = _with_retries(
+            lambda: ublob.create_resumable_upload_session(size=size, client=self._client),
+            max_retries, description)
+        self._upload_chunks(session_url, localpath, size, chunk_size, max_retries, description)
+        if verify:
+            ublob.reload(client=self._client)
+            local_crc32c = crc32c_of_file(localpath)
+            if ublob.crc32c != local_crc32c:
+                raise GoogleStorageIOError(
+                    "Checksum mismatch after uploading {} to {}: {} != {}".format(
+                        localpath, gsuri, ublob.crc32c, local_crc32c))
+        return ublob
 
 
-    def download_to_path(self, gsuri, localpath, binary_mode=False, tmpdir=None):
+    def _upload_chunks(self, session_url, localpath, size, chunk_size, max_retries, description):
+        """
+        Send a file to a resumable upload session, chunk by chunk, with the
+        client's authorized HTTP session.
+        """
+        transport = self._client._http
+        offset = 0
+        n_failures = 0
+        with open(localpath, "rb") as f:
+            while offset is not None:
+                try:
+                    if n_failures > 0:
+                        offset = _upload_offset(transport.put(
+                            session_url, data=b"", headers={"Content-Range": "bytes */{}".format(size)}))
+                        if offset is None:
+                            break
+                    f.seek(offset)
+                    data = f.read(chunk_size)
+                    if len(data) > 0:
+                        content_range = "bytes {}-{}/{}".format(offset, offset + len(data) - 1, size)
+                    else:
+                        content_range = "bytes */{}".format(size)
+                    offset = _upload_offset(transport.put(
+                        session_url, data=data, headers={"Content-Range": content_range}))
+                    n_failures = 0
+                except GoogleStorageIOError:
+                    raise
+                except Exception as e:
+                    if not _is_transient(e):
+                        raise GoogleStorageIOError("Failed to {}: {}".format(description, e))
+                    if n_failures == max_retries:
+                        raise GoogleStorageIOError(
+                            "Failed to {} after {} attempts: {}".format(description, n_failures + 1, e))
+                    logger.warning("Failed to %s (attempt %d), resuming: %s", description, n_failures + 1, e)
+                    time.sleep(min(2 ** n_failures, 30))
+                    n_failures += 1
+
+
+    def download_range(self, blob, start, end):
+        """
+        Return bytes `start` to `end` (inclusive, as in the API) of a blob.
+        """
+        download = getattr(blob, "download_as_bytes", None) or blob.download_as_string
+        return download(client=self._client, start=start, end=end)
+
+
+    def download_to_path(self, gsuri, localpath, binary_mode=False, tmpdir=None,
+                         slice_size=DEFAULT_SLICE_SIZE, n_jobs=DEFAULT_DOWNLOAD_N_JOBS,
+                         max_retries=DEFAULT_MAX_RETRIES, verify=True):
         """
         This method is analogous to "gsutil cp gsuri localpath", but in a
-        programatically accesible way. The only difference is that we
-        have to make a guess about the encoding of the file to not upset
-        downstream file operations. If you are downloading a VCF, then
-        "False" is great. If this is a BAM file you are asking for, you
-        should enable the "binary_mode" to make sure file doesn't get
-        corrupted.
+        programatically accesible way. Bytes are copied as they are, so
+        text and binary (e.g. BAM) files are both safe.
+
+        The object is fetched in slices of `slice_size` bytes, using up to
+        `n_jobs` parallel ranged reads; transient failures of each slice are
+        retried up to `max_retries` times. Finished slices are recorded next
+        to the partial file, so an interrupted download of the same object
+        generation resumes where it left off. Concurrent downloads to the
+        same `localpath`, from threads or processes, take turns; one that
+        waited for another doesn't download again if the file it finds is
+        already verified to match.
 
         gsuri: full GS-based URI, e.g. gs://cohorts/rocks.txt
         localpath: the path for the downloaded file, e.g. /mnt/cohorts/yep.txt
-        binary_mode: (logical) if yes, the binary file operations will be
-                     used; if not, standard ascii-based ones.
+        binary_mode: unused, kept for compatibility.
+        tmpdir: where to keep the partial file; defaults to the directory
+                of localpath, so that the final rename stays on one filesystem.
+        verify: (logical) compare the CRC32C checksum of the downloaded file
+                to the object's.
         """
-        bucket_name, gs_rel_path = self.parse_uri(gsuri)
-        # And now request the handles for bucket and the file
-        bucket = self._client.get_bucket(bucket_name)
-        # Just assignment, no downloading (yet)
-        ablob = bucket.get_blob(gs_rel_path)
+        ablob = self.get_blob(gsuri)
         if not ablob:
             raise GoogleStorageIOError(
-                "No such file on Google Storage: '{}'".format(gs_rel_path))
-
-        # A tmp file to serve intermediate phase
-        # should be on same filesystem as localpath
-        tmp_fid, tmp_file_path = tempfile.mkstemp(text=(not binary_mode),
-                                                  dir=tmpdir)
-        # set chunk_size to reasonable default
-        # https://github.com/GoogleCloudPlatform/google-cloud-python/issues/2222
-        ablob.chunk_size = 1<<30
-        # Download starts in a sec....
-        ablob.download_to_filename(client=self._client, filename=tmp_file_path)
-        # ... end download ends. Let's move our finished file over.
+                "No such file on Google Storage: '{}'".format(gsuri))
 
         # You will see that below, instead of directly writing to a file
         # we are instead first using a different file and then move it to
         # its final location. We are doing this because we don't want
         # corrupted/incomplete data to be around as much as possible.
-        return os.rename(tmp_file_path, localpath)
+        tmpdir = tmpdir or os.path.dirname(os.path.abspath(localpath))
+        part_path = os.path.join(tmpdir, os.path.basename(localpath) + ".part")
+        with _exclusive_lock(part_path + ".lock") as waited:
+            if (waited and verify and getattr(ablob, "crc32c", None) and os.path.exists(localpath) and
+                    os.path.getsize(localpath) == (ablob.size or 0) and
+                    crc32c_of_file(localpath) == ablob.crc32c):
+                return localpath
+            return self._download_to_part(ablob, gsuri, localpath, part_path, slice_size, n_jobs,
+                                          max_retries, verify)
+
+
+    def _download_to_part(self, ablob, gsuri, localpath, part_path, slice_size, n_jobs,
+                          max_retries, verify):
+        state_path = part_path + ".json"
+        size = ablob.size or 0
+        state = dict(generation=ablob.generation, size=size, slice_size=slice_size, done=[])
+        if os.path.exists(part_path) and os.path.exists(state_path):
+            with open(state_path) as f:
+                saved_state = json.load(f)
+            if all(saved_state.get(key) == state[key] for key in ["generation", "size", "slice_size"]):
+                state = saved_state
+        if not state["done"] or not os.path.exists(part_path):
+            with open(part_path, "wb") as f:
+                f.truncate(size)
+        done = set(state["done"])
+        done_lock = threading.Lock()
+
+        def save_state():
+            with open(state_path + ".tmp", "w") as f:
+                json.dump(dict(state, done=sorted(done)), f)
+            os.replace(state_path + ".tmp", state_path)
+
+        def download_slice(index):
+            start = index * slice_size
+            end = min(start + slice_size, size) - 1
+            data = _with_retries(
+                lambda: self.download_range(ablob, start, end),
+                max_retries, "download bytes {}-{} of {}".format(start, end, gsuri))
+            if len(data) != end - start + 1:
+                raise GoogleStorageIOError(
+                    "Short read of bytes {}-{} of {}: got {} bytes".format(start, end, gsuri, len(data)))
+            with open(part_path, "r+b") as f:
+                f.seek(start)
+                f.write(data)
+            with done_lock:
+                done.add(index)
+                save_state()
+
+        n_slices = (size + slice_size - 1) // slice_size
+        thread_map(download_slice, [i for i in range(n_slices) if i not in done], n_jobs=n_jobs)
+
+        if verify and getattr(ablob, "crc32c", None):
+            local_crc32c = crc32c_of_file(part_path)
+            if local_crc32c != ablob.crc32c:
+                os.remove(part_path)
+                os.remove(state_path)
+                raise GoogleStorageIOError(
+                    "Checksum mismatch downloading {}: {} != {}".format(gsuri, local_crc32c, ablob.crc32c))
+        os.replace(part_path, localpath)
+        if os.path.exists(state_path):
+            os.remove(state_path)
+        return localpath
+
+
+    def download_many(self, uris_and_paths, n_jobs=4, **kwargs):
+        """
+        Download (gsuri, localpath) pairs, up to `n_jobs` files at a time.
+        Other arguments are passed to `download_to_path`.
+        """
+        return thread_map(lambda pair: self.download_to_path(pair[0], pair[1], **kwargs),
+                          uris_and_paths, n_jobs=n_jobs)
+
+
+    def upload_many(self, paths_and_uris, n_jobs=4, **kwargs):
+        """
+        Upload (localpath, gsuri) pairs, up to `n_jobs` files at a time.
+        Other arguments are passed to `upload_file`.
+        """
+        return thread_map(lambda pair: self.upload_file(pair[0], pair[1], **kwargs),
+                          paths_and_uris, n_jobs=n_jobs)
 
     def get_blob(self, gsuri):
         bucket_name, gs_rel_path = self.parse_uri(gsuri)
-        bucket = self._client.get_bucket(bucket_name)
+        bucket = self.get_bucket(bucket_name)
         ablob = bucket.get_blob(gs_rel_path)
         return ablob
 
@@ -169,9 +508,17 @@ class GoogleStorageFile(object):
         self._localfile = None
 
     def __enter__(self):
+        # Files that are only read are streamed with ranged reads, so
+        # only the parts that are read get transferred.
+        if not self.is_write:
+            from .gcloud_range import open_gs
+            self._localfile = open_gs(self.gcio, self.gsuri, self.mode)
+            self._localfile_path = None
+            return self._localfile
         # Get a temp file and use it as a local file to immitate
         # direct GS access by downloading contents onto that file.
         tmp_fid, tmp_file_path = tempfile.mkstemp(text=(not self.is_binary))
+        os.close(tmp_fid)
         self.gcio.download_to_path(self.gsuri, tmp_file_path)
         self._localfile = open(tmp_file_path, self.mode)
         self._localfile_path = tmp_file_path
@@ -180,12 +527,11 @@ class GoogleStorageFile(object):
     def __exit__(self, *args):
         # We are done with the open file, so let's close it
         self._localfile.close()
+        if self._localfile_path is None:
+            return
         # If write mode is on, then upload the altered one to GS
         if self.is_write:
-            bucket_name, rel_path = self.gcio.parse_uri(self.gsuri)
-            bucket = self.gcio.client.get_bucket(bucket_name)
-            ublob = storage.Blob(rel_path, bucket)
-            ublob.upload_from_filename(self._localfile_path)
+            self.gcio.upload_file(self._localfile_path, self.gsuri)
         # And because of the type of the temp file we created,
         # we are responsible for deleting it when we are finshed:
         os.remove(self._localfile_path)
@@ -0,0 +1,251 @@
+# Copyright (c) 2017. Mount Sinai School of Medicine
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Run isovar over an RNA BAM one genomic window at a time.
+
+Isovar fetches the reads around each variant from an indexed BAM, so variants
+can be split into windows (a contig, or a fixed-size region of one) and each
+window processed by a separate worker with its own BAM handle. Results are
+concatenated in window order, which matches the order of a single serial pass.
+
+Results are cached per set of isovar parameters (see `isovar_cache_file_name`),
+along with an index of the variants they cover (see `expressed_variant_index`).
+"""
+
+import multiprocessing
+import re
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+from varcode import VariantCollection
+
+# The parameters used for the expressed neoantigen pipeline's 8-11mers.
+DEFAULT_ISOVAR_PARAMETERS = dict(
+    protein_sequence_length=21,
+    min_variant_sequence_coverage=3,
+    max_protein_sequences_per_variant=1)
+
+_ISOVAR_CACHE_FILE_NAME = re.compile(
+    r"^(?P<merge_type>[^.]+)-isovar\.len(?P<protein_sequence_length>\d+)"
+    r"-cov(?P<min_variant_sequence_coverage>\d+)"
+    r"-max(?P<max_protein_sequences_per_variant>\d+)\.csv$")
+
+def isovar_cache_file_name(merge_type, protein_sequence_length, min_variant_sequence_coverage,
+                           max_protein_sequences_per_variant):
+    """Name of the cache entry holding isovar output for one set of parameters."""
+    return "%s-isovar.len%d-cov%d-max%d.csv" % (
+        merge_type, protein_sequence_length, min_variant_sequence_coverage,
+        max_protein_sequences_per_variant)
+
+def parse_isovar_cache_file_name(file_name):
+    """
+    Inverse of `isovar_cache_file_name`: return a dict of merge_type and the isovar
+    parameters, or None if `file_name` isn't an isovar cache entry.
+    """
+    match = _ISOVAR_CACHE_FILE_NAME.match(file_name)
+    if match is None:
+        return None
+    parsed = match.groupdict()
+    for key in DEFAULT_ISOVAR_PARAMETERS:
+        parsed[key] = int(parsed[key])
+    return parsed
+
+def trim_protein_sequences(df_isovar, protein_sequence_length):
+    """
+    Shorten isovar protein sequences to `protein_sequence_length`, keeping a window
+    centered on the variant residues as isovar does when it chooses the cDNA to
+    translate: the flanking residues are split between the two sides, with any odd
+    one before the variant. Sequences whose variant residues are longer than the
+    window keep their first `protein_sequence_length` variant residues. The variant
+    interval is shifted to match, and sequences cut short at their C-terminal end
+    no longer end with a stop codon.
+
+    This lets output computed with a longer `protein_sequence_length` serve a request
+    for a shorter one. It is an approximation of running isovar again: isovar applies
+    `min_variant_sequence_coverage` to the longer cDNA sequences, so a variant whose
+    shorter sequence would have had enough coverage may be missing, and a sequence
+    whose longer translation was limited by its reads or a stop codon on one side
+    may be trimmed differently.
+    """
+    df_isovar = df_isovar.copy()
+    lengths = df_isovar["amino_acids"].str.len().values
+    variant_starts = df_isovar["variant_aa_interval_start"].values.astype(np.int64)
+    variant_ends = df_isovar["variant_aa_interval_end"].values.astype(np.int64)
+    n_flanking = np.maximum(protein_sequence_length - (variant_ends - variant_starts), 0)
+    n_before = n_flanking - n_flanking // 2
+    window_starts = np.maximum(variant_starts - n_before, 0)
+    window_ends = np.minimum(np.minimum(window_starts + protein_sequence_length, lengths),
+                             np.maximum(variant_ends + n_flanking // 2, window_starts))
+    too_long = lengths > protein_sequence_length
+    window_starts = np.where(too_long, window_starts, 0)
+    window_ends = np.where(too_long, window_ends, lengths)
+    df_isovar["amino_acids"] = [
+        amino_acids[window_start:window_end] for (amino_acids, window_start, window_end)
+        in zip(df_isovar["amino_acids"], window_starts, window_ends)]
+    df_isovar["variant_aa_interval_start"] = variant_starts - window_starts
+    df_isovar["variant_aa_interval_end"] = np.minimum(variant_ends, window_ends) - window_starts
+    df_isovar["ends_with_stop_codon"] = df_isovar["ends_with_stop_codon"] & (window_ends == lengths)
+    # Distinct sequences can become identical once trimmed.
+    df_isovar = df_isovar.drop_duplicates(subset=["chr", "pos", "ref", "alt", "amino_acids"])
+    return df_isovar.reset_index(drop=True)
+
+def expressed_variants_file_name(isovar_file_name):
+    """Name of the cache entry holding the expressed variant index for an isovar entry."""
+    return re.sub(r"\.csv$", ".expressed.pkl", isovar_file_name)
+
+def variant_key(variant):
+    """
+    Key of a variant in an expressed variant index. Isovar reports each variant's
+    original (un-normalized) position and alleles.
+    """
+    return (variant.contig, variant.original_start, variant.original_ref, variant.original_alt)
+
+def expressed_variant_index(df_isovar):
+    """
+    Return the set of `variant_key` tuples of the variants in isovar output, i.e.
+    those with RNA support.
+    """
+    # Cached output is read back from CSV, which parses numeric contigs as integers
+    # and empty alleles as NaN.
+    return set(zip(
+        df_isovar["chr"].astype(str),
+        df_isovar["pos"].astype(int),
+        df_isovar["ref"].fillna("").astype(str),
+        df_isovar["alt"].fillna("").astype(str)))
+
+def mutant_binding_predictions(binding_predictions, df_isovar, ic50_cutoff):
+    """
+    Return the binding predictions whose peptides overlap mutant residues and whose
+    predicted IC50 is at most `ic50_cutoff`.
+
+    Each prediction's `source_sequence_key` is the row id (position) of its source
+    protein sequence in `df_isovar`. The overlap test is the same as topiary's
+    `contains_mutant_residues`, applied to all predictions at once.
+    """
+    binding_predictions = list(binding_predictions)
+    n_predictions = len(binding_predictions)
+    offsets = np.fromiter(
+        (prediction.offset for prediction in binding_predictions), dtype=np.int64, count=n_predictions)
+    lengths = np.fromiter(
+        (len(prediction.peptide) for prediction in binding_predictions), dtype=np.int64, count=n_predictions)
+    row_ids = np.fromiter(
+        (prediction.source_sequence_key for prediction in binding_predictions), dtype=np.int64,
+        count=n_predictions)
+    values = np.fromiter(
+        (prediction.value for prediction in binding_predictions), dtype=np.float64, count=n_predictions)
+    mutation_starts = df_isovar["variant_aa_interval_start"].values[row_ids]
+    mutation_ends = df_isovar["variant_aa_interval_end"].values[row_ids]
+    keep = ((offsets < mutation_ends) &
+            (offsets + lengths - 1 >= mutation_starts) &
+            (values <= ic50_cutoff))
+    return [prediction for (prediction, is_kept) in zip(binding_predictions, keep) if is_kept]
+
+def partition_variants(variants, window_size=None):
+    """
+    Split a VariantCollection into windows.
+
+    Parameters
+    ----------
+    variants : VariantCollection
+    window_size : int, optional
+        Size in bases of each window. By default, each contig is one window.
+
+    Returns
+    -------
+    OrderedDict from (contig, window index) to a VariantCollection, in the
+    order the windows' variants appear in `variants` (genomic order, for a
+    sorted collection).
+    """
+    windows = OrderedDict()
+    for variant in variants:
+        window_index = 0 if window_size is None else variant.start // window_size
+        windows.setdefault((variant.contig, window_index), []).append(variant)
+    return OrderedDict([
+        (key, VariantCollection(window_variants))
+        for (key, window_variants) in windows.items()])
+
+def protein_sequences_dataframe(variants, bam_path, protein_sequence_length,
+                                min_variant_sequence_coverage, max_protein_sequences_per_variant,
+                                min_mapping_quality=1):
+    """Run isovar over `variants` using a new handle on `bam_path`."""
+    from isovar.allele_reads import reads_overlapping_variants
+    from isovar.protein_sequences import (reads_generator_to_protein_sequences_generator,
+                                          protein_sequences_generator_to_dataframe)
+    from pysam import AlignmentFile
+    with AlignmentFile(bam_path) as rna_bam_file:
+        allele_reads_generator = reads_overlapping_variants(
+            variants=variants,
+            samfile=rna_bam_file,
+            min_mapping_quality=min_mapping_quality)
+        protein_sequences_generator = reads_generator_to_protein_sequences_generator(
+            allele_reads_generator,
+            protein_sequence_length=protein_sequence_length,
+            min_variant_sequence_coverage=min_variant_sequence_coverage,
+            max_protein_sequences_per_variant=max_protein_sequences_per_variant,
+            variant_sequence_assembly=False)
+        return protein_sequences_generator_to_dataframe(protein_sequences_generator)
+
+# Set in the parent before forking worker processes, so that windows of
+# variants are inherited rather than pickled.
+_worker_windows = None
+_worker_kwargs = None
+
+def _run_window(window_index):
+    return protein_sequences_dataframe(_worker_windows[window_index], **_worker_kwargs)
+
+def windowed_protein_sequences_dataframe(variants, bam_path, n_jobs=1, window_size=None, **kwargs):
+    """
+    Run isovar over `variants` window by window, using up to `n_jobs` worker
+    processes, and concatenate the resulting DataFrames in window order.
+
+    Parameters
+    ----------
+    variants : VariantCollection
+    bam_path : str
+        Path to an indexed RNA BAM.
+    n_jobs : int
+        Number of worker processes, each of which opens its own BAM handle.
+    window_size : int, optional
+        See `partition_variants`.
+    **kwargs
+        Passed to `protein_sequences_dataframe`.
+    """
+    global _worker_windows, _worker_kwargs
+    windows = list(partition_variants(variants, window_size=window_size).values())
+    kwargs["bam_path"] = bam_path
+    # Workers can't start their own pools (e.g. when `precompute` runs this in a
+    # worker process), so fall back to processing windows serially.
+    if n_jobs <= 1 or len(windows) <= 1 or multiprocessing.current_process().daemon:
+        dfs = [protein_sequences_dataframe(window, **kwargs) for window in windows]
+    else:
+        from pysam import AlignmentFile
+        with AlignmentFile(bam_path) as rna_bam_file:
+            if not rna_bam_file.has_index():
+                raise ValueError("Processing %s in parallel requires a BAM index" % bam_path)
+        _worker_windows = windows
+        _worker_kwargs = kwargs
+        pool = multiprocessing.get_context("fork").Pool(min(n_jobs, len(windows)))
+        try:
+            # `map` returns results in window order.
+            dfs = pool.map(_run_window, range(len(windows)))
+        finally:
+            pool.close()
+            pool.join()
+            _worker_windows = None
+            _worker_kwargs = None
+    if len(dfs) == 0:
+        return protein_sequences_dataframe(variants, **kwargs)
+    return pd.concat(dfs, ignore_index=True)
@@ -15,25 +15,69 @@
 from types import FunctionType
 import numpy as np
 import pandas as pd
-from sklearn.utils import resample
-from sklearn.metrics import roc_auc_score
-import lifelines as ll
-import patsy
 
 from .utils import get_logger
 
 logger = get_logger(__name__)
 
 def is_single_class(arr, col):
-    if type(arr) == pd.DataFrame:
-        arr_positive_indices = list(arr[arr[col] == 1][col])
-        arr_negative_indices = list(arr[arr[col] == 0][col])
-    else:
-        arr_positive_indices = (arr == 1).nonzero()[0]
-        arr_negative_indices = (arr == 0).nonzero()[0]
-    return len(arr_positive_indices) == 0 or len(arr_negative_indices) == 0
-
-def bootstrap_auc(df, col, pred_col, n_bootstrap=1000):
+    values = arr[col].values if type(arr) == pd.DataFrame else np.asarray(arr)
+    return not ((values == 1).any() and (values == 0).any())
+
+def bootstrap_auc_scores(values, labels, n_bootstrap=1000, random_state=None):
+    """
+    Calculate the AUC of `values` predicting binary `labels` in each of
+    `n_bootstrap` resamples.
+
+    All resamples are drawn at once, as an (n_bootstrap x n) matrix of indices.
+    Each AUC is then the Mann-Whitney U statistic of its resample divided by
+    (positives x negatives), computed from per-resample counts of each distinct
+    value, so ties count as half (as in `sklearn.metrics.roc_auc_score`).
+
+    Parameters
+    ----------
+    values : array-like
+    labels : array-like
+        1 for positives and 0 for negatives.
+    n_bootstrap : int
+        the number of bootstrap samples
+    random_state : int or numpy.random.RandomState, optional
+        Seed or generator for the resampling, for reproducible scores.
+
+    Returns
+    -------
+    numpy.ndarray : AUCs for each sampling, with 0 for resamples that contain
+    only one class
+    """
+    values = np.asarray(values)
+    labels = np.asarray(labels).astype(int)
+    n = len(values)
+    if n == 0:
+        return np.zeros(n_bootstrap)
+    from sklearn.utils import check_random_state
+    random_state = check_random_state(random_state)
+    sample_indices = random_state.randint(n, size=(n_bootstrap, n))
+
+    # Group equal values, in ascending order, and count each group's positives
+    # and negatives in every resample.
+    _, groups = np.unique(values, return_inverse=True)
+    n_groups = groups.max() + 1
+    cells = (groups * 2 + labels)[sample_indices]
+    cells += (np.arange(n_bootstrap) * n_groups * 2)[:, np.newaxis]
+    counts = np.bincount(cells.ravel(), minlength=n_bootstrap * n_groups * 2).reshape(
+        n_bootstrap, n_groups, 2)
+    negatives = counts[:, :, 0]
+    positives = counts[:, :, 1]
+
+    # Each positive beats the negatives with lower values, and ties those with equal values.
+    negatives_below = np.cumsum(negatives, axis=1) - negatives
+    u = (positives * (negatives_below + 0.5 * negatives)).sum(axis=1)
+    n_pairs = positives.sum(axis=1) * negatives.sum(axis=1)
+    scores = np.zeros(n_bootstrap)
+    np.divide(u, n_pairs, out=scores, where=n_pairs > 0)
+    return scores
+
+def bootstrap_auc(df, col, pred_col, n_bootstrap=1000, random_state=None):
     """
     Calculate the boostrapped AUC for a given col trying to predict a pred_col.
 
@@ -46,36 +90,40 @@ def bootstrap_auc(df, col, pred_col, n_bootstrap=1000):
         the column we're trying to predict
     n_boostrap : int
         the number of bootstrap samples
+    random_state : int or numpy.random.RandomState, optional
+        Seed or generator for the resampling, for reproducible scores.
 
     Returns
     -------
-    list : AUCs for each sampling
+    numpy.ndarray : AUCs for each sampling (see `bootstrap_auc_scores`)
     """
-    scores = np.zeros(n_bootstrap)
     old_len = len(df)
     df.dropna(subset=[col], inplace=True)
     new_len = len(df)
     if new_len < old_len:
         logger.info("Dropping NaN values in %s to go from %d to %d rows" % (col, old_len, new_len))
-    preds = df[pred_col].astype(int)
-    for i in range(n_bootstrap):
-        sampled_counts, sampled_pred = resample(df[col], preds)
-        if is_single_class(sampled_pred, col=pred_col):
-            continue
-        scores[i] = roc_auc_score(sampled_pred, sampled_counts)
-    return scores
+    return bootstrap_auc_scores(
+        values=df[col].values,
+        labels=df[pred_col].astype(int).values,
+        n_bootstrap=n_bootstrap,
+        random_state=random_state)
 
-def cohort_bootstrap_auc(cohort, on, pred_col="is_benefit", n_bootstrap=1000, **kwargs):
+def cohort_bootstrap_auc(cohort, on, pred_col="is_benefit", n_bootstrap=1000, random_state=None,
+                         **kwargs):
     col, df = cohort.as_dataframe(on, return_cols=True, **kwargs)
     return bootstrap_auc(df=df,
                          col=col,
                          pred_col=pred_col,
-                         n_bootstrap=n_bootstrap)
+                         n_bootstrap=n_bootstrap,
+                         random_state=random_state)
 
-def cohort_mean_bootstrap_auc(cohort, on, pred_col="is_benefit", n_bootstrap=1000, **kwargs):
-    return cohort_bootstrap_auc(cohort, on, pred_col, n_bootstrap, **kwargs).mean()
+def cohort_mean_bootstrap_auc(cohort, on, pred_col="is_benefit", n_bootstrap=1000, random_state=None,
+                              **kwargs):
+    return cohort_bootstrap_auc(cohort, on, pred_col, n_bootstrap, random_state, **kwargs).mean()
 
 def coxph_model(formula, data, time_col, event_col, **kwargs):
+    import lifelines as ll
+    import patsy
     # pylint: disable=no-member
     # pylint gets confused by dmatrix
     sdata = patsy.dmatrix(
@@ -0,0 +1,196 @@
+# Copyright (c) 2017. Mount Sinai School of Medicine
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Permutation tests for small cohorts, where asymptotic p-values are unreliable.
+
+Group labels are permuted in batches: each batch is a (permutations x patients)
+matrix of labels, and the test statistic is computed for all of its rows at once
+from quantities that don't depend on the labels (event times sorted once for the
+logrank test, and ranks computed once for the Mann-Whitney test).
+"""
+
+from collections import namedtuple
+
+import numpy as np
+
+class PermutationTestResults(namedtuple("PermutationTestResults", ["statistic", "p_value", "n_permutations"])):
+    def __str__(self):
+        return "PermutationTestResults(statistic=%s, p_value=%s, n_permutations=%d)" % (
+            self.statistic, self.p_value, self.n_permutations)
+
+    def __repr__(self):
+        return self.__str__()
+
+def permuted_labels(labels, n_permutations, random_state):
+    """Return an (n_permutations x n) matrix, each row a random permutation of `labels`."""
+    labels = np.asarray(labels)
+    orders = np.argsort(random_state.rand(n_permutations, len(labels)), axis=1)
+    return labels[orders]
+
+def _permutation_p_value(statistic, labels, n_permutations, random_state, batch_size, permuted_statistics):
+    """
+    Compare `statistic` to those of `n_permutations` permutations of `labels`,
+    computed in batches of `batch_size` by `permuted_statistics`.
+
+    The p-value counts the observed labeling as one of the permutations, so it is
+    never 0.
+    """
+    from sklearn.utils import check_random_state
+    random_state = check_random_state(random_state)
+    n_at_least = 0
+    for start in range(0, n_permutations, batch_size):
+        batch = permuted_labels(labels, min(batch_size, n_permutations - start), random_state)
+        # Allow for floating point error in statistics equal to the observed one.
+        n_at_least += (permuted_statistics(batch) >= statistic - 1e-9 * abs(statistic)).sum()
+    return PermutationTestResults(
+        statistic=statistic,
+        p_value=(n_at_least + 1.0) / (n_permutations + 1.0),
+        n_permutations=n_permutations)
+
+class LogrankStatistic(object):
+    """
+    The two-group logrank chi-squared statistic, for any number of group labelings
+    of the same survival data.
+
+    Parameters
+    ----------
+    durations : array-like
+    events : array-like
+        True where the event was observed, False if censored.
+    """
+    def __init__(self, durations, events):
+        durations = np.asarray(durations, dtype=np.float64)
+        events = np.asarray(events).astype(bool)
+        self.order = np.argsort(durations, kind="mergesort")
+        sorted_durations = durations[self.order]
+        self.sorted_events = events[self.order]
+        # Patients sharing a duration are contiguous once sorted; `starts` indexes
+        # the first patient of each distinct duration.
+        (_, self.starts) = np.unique(sorted_durations, return_index=True)
+        n = len(durations)
+        self.at_risk = (n - self.starts).astype(np.float64)
+        self.deaths = np.add.reduceat(self.sorted_events.astype(np.float64), self.starts) \
+            if n > 0 else np.zeros(0)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            # Hypergeometric variance factor, d * (n - d) / (n - 1), per distinct duration.
+            self.variance_factor = np.where(
+                self.at_risk > 1,
+                self.deaths * (self.at_risk - self.deaths) / (self.at_risk - 1),
+                0.0)
+
+    def __call__(self, groups):
+        """
+        Parameters
+        ----------
+        groups : array-like
+            A boolean vector of group membership, or a (labelings x patients) matrix of them.
+
+        Returns
+        -------
+        The statistic, or a vector of statistics for a matrix of labelings.
+        """
+        groups = np.asarray(groups).astype(np.float64)
+        is_vector = groups.ndim == 1
+        groups = np.atleast_2d(groups)[:, self.order]
+        if groups.shape[1] == 0:
+            statistics = np.zeros(groups.shape[0])
+            return statistics[0] if is_vector else statistics
+        # Group sizes at each distinct duration, and then those still at risk.
+        group_counts = np.add.reduceat(groups, self.starts, axis=1)
+        group_at_risk = np.cumsum(group_counts[:, ::-1], axis=1)[:, ::-1]
+        group_deaths = np.add.reduceat(groups * self.sorted_events, self.starts, axis=1)
+        fraction = group_at_risk / self.at_risk
+        observed_minus_expected = (group_deaths - self.deaths * fraction).sum(axis=1)
+        variance = (self.variance_factor * fraction * (1 - fraction)).sum(axis=1)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            statistics = np.where(variance > 0, observed_minus_expected ** 2 / variance, 0.0)
+        return statistics[0] if is_vector else statistics
+
+def logrank_permutation_test(durations, events, groups, n_permutations=10000, random_state=None,
+                             batch_size=1000):
+    """
+    Permutation test of whether two groups differ in survival, using the logrank statistic.
+    Patients with a missing duration or event are left out, as lifelines does.
+
+    Parameters
+    ----------
+    durations : array-like
+    events : array-like
+        True where the event was observed, False if censored.
+    groups : array-like
+        True for patients in one group, False for the other.
+    n_permutations : int
+    random_state : int or numpy.random.RandomState, optional
+        Seed or generator for the permutations, for reproducible p-values.
+    batch_size : int
+        Number of permutations evaluated at once.
+
+    Returns
+    -------
+    PermutationTestResults
+    """
+    durations = np.asarray(durations, dtype=np.float64)
+    events = np.asarray(events).astype(np.float64)
+    known = np.isfinite(durations) & np.isfinite(events)
+    statistic_fn = LogrankStatistic(durations[known], events[known])
+    groups = np.asarray(groups).astype(bool)[known]
+    return _permutation_p_value(
+        statistic_fn(groups), groups, n_permutations, random_state, batch_size, statistic_fn)
+
+def mann_whitney_permutation_test(values, groups, n_permutations=10000, alternative="two-sided",
+                                  random_state=None, batch_size=1000):
+    """
+    Permutation test of whether `values` differ between two groups, using the
+    Mann-Whitney U statistic of the first group.
+
+    Parameters
+    ----------
+    values : array-like
+    groups : array-like
+        True for patients in the first group, False for the second.
+    n_permutations : int
+    alternative : {"two-sided", "less", "greater"}
+        Whether the first group's values are less or greater than the second's,
+        as in `scipy.stats.mannwhitneyu`.
+    random_state : int or numpy.random.RandomState, optional
+        Seed or generator for the permutations, for reproducible p-values.
+    batch_size : int
+        Number of permutations evaluated at once.
+
+    Returns
+    -------
+    PermutationTestResults, with the first group's U as the statistic
+    """
+    if alternative not in ["two-sided", "less", "greater"]:
+        raise ValueError("Invalid alternative %s" % alternative)
+    from scipy.stats import rankdata
+    ranks = rankdata(values)
+    groups = np.asarray(groups).astype(bool)
+    n_first = groups.sum()
+    expected = n_first * (len(groups) - n_first) / 2.0
+
+    def u(groups):
+        return groups.astype(np.float64).dot(ranks) - n_first * (n_first + 1) / 2.0
+
+    # Orient the statistic so that larger values are more extreme.
+    if alternative == "two-sided":
+        extremity = lambda groups: np.abs(u(groups) - expected)
+    elif alternative == "greater":
+        extremity = u
+    else:
+        extremity = lambda groups: -u(groups)
+    results = _permutation_p_value(
+        extremity(groups), groups, n_permutations, random_state, batch_size, extremity)
+    return results._replace(statistic=u(groups))
@@ -14,12 +14,9 @@
 
 from collections import namedtuple
 
-from scipy.stats import mannwhitneyu, fisher_exact
-import seaborn as sb
 import pandas as pd
-import matplotlib.pyplot as plt
-from sklearn.metrics import roc_curve
 from .model import bootstrap_auc
+from .permutation import mann_whitney_permutation_test
 
 def vertical_percent(plot, percent=0.1):
     """
@@ -73,6 +70,7 @@ def stripboxplot(x, y, data, ax=None, significant=None, **kwargs):
     """
     Overlay a stripplot on top of a boxplot.
     """
+    import seaborn as sb
     ax = sb.boxplot(
         x=x,
         y=y,
@@ -129,7 +127,9 @@ class FishersExactResults(namedtuple("FishersExactResults", ["oddsratio", "p_val
 
 def fishers_exact_plot(data, condition1, condition2, ax=None,
                        condition1_value=None,
-                       alternative="two-sided", **kwargs):
+                       alternative="two-sided",
+                       skip_plot=False,
+                       **kwargs):
     """
     Perform a Fisher's exact test to compare to binary columns
 
@@ -153,22 +153,29 @@ def fishers_exact_plot(data, condition1, condition2, ax=None,
     alternative:
         Specify the sidedness of the test: "two-sided", "less"
         or "greater"
-    """
-    plot = sb.barplot(
-        x=condition1,
-        y=condition2,
-        ax=ax,
-        data=data,
-        **kwargs
-    )
 
-    plot.set_ylabel("Percent %s" % condition2)
+    skip_plot:
+        Calculate the odds ratio and p-value, but don't plot.
+    """
+    from scipy.stats import fisher_exact
     condition1_mask = get_condition_mask(data, condition1, condition1_value)
     count_table = pd.crosstab(data[condition1], data[condition2])
     print(count_table)
     oddsratio, p_value = fisher_exact(count_table, alternative=alternative)
-    add_significance_indicator(plot=plot, significant=p_value <= 0.05)
-    only_percentage_ticks(plot)
+
+    plot = None
+    if not skip_plot:
+        import seaborn as sb
+        plot = sb.barplot(
+            x=condition1,
+            y=condition2,
+            ax=ax,
+            data=data,
+            **kwargs
+        )
+        plot.set_ylabel("Percent %s" % condition2)
+        add_significance_indicator(plot=plot, significant=p_value <= 0.05)
+        only_percentage_ticks(plot)
 
     if alternative != "two-sided":
         raise ValueError("We need to better understand the one-sided Fisher's Exact test")
@@ -182,6 +189,9 @@ def fishers_exact_plot(data, condition1, condition2, ax=None,
                                plot=plot)
 
 class MannWhitneyResults(namedtuple("MannWhitneyResults", ["U", "p_value", "sided_str", "with_condition_series", "without_condition_series", "plot"])):
+    # `PermutationTestResults`, if a permutation test was requested.
+    permutation = None
+
     def __str__(self):
         return "MannWhitneyResults(U=%s, p_value=%s, sided_str='%s')" % (
             self.U, self.p_value, self.sided_str)
@@ -196,6 +206,8 @@ def mann_whitney_plot(data,
                       condition_value=None,
                       alternative="two-sided",
                       skip_plot=False,
+                      n_permutations=None,
+                      random_state=None,
                       **kwargs):
     """
     Create a box plot comparing a condition and perform a
@@ -224,7 +236,15 @@ def mann_whitney_plot(data,
 
     skip_plot:
         Calculate the test statistic and p-value, but don't plot.
+
+    n_permutations:
+        If given, also run a permutation test with this many permutations,
+        available as the `permutation` attribute of the results.
+
+    random_state:
+        Seed for the permutation test.
     """
+    from scipy.stats import mannwhitneyu
     condition_mask = get_condition_mask(data, condition, condition_value)
     U, p_value = mannwhitneyu(
         data[condition_mask][distribution],
@@ -245,12 +265,22 @@ def mann_whitney_plot(data,
 
     sided_str = sided_str_from_alternative(alternative, condition)
     print("Mann-Whitney test: U={}, p-value={} ({})".format(U, p_value, sided_str))
-    return MannWhitneyResults(U=U,
-                              p_value=p_value,
-                              sided_str=sided_str,
-                              with_condition_series=data[condition_mask][distribution],
-                              without_condition_series=data[~condition_mask][distribution],
-                              plot=plot)
+    results = MannWhitneyResults(U=U,
+                                 p_value=p_value,
+                                 sided_str=sided_str,
+                                 with_condition_series=data[condition_mask][distribution],
+                                 without_condition_series=data[~condition_mask][distribution],
+                                 plot=plot)
+    if n_permutations:
+        results.permutation = mann_whitney_permutation_test(
+            values=data[distribution],
+            groups=condition_mask,
+            n_permutations=n_permutations,
+            alternative=alternative,
+            random_state=random_state)
+        print("Mann-Whitney permutation test: p-value={} ({} permutations)".format(
+            results.permutation.p_value, n_permutations))
+    return results
 
 class CorrelationResults(namedtuple("CorrelationResults", ["coeff", "p_value", "stat_func", "series_x", "series_y", "plot"])):
     def __str__(self):
@@ -260,7 +290,7 @@ class CorrelationResults(namedtuple("CorrelationResults", ["coeff", "p_value", "
     def __repr__(self):
         return self.__str__()
 
-def roc_curve_plot(data, value_column, outcome_column, bootstrap_samples=100, ax=None):
+def roc_curve_plot(data, value_column, outcome_column, bootstrap_samples=100, ax=None, skip_plot=False):
     """Create a ROC curve and compute the bootstrap AUC for the given variable and outcome
 
     Parameters
@@ -275,11 +305,13 @@ def roc_curve_plot(data, value_column, outcome_column, bootstrap_samples=100, ax
         Number of bootstrap samples to use to compute the AUC
     ax : Axes, default None
         Axes to plot on
+    skip_plot : bool, optional
+        Compute the AUC, but don't plot
 
     Returns
     -------
     (mean_bootstrap_auc, roc_plot) : (float, matplotlib plot)
-        Mean AUC for the given number of bootstrap samples and the plot
+        Mean AUC for the given number of bootstrap samples and the plot (None if skip_plot)
     """
     scores = bootstrap_auc(df=data,
                            col=value_column,
@@ -288,12 +320,16 @@ def roc_curve_plot(data, value_column, outcome_column, bootstrap_samples=100, ax
     mean_bootstrap_auc = scores.mean()
     print("{}, Bootstrap (samples = {}) AUC:{}, std={}".format(
         value_column, bootstrap_samples, mean_bootstrap_auc, scores.std()))
+    if skip_plot:
+        return (mean_bootstrap_auc, None)
 
+    from sklearn.metrics import roc_curve
     outcome = data[outcome_column].astype(int)
     values = data[value_column]
     fpr, tpr, thresholds = roc_curve(outcome, values)
 
     if ax is None:
+        import matplotlib.pyplot as plt
         ax = plt.gca()
 
     roc_plot = ax.plot(fpr, tpr, lw=1, label=value_column)
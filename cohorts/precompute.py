@@ -0,0 +1,251 @@
+# Copyright (c) 2017. Mount Sinai School of Medicine
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Build a Cohort's caches ahead of time, e.g. as a nightly batch job.
+
+Each stage builds one kind of cache entry for one patient at a time. Entries
+that already exist (and whose input files haven't changed) are skipped, so an
+interrupted run can simply be restarted, and adding patients to a cohort only
+computes what is new.
+"""
+
+from __future__ import print_function
+
+import logging
+import multiprocessing
+import time
+import traceback
+from collections import namedtuple, OrderedDict
+
+import pandas as pd
+
+from .utils import get_logger
+
+logger = get_logger(__name__, level=logging.INFO)
+
+class PrecomputeStage(namedtuple("PrecomputeStage", ["name", "cache", "depends_on"])):
+    """
+    A unit of cache precomputation.
+
+    `cache` is the key of `Cohort.cache_names` whose entries this stage builds,
+    and `depends_on` lists the stages that must complete (for a given patient)
+    before this one runs.
+    """
+    def file_name(self, cohort):
+        return cohort.cache_file_name(self.cache)
+
+    def is_applicable(self, cohort, patient):
+        """Whether this stage can produce anything for `patient`."""
+        if self.name == "polyphen":
+            return cohort.polyphen_dump_path is not None
+        if self.name in ["neoantigens", "expressed_neoantigens"]:
+            if patient.hla_alleles is None:
+                return False
+        if self.name in ["isovar", "expressed_neoantigens"]:
+            return (patient.tumor_sample is not None and
+                    patient.tumor_sample.bam_path_rna is not None)
+        return True
+
+    def compute(self, cohort, patient):
+        if self.name == "variants":
+            cohort._load_single_patient_variants(patient, filter_fn=None)
+        elif self.name in ["effects", "nonsynonymous_effects"]:
+            # Both effect caches are written together.
+            cohort._load_single_patient_effects(
+                patient, only_nonsynonymous=False, all_effects=True, filter_fn=None)
+        elif self.name == "polyphen":
+            cohort._load_single_patient_polyphen(patient, filter_fn=None)
+        elif self.name == "isovar":
+            variants = cohort._load_single_patient_variants(patient, filter_fn=None)
+            if variants is not None:
+                cohort.load_single_patient_isovar(
+                    patient=patient, variants=variants, epitope_lengths=[8, 9, 10, 11])
+        elif self.name in ["neoantigens", "expressed_neoantigens"]:
+            cohort.load_neoantigens(
+                patients=[patient],
+                only_expressed=(self.name == "expressed_neoantigens"))
+        else:
+            raise ValueError("Unknown precompute stage %s" % self.name)
+
+STAGES = OrderedDict([(stage.name, stage) for stage in [
+    PrecomputeStage("variants", "variant", []),
+    PrecomputeStage("effects", "effect", ["variants"]),
+    PrecomputeStage("nonsynonymous_effects", "nonsynonymous_effect", ["effects"]),
+    PrecomputeStage("polyphen", "polyphen", ["variants"]),
+    PrecomputeStage("isovar", "isovar", ["variants"]),
+    PrecomputeStage("neoantigens", "neoantigen", ["variants"]),
+    PrecomputeStage("expressed_neoantigens", "expressed_neoantigen", ["isovar"]),
+]])
+
+DEFAULT_STAGES = ["variants", "effects", "nonsynonymous_effects", "polyphen", "isovar", "neoantigens"]
+
+def schedule_stages(stage_names):
+    """
+    Group the requested stages, plus any stages they depend on, into levels:
+    every stage in a level only depends on stages in earlier levels, so all
+    of a level's (stage, patient) tasks can run concurrently.
+    """
+    unknown = [name for name in stage_names if name not in STAGES]
+    if len(unknown) > 0:
+        raise ValueError("Unknown precompute stage(s) %s; expected some of %s" % (
+            unknown, list(STAGES.keys())))
+    required = set()
+    def require(name):
+        if name not in required:
+            required.add(name)
+            for dependency in STAGES[name].depends_on:
+                require(dependency)
+    for name in stage_names:
+        require(name)
+
+    levels = []
+    done = set()
+    while len(done) < len(required):
+        level = [name for name in STAGES
+                 if name in required and name not in done and
+                 all(dependency in done for dependency in STAGES[name].depends_on)]
+        levels.append(level)
+        done.update(level)
+    return levels
+
+def cache_diff(cohort, stages=None, patients=None):
+    """
+    List the cache entries that `precompute` would build.
+
+    Parameters
+    ----------
+    cohort : Cohort
+    stages : list, optional
+        Names of stages to check, from `STAGES`, including the stages they
+        depend on. Defaults to `DEFAULT_STAGES`.
+    patients : list, optional
+        Only check these patients.
+
+    Returns
+    -------
+    DataFrame with columns patient_id, stage and status, where status is
+    "missing" or "stale" (its input files changed since it was cached).
+    """
+    stages = DEFAULT_STAGES if stages is None else stages
+    rows = []
+    for level in schedule_stages(stages):
+        for stage_name in level:
+            stage = STAGES[stage_name]
+            for patient in cohort.iter_patients(patients):
+                if not stage.is_applicable(cohort, patient):
+                    continue
+                status = cohort.cache_entry_status(stage.cache, patient, stage.file_name(cohort))
+                if status != "ok":
+                    rows.append(dict(patient_id=patient.id, stage=stage_name, status=status))
+    return pd.DataFrame.from_records(rows, columns=["patient_id", "stage", "status"])
+
+# Set in the parent before forking worker processes, so that the Cohort
+# (which may hold unpicklable filter functions) never has to be pickled.
+_worker_cohort = None
+
+def _run_task(task):
+    stage_name, patient_id = task
+    cohort = _worker_cohort
+    start = time.time()
+    try:
+        STAGES[stage_name].compute(cohort, cohort.patient_from_id(patient_id))
+        error = None
+    except Exception:
+        error = traceback.format_exc()
+    return stage_name, patient_id, time.time() - start, error
+
+def precompute(cohort, stages=None, n_jobs=1, patients=None):
+    """
+    Build every missing or stale cache entry for the given stages.
+
+    Parameters
+    ----------
+    cohort : Cohort
+    stages : list, optional
+        Names of stages to run, from `STAGES`. Stages they depend on are run too.
+        Defaults to `DEFAULT_STAGES`.
+    n_jobs : int
+        Number of worker processes.
+    patients : list, optional
+        Only precompute for these patients.
+
+    Returns
+    -------
+    DataFrame with one row per stage: patients computed, skipped (already cached
+    or not applicable), failed, wall-clock seconds and patients per hour.
+    """
+    global _worker_cohort
+    if not cohort.cache_results:
+        raise ValueError("Cannot precompute caches for a Cohort with cache_results=False")
+    stages = DEFAULT_STAGES if stages is None else stages
+    patients = list(cohort.iter_patients(patients))
+    if cohort.polyphen_dump_path is None and "polyphen" in stages:
+        logger.warning("No polyphen_dump_path; skipping the polyphen stage")
+
+    stats = OrderedDict()
+    failed = set()
+    pool = None
+    _worker_cohort = cohort
+    try:
+        if n_jobs > 1:
+            pool = multiprocessing.get_context("fork").Pool(n_jobs)
+        for level in schedule_stages(stages):
+            tasks = []
+            level_start = time.time()
+            for stage_name in level:
+                stage = STAGES[stage_name]
+                stats[stage_name] = dict(stage=stage_name, computed=0, skipped=0, failed=0,
+                                         seconds=0.0, start=level_start, end=level_start)
+                for patient in patients:
+                    if any((dependency, patient.id) in failed for dependency in stage.depends_on):
+                        failed.add((stage_name, patient.id))
+                        stats[stage_name]["failed"] += 1
+                    elif (not stage.is_applicable(cohort, patient) or
+                          cohort.cache_entry_status(stage.cache, patient, stage.file_name(cohort)) == "ok"):
+                        stats[stage_name]["skipped"] += 1
+                    else:
+                        tasks.append((stage_name, patient.id))
+            results = pool.imap_unordered(_run_task, tasks) if pool else map(_run_task, tasks)
+            for stage_name, patient_id, seconds, error in results:
+                stage_stats = stats[stage_name]
+                stage_stats["seconds"] += seconds
+                stage_stats["end"] = time.time()
+                if error is None:
+                    stage_stats["computed"] += 1
+                else:
+                    logger.error("Stage %s failed for patient %s:\n%s" % (stage_name, patient_id, error))
+                    failed.add((stage_name, patient_id))
+                    stage_stats["failed"] += 1
+            for stage_name in level:
+                stage_stats = stats[stage_name]
+                print("%s: computed %d, skipped %d, failed %d in %.1fs" % (
+                    stage_name, stage_stats["computed"], stage_stats["skipped"],
+                    stage_stats["failed"], stage_stats["end"] - stage_stats["start"]))
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+        _worker_cohort = None
+
+    rows = []
+    for stage_stats in stats.values():
+        wall_seconds = stage_stats.pop("end") - stage_stats.pop("start")
+        stage_stats["wall_seconds"] = wall_seconds
+        stage_stats["patients_per_hour"] = (
+            3600.0 * stage_stats["computed"] / wall_seconds if wall_seconds > 0 else float("nan"))
+        rows.append(stage_stats)
+    return pd.DataFrame.from_records(
+        rows, columns=["stage", "computed", "skipped", "failed", "seconds",
+                       "wall_seconds", "patients_per_hour"])
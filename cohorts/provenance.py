@@ -19,6 +19,18 @@ def _provenance_str(provenance):
     """
     return ["%s==%s" % (key, value) for (key, value) in provenance]
 
+def provenance_diff(this_provenance, other_provenance):
+    """Two-way diff of provenance dicts: are any modules introduced, and are any modules lost?
+
+    Returns
+    -----------
+    (items in this_provenance but not other_provenance, items in other_provenance but not this_provenance)
+    """
+    this_items = set(this_provenance.items())
+    other_items = set(other_provenance.items())
+    return (this_items.difference(other_items),
+            other_items.difference(this_items))
+
 def compare_provenance(
         this_provenance, other_provenance,
         left_outer_diff = "In current but not comparison",
@@ -43,12 +55,7 @@ def compare_provenance(
     if (not this_provenance or not other_provenance):
         return 0
 
-    this_items = set(this_provenance.items())
-    other_items = set(other_provenance.items())
-
-    # Two-way diff: are any modules introduced, and are any modules lost?
-    new_diff = this_items.difference(other_items)
-    old_diff = other_items.difference(this_items)
+    new_diff, old_diff = provenance_diff(this_provenance, other_provenance)
     warn_str = ""
     if len(new_diff) > 0:
         warn_str += "%s: %s" % (
@@ -24,7 +24,8 @@ from . import Cohort, Patient
 def random_cohort(size, cache_dir, data_dir=None,
                   min_random_variants=None,
                   max_random_variants=None,
-                  seed_val=1234):
+                  seed_val=1234,
+                  **kwargs):
     """
     Parameters
     ----------
@@ -32,6 +33,8 @@ def random_cohort(size, cache_dir, data_dir=None,
         Minimum number of random variants to be generated per patient.
     max_random_variants: optional, int
         Maximum number of random variants to be generated per patient.
+    kwargs: optional
+        Passed to `Cohort`, e.g. show_progress=False.
     """
     seed(seed_val)
     d = {}
@@ -66,13 +69,14 @@ def random_cohort(size, cache_dir, data_dir=None,
             deceased=row["deceased"],
             progressed_or_deceased=row["progressed_or_deceased"],
             hla_alleles=["HLA-A02:01"],
-            variants={"snv": snv_vcf_paths},
+            variants=snv_vcf_paths if snv_vcf_paths is not None else [],
             additional_data=row)
         patients.append(patient)
     return Cohort(
         patients=patients,
         cache_dir=cache_dir,
-        mhc_class=RandomBindingPredictor)
+        mhc_class=RandomBindingPredictor,
+        **kwargs)
 
 def generate_random_missense_variants(num_variants=10, max_search=100000, reference="GRCh37"):
     """
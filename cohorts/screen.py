@@ -0,0 +1,279 @@
+# Copyright (c) 2017. Mount Sinai School of Medicine
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Screen many candidate biomarkers against clinical outcomes at once.
+
+Every (feature, outcome, test) combination is evaluated on one cohort DataFrame,
+optionally across worker processes, and the results are returned as a single
+table with multiple-testing corrected p-values. Nothing is plotted.
+"""
+
+import multiprocessing
+
+import numpy as np
+import pandas as pd
+
+from .model import bootstrap_auc_scores
+from .utils import get_logger
+
+logger = get_logger(__name__)
+
+# The survival time and event columns of each survival outcome.
+SURVIVAL_OUTCOMES = {
+    "os": ("os", "deceased"),
+    "pfs": ("pfs", "progressed_or_deceased"),
+}
+
+# The tests that apply to each kind of outcome.
+BENEFIT_TESTS = ["auc", "mann_whitney"]
+SURVIVAL_TESTS = ["logrank", "coxph"]
+
+SCREEN_COLUMNS = ["feature", "outcome", "test", "n", "statistic", "effect",
+                  "ci_low", "ci_high", "p_value", "q_value"]
+
+def adjust_p_values(p_values, method="fdr_bh"):
+    """
+    Correct p-values for multiple testing.
+
+    Parameters
+    ----------
+    p_values : array-like
+        NaN p-values are left as NaN, and don't count as tests.
+    method : {"fdr_bh", "bonferroni", None}
+        Benjamini-Hochberg false discovery rate, Bonferroni, or no correction.
+
+    Returns
+    -------
+    numpy.ndarray of adjusted p-values
+    """
+    p_values = np.asarray(p_values, dtype=np.float64)
+    adjusted = np.full(len(p_values), np.nan)
+    tested = ~np.isnan(p_values)
+    n_tests = tested.sum()
+    if method is None:
+        return p_values.copy()
+    if n_tests == 0:
+        return adjusted
+    if method == "bonferroni":
+        adjusted[tested] = np.minimum(p_values[tested] * n_tests, 1.0)
+    elif method == "fdr_bh":
+        tested_p_values = p_values[tested]
+        order = np.argsort(tested_p_values)
+        ranked = tested_p_values[order] * n_tests / np.arange(1, n_tests + 1)
+        # Each q-value is the smallest ranked value at or above its rank.
+        ranked = np.minimum.accumulate(ranked[::-1])[::-1]
+        q_values = np.empty(n_tests)
+        q_values[order] = np.minimum(ranked, 1.0)
+        adjusted[tested] = q_values
+    else:
+        raise ValueError("Unknown multiple testing correction: %s" % method)
+    return adjusted
+
+def _is_numeric(series):
+    return series.dtype != "bool" and np.issubdtype(series.dtype, np.number)
+
+def _two_groups(series):
+    """Split a feature into two groups: as-is if boolean, else above/below its median."""
+    if _is_numeric(series):
+        return series > series.median()
+    return series.astype(bool)
+
+def _result(n, statistic=np.nan, effect=np.nan, ci_low=np.nan, ci_high=np.nan, p_value=np.nan):
+    return dict(n=n, statistic=statistic, effect=effect, ci_low=ci_low, ci_high=ci_high,
+                p_value=p_value)
+
+def _auc_test(df, feature, n_bootstrap, random_state, ci):
+    from scipy.stats import mannwhitneyu
+    labels = df["benefit"].astype(int).values
+    values = df[feature].astype(float).values
+    if len(set(labels)) < 2:
+        return _result(len(df))
+    scores = bootstrap_auc_scores(values, labels, n_bootstrap=n_bootstrap, random_state=random_state)
+    U, _ = mannwhitneyu(values[labels == 1], values[labels == 0], alternative="two-sided")
+    alpha = (1 - ci) / 2
+    # No p-value: it would be the Mann-Whitney test's, counted twice when correcting.
+    return _result(len(df), statistic=U,
+                   effect=U / float((labels == 1).sum() * (labels == 0).sum()),
+                   ci_low=np.percentile(scores, 100 * alpha),
+                   ci_high=np.percentile(scores, 100 * (1 - alpha)))
+
+def _mann_whitney_test(df, feature):
+    from scipy.stats import mannwhitneyu
+    condition = df["benefit"].astype(bool)
+    values = df[feature].astype(float)
+    if condition.all() or not condition.any():
+        return _result(len(df))
+    with_condition = values[condition]
+    without_condition = values[~condition]
+    U, p_value = mannwhitneyu(with_condition, without_condition, alternative="two-sided")
+    return _result(len(df), statistic=U, effect=with_condition.median() - without_condition.median(),
+                   p_value=p_value)
+
+def _logrank_test(df, feature, survival_col, event_col):
+    from lifelines.statistics import logrank_test
+    condition = _two_groups(df[feature])
+    if condition.all() or not condition.any():
+        return _result(len(df))
+    events = df[event_col].astype(bool)
+    results = logrank_test(df[survival_col][~condition], df[survival_col][condition],
+                           event_observed_A=events[~condition],
+                           event_observed_B=events[condition])
+    return _result(len(df), statistic=results.test_statistic, p_value=results.p_value)
+
+def _coxph_test(df, feature, survival_col, event_col, ci):
+    from lifelines import CoxPHFitter
+    from scipy.stats import norm
+    data = pd.DataFrame({
+        feature: df[feature].astype(float),
+        survival_col: df[survival_col],
+        event_col: df[event_col].astype(bool)})
+    if data[feature].nunique() < 2:
+        return _result(len(df))
+    try:
+        summary = CoxPHFitter().fit(data, survival_col, event_col=event_col).summary.iloc[0]
+    except Exception as e:
+        logger.warning("Cox PH fit of %s on %s failed: %s" % (feature, survival_col, e))
+        return _result(len(df))
+    z = norm.ppf((1 + ci) / 2)
+    return _result(len(df), statistic=summary["z"], effect=np.exp(summary["coef"]),
+                   ci_low=np.exp(summary["coef"] - z * summary["se(coef)"]),
+                   ci_high=np.exp(summary["coef"] + z * summary["se(coef)"]),
+                   p_value=summary["p"])
+
+def screen_feature(df, feature, outcome, test, n_bootstrap=1000, random_state=None, ci=0.95):
+    """
+    Run one test of `feature` against `outcome` on the rows where both are known.
+
+    Parameters
+    ----------
+    df : pandas.DataFrame
+        A cohort DataFrame, as from `Cohort.as_dataframe`.
+    feature : str
+    outcome : {"benefit", "os", "pfs"}
+    test : str
+        For "benefit": "auc" (bootstrapped AUC of the feature predicting benefit;
+        the effect is the AUC, and there is no p-value, since it would be that of
+        "mann_whitney") or "mann_whitney" (the effect is the difference in median
+        feature value). For "os" and "pfs": "logrank" (numeric features are
+        split at their median) or "coxph" (univariate; the effect is the hazard ratio).
+
+    Returns
+    -------
+    dict of n, statistic, effect, ci_low, ci_high and p_value
+    """
+    if outcome == "benefit":
+        df = df[df[feature].notnull() & df["benefit"].notnull()]
+        if test == "auc":
+            return _auc_test(df, feature, n_bootstrap, random_state, ci)
+        if test == "mann_whitney":
+            return _mann_whitney_test(df, feature)
+    elif outcome in SURVIVAL_OUTCOMES:
+        (survival_col, event_col) = SURVIVAL_OUTCOMES[outcome]
+        df = df[df[feature].notnull() & df[survival_col].notnull() & df[event_col].notnull()]
+        if test == "logrank":
+            return _logrank_test(df, feature, survival_col, event_col)
+        if test == "coxph":
+            return _coxph_test(df, feature, survival_col, event_col, ci)
+    else:
+        raise ValueError("Unknown outcome %s" % outcome)
+    raise ValueError("Test %s does not apply to outcome %s" % (test, outcome))
+
+def screen_tasks(features, outcomes, tests=None):
+    """List the (feature, outcome, test) combinations to screen."""
+    tasks = []
+    for feature in features:
+        for outcome in outcomes:
+            applicable = BENEFIT_TESTS if outcome == "benefit" else SURVIVAL_TESTS
+            for test in applicable:
+                if tests is None or test in tests:
+                    tasks.append((feature, outcome, test))
+    return tasks
+
+# Set in the parent before forking worker processes, so that the DataFrame is
+# inherited rather than pickled for every task.
+_worker_df = None
+_worker_kwargs = None
+
+def _run_task(task):
+    (feature, outcome, test, seed) = task
+    return screen_feature(_worker_df, feature, outcome, test, random_state=seed, **_worker_kwargs)
+
+def screen(df, features, outcomes=["benefit", "os", "pfs"], tests=None, n_jobs=1,
+           n_bootstrap=1000, random_state=None, ci=0.95, correction="fdr_bh"):
+    """
+    Test every feature against every outcome, and return a tidy results table.
+
+    Parameters
+    ----------
+    df : pandas.DataFrame
+        A cohort DataFrame, as from `Cohort.as_dataframe`.
+    features : list
+        Columns of `df` to screen.
+    outcomes : list
+        Any of "benefit", "os" and "pfs".
+    tests : list, optional
+        Tests to run (see `screen_feature`). By default, all tests that apply to each outcome.
+    n_jobs : int
+        Number of worker processes.
+    n_bootstrap : int
+        Bootstrap samples for the AUC confidence interval.
+    random_state : int, optional
+        Seed for the bootstrap, for reproducible results.
+    ci : float
+        Confidence level of the intervals.
+    correction : {"fdr_bh", "bonferroni", None}
+        Multiple testing correction applied across all tests, giving q_value.
+
+    Returns
+    -------
+    DataFrame with one row per (feature, outcome, test): n, statistic, effect,
+    ci_low, ci_high, p_value and q_value, sorted by p_value.
+    """
+    global _worker_df, _worker_kwargs
+    missing = [feature for feature in features if feature not in df.columns]
+    if len(missing) > 0:
+        raise ValueError("Features not in the DataFrame: %s" % missing)
+    tasks = screen_tasks(features, outcomes, tests)
+    # One seed per task, so that results don't depend on how tasks are split among workers.
+    if random_state is None:
+        seeds = [None] * len(tasks)
+    else:
+        seeds = list(np.random.RandomState(random_state).randint(np.iinfo(np.int32).max, size=len(tasks)))
+    tasks = [task + (seed,) for (task, seed) in zip(tasks, seeds)]
+
+    _worker_df = df
+    _worker_kwargs = dict(n_bootstrap=n_bootstrap, ci=ci)
+    try:
+        if n_jobs <= 1 or len(tasks) <= 1 or multiprocessing.current_process().daemon:
+            results = [_run_task(task) for task in tasks]
+        else:
+            pool = multiprocessing.get_context("fork").Pool(min(n_jobs, len(tasks)))
+            try:
+                results = pool.map(_run_task, tasks, chunksize=max(1, len(tasks) // (4 * n_jobs)))
+            finally:
+                pool.close()
+                pool.join()
+    finally:
+        _worker_df = None
+        _worker_kwargs = None
+
+    rows = []
+    for ((feature, outcome, test, _), result) in zip(tasks, results):
+        row = dict(feature=feature, outcome=outcome, test=test)
+        row.update(result)
+        rows.append(row)
+    df_results = pd.DataFrame.from_records(rows, columns=SCREEN_COLUMNS[:-1])
+    df_results["q_value"] = adjust_p_values(df_results["p_value"].values, method=correction)
+    return df_results.sort_values("p_value", kind="mergesort").reset_index(drop=True)
@@ -0,0 +1,270 @@
+# Copyright (c) 2017. Mount Sinai School of Medicine
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Serialization of pickled cache entries (variants, effects, etc.).
+
+Files written by `CacheSerializer` start with a short header recording the
+compression codec, so that they can be loaded regardless of how the reading
+`Cohort` is configured. Files without the header are plain pickles, as written
+by older versions of cohorts, and are still loaded as such.
+"""
+
+import pickle
+
+import numpy as np
+from varcode import Variant, VariantCollection, EffectCollection
+
+_MAGIC = b"\x93COHORTS"
+_FORMAT_VERSION = 1
+
+COMPRESSION_CODECS = [None, "lz4", "zstd"]
+
+def _compressor(compression):
+    """
+    Return (compress, decompress) functions for a compression codec name.
+
+    lz4 and zstandard are optional dependencies, so only import them when
+    a cache actually uses them.
+    """
+    if compression is None:
+        return (lambda data: data), (lambda data: data)
+    if compression == "lz4":
+        try:
+            import lz4.frame
+        except ImportError:
+            raise ValueError("lz4 compression requires the lz4 package: pip install lz4")
+        return lz4.frame.compress, lz4.frame.decompress
+    if compression == "zstd":
+        try:
+            import zstandard
+        except ImportError:
+            raise ValueError("zstd compression requires the zstandard package: pip install zstandard")
+        return (lambda data: zstandard.ZstdCompressor().compress(data),
+                lambda data: zstandard.ZstdDecompressor().decompress(data))
+    raise ValueError("Unknown compression %s; expected one of %s" % (
+        compression, COMPRESSION_CODECS))
+
+class _ObjectTable(object):
+    """
+    Interns objects (genomes, transcript IDs, metadata sources) so that each
+    distinct one is only stored once, and rows refer to it by index.
+    """
+    def __init__(self):
+        self.values = []
+        self._index = {}
+
+    def index(self, value):
+        if value not in self._index:
+            self._index[value] = len(self.values)
+            self.values.append(value)
+        return self._index[value]
+
+class CompactVariantCollection(object):
+    """
+    Struct-of-arrays encoding of a `varcode.VariantCollection`.
+
+    Rather than pickling every `Variant` (and its reference to a genome
+    object), we store contig/start/ref/alt columns, an index into a table
+    of distinct genomes, and the per-source metadata as plain lists. The
+    `VariantCollection` is only rebuilt when `materialize` is first called.
+    """
+    def __init__(self, variant_collection):
+        genomes = _ObjectTable()
+        variants = list(variant_collection)
+        self.contigs = np.array([v.original_contig for v in variants], dtype=object)
+        self.starts = np.array([v.original_start for v in variants], dtype=np.int64)
+        self.refs = np.array([v.original_ref for v in variants], dtype=object)
+        self.alts = np.array([v.original_alt for v in variants], dtype=object)
+        self.genome_indices = np.array([genomes.index(v.ensembl) for v in variants], dtype=np.int32)
+        self.flags = np.array([(v.allow_extended_nucleotides, v.normalize_contig_name)
+                               for v in variants], dtype=bool).reshape(len(variants), 2)
+        self.genomes = genomes.values
+
+        # Metadata is keyed by Variant; store it positionally instead.
+        variant_to_row = dict((v, i) for (i, v) in enumerate(variants))
+        self.metadata = {}
+        for source, variant_to_metadata in variant_collection.source_to_metadata_dict.items():
+            self.metadata[source] = [(variant_to_row[v], metadata)
+                                     for (v, metadata) in variant_to_metadata.items()
+                                     if v in variant_to_row]
+
+        kwargs = variant_collection.to_dict()
+        del kwargs["variants"]
+        del kwargs["source_to_metadata_dict"]
+        self.collection_kwargs = kwargs
+        self._materialized = None
+
+    def __len__(self):
+        return len(self.starts)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_materialized"] = None
+        return state
+
+    def variants(self):
+        return [Variant(contig=self.contigs[i],
+                        start=int(self.starts[i]),
+                        ref=self.refs[i],
+                        alt=self.alts[i],
+                        ensembl=self.genomes[self.genome_indices[i]],
+                        allow_extended_nucleotides=bool(self.flags[i, 0]),
+                        normalize_contig_name=bool(self.flags[i, 1]))
+                for i in range(len(self))]
+
+    def materialize(self):
+        if self._materialized is None:
+            variants = self.variants()
+            source_to_metadata_dict = dict(
+                (source, dict((variants[row], metadata) for (row, metadata) in rows))
+                for (source, rows) in self.metadata.items())
+            self._materialized = VariantCollection(
+                variants=variants,
+                source_to_metadata_dict=source_to_metadata_dict,
+                **self.collection_kwargs)
+        return self._materialized
+
+class CompactEffectCollection(object):
+    """
+    Struct-of-arrays encoding of a `varcode.EffectCollection`.
+
+    Each effect is stored as its class, the fields it is pickled with (its
+    `to_dict()`) other than its variant and transcript, and indices into the
+    distinct variants (held in a `CompactVariantCollection`) and transcripts.
+    `materialize` rebuilds each effect from those fields with `from_dict`, as
+    unpickling does, so effects are never re-annotated.
+    """
+    def __init__(self, effect_collection):
+        effects = list(effect_collection)
+        variant_table = _ObjectTable()
+        transcript_table = _ObjectTable()
+        class_table = _ObjectTable()
+        variant_indices = []
+        transcript_indices = []
+        class_indices = []
+        self.fields = []
+        for effect in effects:
+            fields = effect.to_dict()
+            variant = fields.pop("variant", None)
+            variant_indices.append(-1 if variant is None else variant_table.index(variant))
+            transcript = fields.pop("transcript", None)
+            transcript_indices.append(-1 if transcript is None else transcript_table.index(transcript))
+            class_indices.append(class_table.index(effect.__class__))
+            self.fields.append(fields)
+        self.variants = CompactVariantCollection(
+            VariantCollection(variant_table.values, distinct=False, sort_key=None))
+        self.variant_indices = np.array(variant_indices, dtype=np.int32)
+        self.transcripts = transcript_table.values
+        self.transcript_indices = np.array(transcript_indices, dtype=np.int32)
+        self.classes = class_table.values
+        self.class_indices = np.array(class_indices, dtype=np.int32)
+
+        kwargs = effect_collection.to_dict()
+        del kwargs["effects"]
+        self.collection_kwargs = kwargs
+        self._materialized = None
+
+    def __len__(self):
+        return len(self.variant_indices)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_materialized"] = None
+        return state
+
+    def materialize(self):
+        if self._materialized is None:
+            variants = self.variants.variants()
+            effects = []
+            for i in range(len(self)):
+                fields = dict(self.fields[i])
+                if self.variant_indices[i] >= 0:
+                    fields["variant"] = variants[self.variant_indices[i]]
+                if self.transcript_indices[i] >= 0:
+                    fields["transcript"] = self.transcripts[self.transcript_indices[i]]
+                effects.append(self.classes[self.class_indices[i]].from_dict(fields))
+            self._materialized = EffectCollection(effects, **self.collection_kwargs)
+        return self._materialized
+
+def to_compact(obj):
+    """Return the compact encoding of `obj` if it has one, otherwise `obj`."""
+    # EffectCollection and VariantCollection are unrelated classes, so order
+    # doesn't matter here.
+    if isinstance(obj, VariantCollection):
+        return CompactVariantCollection(obj)
+    if isinstance(obj, EffectCollection):
+        return CompactEffectCollection(obj)
+    return obj
+
+def is_compact(obj):
+    return isinstance(obj, (CompactVariantCollection, CompactEffectCollection))
+
+class CacheSerializer(object):
+    """
+    Reads and writes pickled cache files.
+
+    Parameters
+    __________
+    protocol : int, optional
+        Pickle protocol; defaults to the highest available (5 on Python 3.8+).
+    compression : {None, "lz4", "zstd"}, optional
+        Compress the pickled bytes. Requires the corresponding optional package.
+    compact : bool
+        Store `VariantCollection` and `EffectCollection` objects using their
+        compact struct-of-arrays encoding, in which genomes, variants and
+        transcripts shared by many objects are stored once. This makes cache
+        files smaller; `loads` rebuilds the same objects a plain pickle would.
+    """
+    def __init__(self, protocol=None, compression=None, compact=False):
+        if compression not in COMPRESSION_CODECS:
+            raise ValueError("Unknown compression %s; expected one of %s" % (
+                compression, COMPRESSION_CODECS))
+        self.protocol = pickle.HIGHEST_PROTOCOL if protocol is None else protocol
+        self.compression = compression
+        self.compact = compact
+
+    def dumps(self, obj):
+        if self.compact:
+            obj = to_compact(obj)
+        compress, _ = _compressor(self.compression)
+        codec = COMPRESSION_CODECS.index(self.compression)
+        header = _MAGIC + bytes([_FORMAT_VERSION, codec])
+        return header + compress(pickle.dumps(obj, protocol=self.protocol))
+
+    def loads(self, data, lazy=False):
+        """
+        Load bytes written by `dumps`, or a plain pickle.
+
+        If `lazy` is True, compact encodings are returned as-is rather than
+        materialized into varcode collections; callers must then call
+        `materialize` themselves. `Cohort` always loads with `lazy=False`.
+        """
+        if not data.startswith(_MAGIC):
+            return pickle.loads(data)
+        header_len = len(_MAGIC) + 2
+        version, codec = data[len(_MAGIC)], data[len(_MAGIC) + 1]
+        if version != _FORMAT_VERSION:
+            raise ValueError("Unknown cache format version %d" % version)
+        _, decompress = _compressor(COMPRESSION_CODECS[codec])
+        obj = pickle.loads(decompress(data[header_len:]))
+        if is_compact(obj) and not lazy:
+            return obj.materialize()
+        return obj
+
+    def dump(self, obj, f):
+        f.write(self.dumps(obj))
+
+    def load(self, f, lazy=False):
+        return self.loads(f.read(), lazy=lazy)
@@ -14,15 +14,10 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-from lifelines import KaplanMeierFitter, CoxPHFitter
-from lifelines.statistics import logrank_test
 import logging
-import matplotlib.colors as colors
-from matplotlib import pyplot as plt
 import numbers
 import numpy as np
-import seaborn as sb
-import patsy
+from .permutation import logrank_permutation_test
 from .rounding import float_str
 from .utils import get_logger
 
@@ -45,17 +40,22 @@ def _plot_kmf_single(df,
                      label_map,
                      color_palette,
                      ci_show,
-                     print_as_title):
+                     print_as_title,
+                     n_permutations=None,
+                     random_state=None,
+                     skip_plot=False):
     """
     Helper function to produce a single KM survival plot, among observations in df by groups defined by condition_col.
 
     All inputs are required - this function is intended to be called by `plot_kmf`.
     """
-    # make color inputs consistent hex format
-    if colors.is_color_like(with_condition_color):
-        with_condition_color = colors.to_hex(with_condition_color)
-    if colors.is_color_like(no_condition_color):
-        no_condition_color = colors.to_hex(no_condition_color)
+    if not skip_plot:
+        import matplotlib.colors as colors
+        # make color inputs consistent hex format
+        if colors.is_color_like(with_condition_color):
+            with_condition_color = colors.to_hex(with_condition_color)
+        if colors.is_color_like(no_condition_color):
+            no_condition_color = colors.to_hex(no_condition_color)
     ## prepare data to be plotted; producing 3 outputs:
     # - `condition`, series containing category labels to be plotted
     # - `label_map` (mapping condition values to plot labels)
@@ -85,7 +85,8 @@ def _plot_kmf_single(df,
             [label_map.update({condition_value: '{} = {}'.format(condition_col,
                                                         condition_value)})
                      for condition_value in condition.unique()]
-        if not color_map:
+        if not color_map and not skip_plot:
+            import seaborn as sb
             rgb_values = sb.color_palette(color_palette, len(label_map.keys()))
             hex_values = [colors.to_hex(col) for col in rgb_values]
             color_map = dict(zip(label_map.keys(), hex_values))
@@ -105,6 +106,9 @@ def _plot_kmf_single(df,
         raise ValueError('Don\'t know how to plot data of type\
                          {}'.format(df[condition_col].dtype))
 
+    from lifelines import KaplanMeierFitter, CoxPHFitter
+    from lifelines.statistics import logrank_test
+
     # produce kmf plot for each category (group) identified above
     kmf = KaplanMeierFitter()
     grp_desc = list()
@@ -115,34 +119,39 @@ def _plot_kmf_single(df,
         grp_survival = grp_df[survival_col]
         grp_event = (grp_df[censor_col].astype(bool))
         grp_label = label_map[grp_name]
-        grp_color = color_map[grp_name]
-        kmf.fit(grp_survival, grp_event, label=grp_label)
         desc_str = "# {}: {}".format(grp_label, len(grp_survival))
         grp_desc.append(desc_str)
         grp_survival_data[grp_name] = grp_survival
         grp_event_data[grp_name] = grp_event
+        if skip_plot:
+            continue
+        grp_color = color_map[grp_name]
+        kmf.fit(grp_survival, grp_event, label=grp_label)
         if ax:
             ax = kmf.plot(ax=ax, show_censors=True, ci_show=ci_show, color=grp_color)
         else:
             ax = kmf.plot(show_censors=True, ci_show=ci_show, color=grp_color)
 
     ## format the plot
-    # Set the y-axis to range 0 to 1
-    ax.set_ylim(0, 1)
-    y_tick_vals = ax.get_yticks()
-    ax.set_yticklabels(["%d" % int(y_tick_val * 100) for y_tick_val in y_tick_vals])
-    # plot title
-    if title:
-        ax.set_title(title)
-    elif print_as_title:
-        ax.set_title(' | '.join(grp_desc))
-    else:
+    if skip_plot:
         [print(desc) for desc in grp_desc]
-    # axis labels
-    if xlabel:
-        ax.set_xlabel(xlabel)
-    if ylabel:
-        ax.set_ylabel(ylabel)
+    else:
+        # Set the y-axis to range 0 to 1
+        ax.set_ylim(0, 1)
+        y_tick_vals = ax.get_yticks()
+        ax.set_yticklabels(["%d" % int(y_tick_val * 100) for y_tick_val in y_tick_vals])
+        # plot title
+        if title:
+            ax.set_title(title)
+        elif print_as_title:
+            ax.set_title(' | '.join(grp_desc))
+        else:
+            [print(desc) for desc in grp_desc]
+        # axis labels
+        if xlabel:
+            ax.set_xlabel(xlabel)
+        if ylabel:
+            ax.set_ylabel(ylabel)
     
     ## summarize analytical version of results
     ## again using same groups as are plotted
@@ -152,11 +161,19 @@ def _plot_kmf_single(df,
                                grp_survival_data[grp_names[1]],
                                event_observed_A=grp_event_data[grp_names[0]],
                                event_observed_B=grp_event_data[grp_names[1]])
+        if n_permutations:
+            results.permutation = logrank_permutation_test(
+                durations=df[survival_col],
+                events=df[censor_col].astype(bool),
+                groups=condition == grp_names[0],
+                n_permutations=n_permutations,
+                random_state=random_state)
     elif len(grp_names) == 1:
         # no analytical result for 1 or 0 groups
         results = NullSurvivalResults()
     else:
         # cox PH fitter for >2 groups
+        import patsy
         cf = CoxPHFitter()
         cox_df = patsy.dmatrix('+'.join([condition_col, survival_col,
                                          censor_col]),
@@ -189,7 +206,10 @@ def plot_kmf(df,
              label_map=None,
              color_palette="Set1",
              ci_show=False,
-             print_as_title=False):
+             print_as_title=False,
+             n_permutations=None,
+             random_state=None,
+             skip_plot=False):
     """
     Plot survival curves by splitting the dataset into two groups based on
     condition_col. Report results for a log-rank test (if two groups are plotted)
@@ -236,6 +256,12 @@ def plot_kmf(df,
           if color_map not provided.
         print_as_title: bool, optional, whether or not to print text
           within the plot's title vs. stdout, default False
+        n_permutations: int, optional, if given and two groups are plotted, also
+          run a logrank permutation test with this many permutations; its
+          `PermutationTestResults` are the `permutation` attribute of the results
+        random_state: int, optional, seed for the permutation test
+        skip_plot: bool, optional, compute the same results without plotting
+          (or importing matplotlib), default False
     """
     
     # set reasonable default threshold value depending on type of condition_col
@@ -268,7 +294,10 @@ def plot_kmf(df,
             ylabel=ylabel,
             ci_show=ci_show,
             color_palette=color_palette,
-            print_as_title=print_as_title)
+            print_as_title=print_as_title,
+            n_permutations=n_permutations,
+            random_state=random_state,
+            skip_plot=skip_plot)
 
     # if strata_col is None, pass all parameters to _plot_kmf_single
     if strata_col is None:
@@ -288,7 +317,12 @@ def plot_kmf(df,
         if ax is not None:
             raise ValueError("ax not supported with stratified analysis.")
         n_strata = len(df[strata_col].unique())
-        f, ax = plt.subplots(n_strata, sharex=True)
+        if skip_plot:
+            f = None
+            ax = None if n_strata == 1 else [None] * n_strata
+        else:
+            from matplotlib import pyplot as plt
+            f, ax = plt.subplots(n_strata, sharex=True)
         # create results dict to hold per-strata results
         results = dict()
         # call _plot_kmf_single for each of the strata
@@ -302,7 +336,7 @@ def plot_kmf(df,
             arglist["df"] = strat_df
             results[subtitle] = plot_kmf(**arglist)
             [print(desc) for desc in results[subtitle].desc]
-        if title:
+        if title and f is not None:
             f.suptitle(title)
         return results
 
@@ -317,6 +351,7 @@ def logrank(df,
             censor_col,
             survival_col,
             threshold=None):
+    from lifelines.statistics import logrank_test
     if threshold is not None:
         if threshold == "median":
             threshold = df[condition_col].median()
@@ -15,6 +15,7 @@
 import re
 import warnings
 from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
 import sys
 import logging
 from os import path
@@ -217,3 +218,14 @@ def set_attributes(obj, additional_data):
         if hasattr(obj, key):
             raise ValueError("Key %s in additional_data already exists in this object" % key)
         setattr(obj, _strip_column_name(key), value)
+
+def thread_map(fn, items, n_jobs=1):
+    """
+    Return `[fn(item) for item in items]`, computed by up to `n_jobs` threads.
+    Intended for I/O-bound work such as reading per-patient files.
+    """
+    items = list(items)
+    if n_jobs <= 1 or len(items) <= 1:
+        return [fn(item) for item in items]
+    with ThreadPoolExecutor(max_workers=min(n_jobs, len(items))) as executor:
+        return list(executor.map(fn, items))
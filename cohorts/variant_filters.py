@@ -13,10 +13,9 @@
 # limitations under the License.
 
 from .variant_stats import variant_stats_from_variant
-from .utils import get_logger
+from .utils import get_logger, thread_map
+from .isovar_utils import variant_key
 
-from varcode import Variant
-from varcode.common import memoize
 import pandas as pd
 from os import path
 
@@ -53,39 +52,89 @@ def variant_qc_filter(filterable_variant,
 
     return True
 
-@memoize
 def expressed_variant_set(cohort, patient, variant_collection):
-    # Warning: we previously had an issue where we used the same
-    # memoized set across different cohorts.
+    """
+    Set of `isovar_utils.variant_key` tuples of the patient's expressed variants.
+    """
     # TODO: we're currently using the same isovar cache that we use for expressed
     # neoantigen prediction; so we pass in the same epitope lengths.
     # This is hacky and should be addressed.
-    df_isovar = patient.cohort.load_single_patient_isovar(
+    return cohort.load_single_patient_expressed_variants(
         patient=patient,
         variants=variant_collection,
         epitope_lengths=[8, 9, 10, 11])
-    expressed_variant_set = set()
-    for _, row in df_isovar.iterrows():
-        expressed_variant = Variant(contig=row["chr"],
-                          start=row["pos"],
-                          ref=row["ref"],
-                          alt=row["alt"],
-                          ensembl=variant_collection[0].ensembl)
-        expressed_variant_set.add(expressed_variant)
-    return expressed_variant_set
 
 def variant_expressed_filter(filterable_variant, **kwargs):
     expressed_variants = expressed_variant_set(
         cohort=filterable_variant.patient.cohort,
         patient=filterable_variant.patient,
         variant_collection=filterable_variant.variant_collection)
-    return filterable_variant.variant in expressed_variants
+    return variant_key(filterable_variant.variant) in expressed_variants
 
 def effect_expressed_filter(filterable_effect, **kwargs):
     return variant_expressed_filter(filterable_effect, **kwargs)
 
+PAGEANT_COLUMNS_BOTH = [
+    "depth1", # Normal
+    "depth2", # Tumor
+    "onBP1",
+    "onBP2",
+    "numOnLoci",
+    "fracBPOn1",
+    "fracBPOn2",
+    "fracLociOn",
+    "offBP1",
+    "offBP2",
+    "numOffLoci",
+    "fracBPOff1",
+    "fracBPOff2",
+    "fracLociOff",
+]
+PAGEANT_COLUMNS_SINGLE = [
+    "depth",
+    "onBP",
+    "numOnLoci",
+    "fracBPOn",
+    "fracLociOn",
+    "offBP",
+    "numOffLoci",
+    "fracBPOff",
+    "fracLociOff"
+]
+
+def load_single_patient_num_loci(coverage_file, min_tumor_depth, min_normal_depth=0):
+    """
+    Return the number of Ensembl loci covered at the given depths, from one patient's
+    Pageant CoverageDepth `cdf.csv`. Only the depth and numOnLoci columns are read.
+
+    If min_normal_depth is 0, use tumor coverage. Otherwise, use joint tumor/normal
+    coverage.
+    """
+    if min_normal_depth < 0:
+        raise ValueError("min_normal_depth must be >= 0")
+    use_tumor_only = (min_normal_depth == 0)
+    columns = PAGEANT_COLUMNS_SINGLE if use_tumor_only else PAGEANT_COLUMNS_BOTH
+    depth_columns = ["depth"] if use_tumor_only else ["depth1", "depth2"]
+    df = pd.read_csv(
+        coverage_file,
+        names=columns,
+        header=1,
+        usecols=depth_columns + ["numOnLoci"])
+    # pylint: disable=no-member
+    # pylint gets confused by read_csv
+    if use_tumor_only:
+        depth_mask = (df.depth == min_tumor_depth)
+    else:
+        depth_mask = ((df.depth1 == min_normal_depth) & (df.depth2 == min_tumor_depth))
+    num_loci = df.numOnLoci[depth_mask]
+    if len(num_loci) != 1:
+        raise ValueError(
+            "Incorrect number of tumor={}, normal={} depth loci results: {} in {}".format(
+                min_tumor_depth, min_normal_depth, len(num_loci), coverage_file))
+    return num_loci.iloc[0]
+
 def load_ensembl_coverage(cohort, coverage_path, min_tumor_depth, min_normal_depth=0,
-                          pageant_dir_fn=None):
+                          pageant_dir_fn=None, n_jobs=1):
     """
     Load in Pageant CoverageDepth results with Ensembl loci.
 
@@ -98,63 +147,23 @@ def load_ensembl_coverage(cohort, coverage_path, min_tumor_depth, min_normal_dep
     pageant_dir_fn is a function that takes in a Patient and produces a Pageant
     dir name.
 
+    Patients' files are read by up to n_jobs threads.
+
     Last tested with Pageant CoverageDepth version 1ca9ed2.
     """
     # Function to grab the pageant file name using the Patient
     if pageant_dir_fn is None:
         pageant_dir_fn = lambda patient: patient.id
 
-    columns_both = [
-        "depth1", # Normal
-        "depth2", # Tumor
-        "onBP1",
-        "onBP2",
-        "numOnLoci",
-        "fracBPOn1",
-        "fracBPOn2",
-        "fracLociOn",
-        "offBP1",
-        "offBP2",
-        "numOffLoci",
-        "fracBPOff1",
-        "fracBPOff2",
-        "fracLociOff",
-    ]
-    columns_single = [
-        "depth",
-        "onBP",
-        "numOnLoci",
-        "fracBPOn",
-        "fracLociOn",
-        "offBP",
-        "numOffLoci",
-        "fracBPOff",
-        "fracLociOff"
-    ]
-    if min_normal_depth < 0:
-        raise ValueError("min_normal_depth must be >= 0")
-    use_tumor_only = (min_normal_depth == 0)
-    columns = columns_single if use_tumor_only else columns_both
-    ensembl_loci_dfs = []
-    for patient in cohort:
-        patient_ensembl_loci_df = pd.read_csv(
+    num_loci = thread_map(
+        lambda patient: load_single_patient_num_loci(
             path.join(coverage_path, pageant_dir_fn(patient), "cdf.csv"),
-            names=columns,
-            header=1)
-        # pylint: disable=no-member
-        # pylint gets confused by read_csv
-        if use_tumor_only:
-            depth_mask = (patient_ensembl_loci_df.depth == min_tumor_depth)
-        else:
-            depth_mask = (
-                (patient_ensembl_loci_df.depth1 == min_normal_depth) &
-                (patient_ensembl_loci_df.depth2 == min_tumor_depth))
-        patient_ensembl_loci_df = patient_ensembl_loci_df[depth_mask]
-        assert len(patient_ensembl_loci_df) == 1, (
-            "Incorrect number of tumor={}, normal={} depth loci results: {} for patient {}".format(
-                min_tumor_depth, min_normal_depth, len(patient_ensembl_loci_df), patient))
-        patient_ensembl_loci_df["patient_id"] = patient.id
-        ensembl_loci_dfs.append(patient_ensembl_loci_df)
-    ensembl_loci_df = pd.concat(ensembl_loci_dfs)
+            min_tumor_depth=min_tumor_depth,
+            min_normal_depth=min_normal_depth),
+        cohort, n_jobs=n_jobs)
+    return ensembl_coverage_dataframe([patient.id for patient in cohort], num_loci)
+
+def ensembl_coverage_dataframe(patient_ids, num_loci):
+    ensembl_loci_df = pd.DataFrame({"patient_id": patient_ids, "numOnLoci": num_loci})
     ensembl_loci_df["MB"] = ensembl_loci_df.numOnLoci / 1000000.0
     return ensembl_loci_df[["patient_id", "numOnLoci", "MB"]]
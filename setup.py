@@ -66,8 +66,16 @@ if __name__ == "__main__":
             "Topic :: Scientific/Engineering :: Bio-Informatics",
         ],
         install_requires=install_requires,
+        extras_require={
+            "compression": ["lz4", "zstandard"],
+        },
         dependency_links=dependency_links,
         python_requires=">=3.3",
         long_description=readme,
         packages=["cohorts", "cohorts.io"],
+        entry_points={
+            "console_scripts": [
+                "cohorts-precompute = cohorts.cli:precompute_main",
+            ],
+        },
     )
@@ -0,0 +1,132 @@
+# Copyright (c) 2017. Mount Sinai School of Medicine
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import print_function
+
+from os import path
+import pandas as pd
+from nose.tools import eq_, ok_
+
+from cohorts.cache_management import filter_hash_of, select_evictions
+from cohorts.utils import thread_map
+
+from .test_basic import make_simple_cohort
+
+def make_usage():
+    # (file_name, bytes, last_access)
+    files = [("union-variants.pkl", 100, 0),
+             ("union-variants.f-1.default.null.pkl", 10, 50),
+             ("union-variants.f-2.default.null.pkl", 10, 10),
+             ("union-variants.f-3.default.null.pkl", 10, 90)]
+    return pd.DataFrame.from_records([
+        dict(cache_name="cached-variants", patient_id="1", file_name=file_name,
+             filter_hash=filter_hash_of(file_name), bytes=size, last_access=last_access,
+             path=file_name)
+        for (file_name, size, last_access) in files])
+
+def test_filter_hash_of():
+    eq_(filter_hash_of("union-variants.pkl"), None)
+    eq_(filter_hash_of("union-effects.pkl"), None)
+    eq_(filter_hash_of("union-variants.f-1.default.null.pkl"), "f-1.default.null")
+
+def test_select_evictions_quota():
+    usage = make_usage()
+    # LRU among filtered entries
+    eq_(list(select_evictions(usage, max_bytes=115)["file_name"]),
+        ["union-variants.f-2.default.null.pkl", "union-variants.f-1.default.null.pkl"])
+    # Base artifacts are kept, even if still over quota
+    eq_(len(select_evictions(usage, max_bytes=50)), 3)
+    eq_(len(select_evictions(usage, max_bytes=50, evict_base=True)), 4)
+    eq_(len(select_evictions(usage, max_bytes=1000)), 0)
+
+def test_select_evictions_ttl():
+    usage = make_usage()
+    eq_(list(select_evictions(usage, ttl_seconds=60, now=100)["file_name"]),
+        ["union-variants.f-2.default.null.pkl"])
+    # TTL only expires base artifacts if allowed
+    eq_(len(select_evictions(usage, ttl_seconds=60, now=100, evict_base=True)), 2)
+
+def test_evict_cache():
+    cohort = None
+    try:
+        cohort = make_simple_cohort()
+        cache_name = cohort.cache_names["variant"]
+        df = pd.DataFrame({"a": range(100)})
+        cohort.save_to_cache(df, cache_name, "1", "union-variants.pkl")
+        cohort.save_to_cache(df, cache_name, "1", "union-variants.f-1.default.null.pkl")
+        cohort.save_to_cache(df, cache_name, "4", "union-variants.f-1.default.null.pkl")
+        stats = cohort.cache_stats(by="filter_hash").set_index("filter_hash")
+        eq_(stats.loc["base", "files"], 1)
+        eq_(stats.loc["f-1.default.null", "files"], 2)
+
+        evicted = cohort.evict_cache(max_bytes=0)
+        eq_(len(evicted), 2)
+        eq_(list(cohort.cache_usage()["file_name"]), ["union-variants.pkl"])
+    finally:
+        if cohort is not None:
+            cohort.clear_caches()
+
+def test_evict_cache_over_quota():
+    cohort = None
+    try:
+        cohort = make_simple_cohort()
+        cache_name = cohort.cache_names["variant"]
+        df = pd.DataFrame({"a": range(100)})
+        inputs = [{"path": "1.vcf", "size": 1, "mtime": 1}]
+        cohort.save_to_cache(df, cache_name, "1", "union-variants.pkl", inputs=inputs)
+        cohort.save_to_cache(df, cache_name, "1", "union-variants.f-1.default.null.pkl", inputs=inputs)
+        patient_cache_dir = cohort._patient_cache_dir(cache_name, "1")
+        eq_(sorted(cohort.load_input_fingerprints(patient_cache_dir).keys()),
+            ["union-variants.f-1.default.null.pkl", "union-variants.pkl"])
+
+        # Evicted entries' input fingerprints are removed too.
+        cohort.cache_max_bytes = 1
+        cohort.save_to_cache(df, cache_name, "1", "union-variants.f-2.default.null.pkl", inputs=inputs)
+        eq_(list(cohort.cache_usage()["file_name"]), ["union-variants.pkl"])
+        eq_(list(cohort.load_input_fingerprints(patient_cache_dir).keys()), ["union-variants.pkl"])
+
+        # With only unfiltered entries left, later writes don't rescan the cache.
+        evictions = []
+        evict_cache = cohort.evict_cache
+        cohort.evict_cache = lambda **kwargs: evictions.append(kwargs) or evict_cache(**kwargs)
+        cohort.save_to_cache(df, cache_name, "2", "union-variants.pkl")
+        eq_(len(evictions), 0)
+        cohort.save_to_cache(df, cache_name, "2", "union-variants.f-1.default.null.pkl")
+        eq_(len(evictions), 1)
+    finally:
+        if cohort is not None:
+            cohort.clear_caches()
+
+def test_evict_cache_threads():
+    cohort = None
+    try:
+        cohort = make_simple_cohort()
+        cohort.cache_max_bytes = 1
+        cache_name = cohort.cache_names["variant"]
+        df = pd.DataFrame({"a": range(100)})
+        inputs = [{"path": "1.vcf", "size": 1, "mtime": 1}]
+
+        def save(i):
+            for j in range(20):
+                cohort.save_to_cache(df, cache_name, str(i % 3),
+                                     "union-variants.f-%d.default.null.pkl" % (i * 20 + j), inputs=inputs)
+        # Workers going over quota at the same time don't remove each other's evictions.
+        thread_map(save, range(8), n_jobs=8)
+        eq_(len(cohort.cache_usage()), 0)
+        eq_(cohort._cache_bytes, 0)
+        for patient_id in ["0", "1", "2"]:
+            eq_(cohort.load_input_fingerprints(cohort._patient_cache_dir(cache_name, patient_id)), {})
+    finally:
+        if cohort is not None:
+            cohort.clear_caches()
@@ -0,0 +1,49 @@
+# Copyright (c) 2017. Mount Sinai School of Medicine
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import numpy as np
+from nose.tools import eq_, ok_
+
+from cohorts.cutpoint import candidate_thresholds, cutpoint_scan, maxstat_test
+from cohorts.permutation import LogrankStatistic
+
+def make_survival_data(n=60, seed=0):
+    random_state = np.random.RandomState(seed)
+    values = random_state.randn(n)
+    # Patients above 0.5 survive twice as long.
+    durations = random_state.exponential(10, size=n) * np.where(values > 0.5, 2, 1)
+    events = random_state.rand(n) > 0.2
+    return values, durations, events
+
+def test_candidate_thresholds():
+    values = np.arange(10)
+    eq_(list(candidate_thresholds(values, min_group_fraction=0.2)), [1, 2, 3, 4, 5, 6, 7])
+    eq_(list(candidate_thresholds(values, min_group_fraction=0)), list(range(9)))
+
+def test_cutpoint_scan():
+    values, durations, events = make_survival_data()
+    scan = cutpoint_scan(values, durations, events)
+    ok_((scan.n_above >= 6).all() and (scan.n_below >= 6).all())
+    statistic = LogrankStatistic(durations, events)
+    for row in scan.itertuples():
+        ok_(np.isclose(row.statistic, statistic(values > row.threshold)))
+
+def test_maxstat_test():
+    values, durations, events = make_survival_data()
+    results = maxstat_test(values, durations, events, n_permutations=200, random_state=0)
+    eq_(results.statistic, results.scan.statistic.max())
+    # Adjusting for the search over thresholds makes the best split less significant.
+    ok_(results.p_value >= results.scan.p_value.min())
+    eq_(results.p_value, maxstat_test(values, durations, events, n_permutations=200,
+                                      random_state=0, batch_size=7).p_value)
@@ -15,7 +15,12 @@
 from __future__ import print_function
 
 from cohorts import Cohort, DataFrameLoader
+from cohorts.cohort import DATAFRAME_MEMO_SIZE
+from cohorts.variant_filters import load_ensembl_coverage
 
+from os import makedirs, path
+from shutil import rmtree
+import tempfile
 import pandas as pd
 from nose.tools import eq_
 
@@ -35,3 +40,103 @@ def test_df_loading():
     # pylint: disable=no-member
     # pylint gets confused by as_dataframe's return type
     eq_(set(df.patient_id), set(["1", "5"]))
+
+def test_df_loading_cached():
+    cohort = make_simple_cohort()
+    calls = []
+    fingerprint = [0]
+    def load_df():
+        calls.append(1)
+        return pd.DataFrame({"patient_id": ["1", "5"], "hello_value": ["hello", "goodbye"]})
+    cohort.df_loaders = [DataFrameLoader("hello", load_df, fingerprint=lambda: fingerprint[0])]
+
+    df = cohort.as_dataframe(join_with="hello")
+    df["hello_value"] = "changed"
+    df = cohort.as_dataframe(join_with="hello")
+    eq_(len(calls), 1)
+    # The memoized DataFrame isn't modified by changes to a returned copy.
+    eq_(set(df.hello_value), set(["hello", "goodbye"]))
+
+    fingerprint[0] += 1
+    cohort.as_dataframe(join_with="hello")
+    eq_(len(calls), 2)
+
+    cohort.clear_dataframe_cache()
+    cohort.as_dataframe(join_with="hello")
+    eq_(len(calls), 3)
+
+    # Patients' data changed in place is picked up without reloading.
+    cohort[0].additional_data["stage"] = "IV"
+    df = cohort.as_dataframe(join_with="hello")
+    eq_(df.set_index("patient_id")["stage"]["1"], "IV")
+    eq_(len(calls), 3)
+
+def test_df_loading_not_cached_without_fingerprint():
+    cohort = make_simple_cohort()
+    values = ["hello"]
+    def load_df():
+        return pd.DataFrame({"patient_id": ["1", "5"], "hello_value": values * 2})
+    cohort.df_loaders = [DataFrameLoader("hello", load_df)]
+    n_memoized = len(cohort._dataframe_memo)
+
+    eq_(set(cohort.as_dataframe(join_with="hello").hello_value), set(["hello"]))
+    values[0] = "goodbye"
+    eq_(set(cohort.as_dataframe(join_with="hello").hello_value), set(["goodbye"]))
+    eq_(len(cohort._dataframe_memo), n_memoized)
+    eq_(len(cohort._df_loader_memo), 0)
+
+def test_df_loading_memo_bounded():
+    cohort = make_simple_cohort()
+    fingerprint = [0]
+    def load_df():
+        return pd.DataFrame({"patient_id": ["1", "5"], "hello_value": ["hello", "goodbye"]})
+    cohort.df_loaders = [DataFrameLoader("hello", load_df, fingerprint=lambda: fingerprint[0])]
+
+    for i in range(DATAFRAME_MEMO_SIZE + 2):
+        fingerprint[0] = i
+        cohort.as_dataframe(join_with="hello")
+    eq_(len(cohort._dataframe_memo), DATAFRAME_MEMO_SIZE)
+    eq_(len(cohort._df_loader_memo), 1)
+
+COVERAGE_COLUMNS = ["depth", "onBP", "numOnLoci", "fracBPOn", "fracLociOn",
+                    "offBP", "numOffLoci", "fracBPOff", "fracLociOff"]
+
+def write_coverage(coverage_path, dir_name, bp_per_depth):
+    makedirs(path.join(coverage_path, dir_name))
+    df_cdf = pd.DataFrame([[depth] + [bp_per_depth * (10 - depth)] * 8 for depth in range(5)],
+                          columns=COVERAGE_COLUMNS)
+    with open(path.join(coverage_path, dir_name, "cdf.csv"), "w") as f:
+        f.write("# Pageant CoverageDepth\n")
+        df_cdf.to_csv(f, index=False)
+
+def test_ensembl_coverage():
+    cohort = make_simple_cohort()
+    coverage_path = tempfile.mkdtemp()
+    try:
+        for (i, patient) in enumerate(cohort):
+            write_coverage(coverage_path, patient.id, (i + 1) * 1000000)
+
+        df = load_ensembl_coverage(cohort, coverage_path, min_tumor_depth=2, n_jobs=2)
+        eq_(list(df.patient_id), [patient.id for patient in cohort])
+        eq_(list(df.MB), [8.0 * (i + 1) for i in range(len(cohort))])
+    finally:
+        rmtree(coverage_path)
+
+def test_patient_to_mb():
+    cohort = make_simple_cohort()
+    coverage_path = tempfile.mkdtemp()
+    try:
+        for (i, patient) in enumerate(cohort):
+            write_coverage(coverage_path, patient.id, 1000000)
+            write_coverage(coverage_path, "other-" + patient.id, 2000000)
+        cohort.pageant_coverage_path = coverage_path
+        cohort.min_coverage_tumor_depth = 2
+        cohort.min_coverage_normal_depth = 0
+        eq_(set(cohort.patient_to_mb().values()), set([8.0]))
+
+        # Coverage files chosen by a new pageant_dir_fn are read.
+        cohort.pageant_dir_fn = lambda patient: "other-" + patient.id
+        eq_(set(cohort.patient_to_mb().values()), set([16.0]))
+    finally:
+        cohort.clear_caches()
+        rmtree(coverage_path)
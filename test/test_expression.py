@@ -0,0 +1,142 @@
+# Copyright (c) 2017. Mount Sinai School of Medicine
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from os import listdir, makedirs, path, remove
+from shutil import rmtree
+import tempfile
+
+import numpy as np
+import pandas as pd
+from nose.tools import eq_, ok_, raises
+
+from cohorts.expression import (read_kallisto_abundance, kallisto_gene_counts, read_cufflinks,
+                                ExpressionMatrix)
+
+from . import generated_data_path
+
+GENE_NAMES = pd.Series(
+    ["TP53", "TP53", "BRCA1"],
+    index=pd.Index(["ENST01", "ENST02", "ENST03"], name="target_id"),
+    name="gene_name")
+
+def generated_file_path(file_name):
+    file_path = generated_data_path(file_name)
+    if not path.exists(path.dirname(file_path)):
+        makedirs(path.dirname(file_path))
+    return file_path
+
+def write_kallisto_abundance(file_name, target_ids, est_counts):
+    file_path = generated_file_path(file_name)
+    pd.DataFrame({
+        "target_id": target_ids,
+        "length": 1000,
+        "eff_length": 900.0,
+        "est_counts": est_counts,
+        "tpm": 1.0}).to_csv(file_path, sep="\t", index=False)
+    return file_path
+
+def test_kallisto_gene_counts():
+    file_path = write_kallisto_abundance(
+        "abundance.tsv", ["ENST01", "ENST02", "ENST03"], [1.5, 2.0, 4.0])
+    try:
+        df_abundance = read_kallisto_abundance(file_path)
+        eq_(list(df_abundance.columns), ["target_id", "est_counts"])
+        df_genes = kallisto_gene_counts(df_abundance, GENE_NAMES)
+        eq_(list(df_genes["gene_name"]), ["BRCA1", "TP53"])
+        eq_(list(df_genes["est_counts"]), [4.0, 3.5])
+    finally:
+        remove(file_path)
+
+@raises(ValueError)
+def test_kallisto_gene_counts_unknown_transcript():
+    kallisto_gene_counts(
+        pd.DataFrame({"target_id": ["ENST01", "ENST99"], "est_counts": [1.0, 2.0]}), GENE_NAMES)
+
+def test_read_cufflinks():
+    file_path = generated_file_path("genes.fpkm_tracking")
+    pd.DataFrame({
+        "tracking_id": ["G1", "G2", "G3"],
+        "class_code": "-",
+        "gene_id": ["G1", "G2", "G3"],
+        "gene_short_name": ["TP53", "BRCA1", "EGFR"],
+        "locus": "1:1-100",
+        "length": 100,
+        "FPKM": [1.0, 2.0, 3.0],
+        "FPKM_conf_lo": 0.0,
+        "FPKM_conf_hi": 5.0,
+        "FPKM_status": ["OK", "LOWDATA", "OK"]}).to_csv(file_path, sep="\t", index=False)
+    try:
+        data = read_cufflinks(file_path, filter_ok=True, chunksize=2)
+        eq_(list(data["gene_id"]), ["G1", "G3"])
+        ok_("class_code" not in data.columns)
+        eq_(len(read_cufflinks(file_path, filter_ok=False)), 3)
+    finally:
+        remove(file_path)
+
+def test_expression_matrix():
+    matrix_dir = tempfile.mkdtemp()
+    try:
+        tables = [
+            pd.DataFrame({"gene_name": ["TP53", "BRCA1", "TP53"], "est_counts": [1.0, 2.0, 3.0]}),
+            pd.DataFrame({"gene_name": ["EGFR", "TP53"], "est_counts": [5.0, 6.0]})]
+        ExpressionMatrix.build(matrix_dir, ["1", "2"], tables, "gene_name", "est_counts",
+                               metadata={"source": "kallisto"})
+        ok_(ExpressionMatrix.exists(matrix_dir))
+
+        matrix = ExpressionMatrix(matrix_dir)
+        eq_(matrix.shape, (2, 3))
+        eq_(matrix.metadata, {"source": "kallisto"})
+        eq_(matrix.values.dtype, np.float32)
+        df_genes = matrix.genes(["TP53", "EGFR"])
+        eq_(list(df_genes.index), ["1", "2"])
+        eq_(list(df_genes["TP53"]), [4.0, 6.0])
+        ok_(np.isnan(df_genes["EGFR"]["1"]))
+        eq_(matrix.gene("BRCA1")["1"], 2.0)
+        eq_(matrix.patient("2")["EGFR"], 5.0)
+        eq_(matrix.to_dataframe().shape, (2, 3))
+    finally:
+        rmtree(matrix_dir)
+
+def test_expression_matrix_rebuilt():
+    matrix_dir = tempfile.mkdtemp()
+    try:
+        tables = [pd.DataFrame({"gene_name": ["TP53", "BRCA1", "EGFR"], "est_counts": [1.0, 2.0, 3.0]})]
+        matrix = ExpressionMatrix.build(matrix_dir, ["1"], tables, "gene_name", "est_counts")
+        # A smaller matrix written over it doesn't change the one already open.
+        ExpressionMatrix.build(matrix_dir, ["1"], [tables[0][:1]], "gene_name", "est_counts")
+        eq_(list(matrix.patient("1")), [2.0, 3.0, 1.0])
+        eq_(ExpressionMatrix(matrix_dir).shape, (1, 1))
+        eq_(sorted(listdir(matrix_dir)), [ExpressionMatrix.INDEX_FILE_NAME, ExpressionMatrix.VALUES_FILE_NAME])
+    finally:
+        rmtree(matrix_dir)
+
+def test_expression_matrix_in_memory():
+    tables = [
+        pd.DataFrame({"gene_name": ["TP53", "BRCA1", "TP53"], "est_counts": [1.0, 2.0, 3.0]}),
+        pd.DataFrame({"gene_name": ["EGFR", "TP53"], "est_counts": [5.0, 6.0]})]
+    matrix = ExpressionMatrix.build(None, ["1", "2"], tables, "gene_name", "est_counts")
+    eq_(matrix.directory, None)
+    eq_(matrix.shape, (2, 3))
+    eq_(list(matrix.genes(["TP53"])["TP53"]), [4.0, 6.0])
+    eq_(matrix.patient("2")["EGFR"], 5.0)
+
+@raises(ValueError)
+def test_expression_matrix_unknown_gene():
+    matrix_dir = tempfile.mkdtemp()
+    try:
+        matrix = ExpressionMatrix.build(
+            matrix_dir, ["1"], [pd.DataFrame({"gene_id": ["G1"], "FPKM": [1.0]})], "gene_id", "FPKM")
+        matrix.genes(["G2"])
+    finally:
+        rmtree(matrix_dir)
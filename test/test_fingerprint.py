@@ -0,0 +1,40 @@
+# Copyright (c) 2017. Mount Sinai School of Medicine
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from nose.tools import eq_, ok_
+
+from cohorts.fingerprint import file_fingerprint, fingerprints_match
+
+from . import data_path
+
+def test_file_fingerprint():
+    fingerprint = file_fingerprint(data_path("vcf_template_1.vcf"), hash_content=True)
+    ok_(fingerprint["size"] > 0)
+    ok_(fingerprint["mtime"] is not None)
+    eq_(len(fingerprint["sha1"]), 40)
+
+    missing = file_fingerprint(data_path("does_not_exist.vcf"))
+    eq_(missing["size"], None)
+
+def test_fingerprints_match():
+    a = {"path": "a.vcf", "size": 10, "mtime": 1}
+    ok_(fingerprints_match([a], [dict(a)]))
+    ok_(not fingerprints_match([a], [dict(a, size=11)]))
+    ok_(not fingerprints_match([a], [dict(a, mtime=2)]))
+    ok_(not fingerprints_match([a], []))
+    # Content hashes take precedence over mtimes
+    ok_(fingerprints_match([dict(a, sha1="x")], [dict(a, mtime=2, sha1="x")]))
+    ok_(not fingerprints_match([dict(a, sha1="x")], [dict(a, sha1="y")]))
+    # Hashes recorded on only one side are ignored
+    ok_(fingerprints_match([dict(a, sha1="x")], [a]))
@@ -0,0 +1,226 @@
+# Copyright (c) 2017. Mount Sinai School of Medicine
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+from os import listdir, path, utime
+from shutil import rmtree
+import tempfile
+import time
+
+import pandas as pd
+from nose.tools import eq_, ok_
+
+from cohorts import Sample
+from cohorts.io.gcloud_cache import GoogleStorageCache
+from cohorts.io.gcloud_storage import GoogleStorageIO
+
+from .test_basic import make_simple_cohort
+from .test_gcloud_range import make_bam
+from .test_gcloud_storage import FakeClient, write_file, read_file
+
+def make_cache(temp_dir, **kwargs):
+    client = FakeClient(path.join(temp_dir, "gs"))
+    cache = GoogleStorageCache(path.join(temp_dir, "cache"),
+                               gcio=GoogleStorageIO(client=client), **kwargs)
+    return (client, cache)
+
+def test_downloads_once():
+    temp_dir = tempfile.mkdtemp()
+    try:
+        (client, cache) = make_cache(temp_dir)
+        write_file(path.join(client.directory, "bucket", "1.vcf"), b"variants")
+        local_path = cache.local_path("gs://bucket/1.vcf")
+        eq_(path.basename(local_path), "1.vcf")
+        eq_(read_file(local_path), b"variants")
+        eq_(cache.local_path("gs://bucket/1.vcf"), local_path)
+        eq_(client.n_range_reads, 1)
+
+        # A later run checks the generation, and reuses the local copy.
+        later_cache = GoogleStorageCache(cache.cache_dir, gcio=cache.gcio)
+        eq_(later_cache.local_path("gs://bucket/1.vcf"), local_path)
+        eq_(client.n_range_reads, 1)
+
+        # The same contents under another URI are stored once.
+        write_file(path.join(client.directory, "bucket", "copy", "1.vcf"), b"variants")
+        eq_(later_cache.local_path("gs://bucket/copy/1.vcf"), local_path)
+        eq_(client.n_range_reads, 1)
+
+        # Changed objects are downloaded again.
+        time.sleep(0.01)
+        write_file(path.join(client.directory, "bucket", "1.vcf"), b"new variants")
+        changed_cache = GoogleStorageCache(cache.cache_dir, gcio=cache.gcio)
+        ok_(changed_cache.fingerprint("gs://bucket/1.vcf") != cache.fingerprint("gs://bucket/1.vcf"))
+        eq_(read_file(changed_cache.local_path("gs://bucket/1.vcf")), b"new variants")
+        eq_(client.n_range_reads, 2)
+    finally:
+        rmtree(temp_dir)
+
+def test_companions():
+    temp_dir = tempfile.mkdtemp()
+    try:
+        (client, cache) = make_cache(temp_dir)
+        write_file(path.join(client.directory, "bucket", "rna.bam"), b"reads")
+        write_file(path.join(client.directory, "bucket", "rna.bam.bai"), b"index")
+        local_path = cache.local_path("gs://bucket/rna.bam", companions=[".bai", ".csi"])
+        eq_(sorted(listdir(path.dirname(local_path))), ["rna.bam", "rna.bam.bai"])
+    finally:
+        rmtree(temp_dir)
+
+def test_eviction():
+    temp_dir = tempfile.mkdtemp()
+    try:
+        (client, cache) = make_cache(temp_dir, max_bytes=250)
+        local_paths = []
+        for i in range(3):
+            write_file(path.join(client.directory, "bucket", "%d.tsv" % i), str(i).encode() * 100)
+            local_paths.append(cache.local_path("gs://bucket/%d.tsv" % i))
+            # Mark each object as used before the next one.
+            utime(local_paths[-1], (i, i))
+        eq_([path.exists(local_path) for local_path in local_paths], [False, True, True])
+        # An evicted object is downloaded again when next used.
+        eq_(client.n_range_reads, 3)
+        eq_(read_file(cache.local_path("gs://bucket/0.tsv")), b"0" * 100)
+        eq_(client.n_range_reads, 4)
+    finally:
+        rmtree(temp_dir)
+
+def test_pinned_objects_kept():
+    temp_dir = tempfile.mkdtemp()
+    try:
+        (client, cache) = make_cache(temp_dir, max_bytes=250)
+        # Another cache on the same directory, as in another process.
+        other_cache = GoogleStorageCache(cache.cache_dir, max_bytes=250, gcio=cache.gcio)
+        for i in range(4):
+            write_file(path.join(client.directory, "bucket", "%d.tsv" % i), str(i).encode() * 100)
+        pinned_path = cache.local_path("gs://bucket/0.tsv", pin=True)
+        utime(pinned_path, (0, 0))
+        for i in range(1, 4):
+            other_cache.local_path("gs://bucket/%d.tsv" % i)
+        ok_(path.exists(pinned_path))
+        cache.unpin(pinned_path)
+        write_file(path.join(client.directory, "bucket", "4.tsv"), b"4" * 100)
+        other_cache.local_path("gs://bucket/4.tsv")
+        ok_(not path.exists(pinned_path))
+    finally:
+        rmtree(temp_dir)
+
+def test_usage_skips_partial_files():
+    temp_dir = tempfile.mkdtemp()
+    try:
+        (client, cache) = make_cache(temp_dir)
+        write_file(path.join(client.directory, "bucket", "0.tsv"), b"0" * 100)
+        local_path = cache.local_path("gs://bucket/0.tsv")
+        [(_, n_bytes, _, _)] = cache.usage()
+        for suffix in [".part", ".part.json", ".part.json.tmp", ".part.lock"]:
+            write_file(path.join(path.dirname(local_path), "1.tsv" + suffix), b"1" * 10000)
+        eq_(cache.usage()[0][1], n_bytes)
+        # Files removed while the cache is scanned are skipped.
+        object_dir = path.dirname(local_path)
+        def listdir_then_remove(directory):
+            file_names = listdir(directory)
+            if directory == object_dir:
+                rmtree(directory)
+            return file_names
+        os.listdir = listdir_then_remove
+        try:
+            eq_(cache.usage(), [(0, 0, path.basename(object_dir), cache.objects_dir)])
+        finally:
+            os.listdir = listdir
+    finally:
+        rmtree(temp_dir)
+
+def test_prefetch():
+    temp_dir = tempfile.mkdtemp()
+    try:
+        (client, cache) = make_cache(temp_dir)
+        gs_uris = []
+        for i in range(4):
+            write_file(path.join(client.directory, "bucket", "%d.vcf" % i), b"variants %d" % i)
+            gs_uris.append("gs://bucket/%d.vcf" % i)
+        cache.prefetch(gs_uris)
+        eq_([read_file(cache.local_path(gs_uri)) for gs_uri in gs_uris],
+            [b"variants %d" % i for i in range(4)])
+        eq_(client.n_range_reads, 4)
+    finally:
+        rmtree(temp_dir)
+
+def test_cohort_gs_inputs():
+    temp_dir = tempfile.mkdtemp()
+    try:
+        cohort = make_simple_cohort()
+        cohort.cache_results = False
+        (client, cohort._gs_cache) = make_cache(temp_dir)
+        for patient in cohort:
+            file_path = path.join(client.directory, "bucket", patient.id, "genes.fpkm_tracking")
+            write_file(file_path, b"")
+            pd.DataFrame({
+                "tracking_id": ["G1"],
+                "gene_id": ["G1"],
+                "gene_short_name": ["TP53"],
+                "locus": "1:1-100",
+                "FPKM": [float(patient.id)],
+                "FPKM_conf_lo": 0.0,
+                "FPKM_conf_hi": 5.0,
+                "FPKM_status": ["OK"]}).to_csv(file_path, sep="\t", index=False)
+            patient.tumor_sample = Sample(
+                is_tumor=True, cufflinks_path="gs://bucket/%s/genes.fpkm_tracking" % patient.id)
+        df_cufflinks = cohort.load_cufflinks()
+        eq_(sorted(df_cufflinks["FPKM"]), sorted(float(patient.id) for patient in cohort))
+        eq_(client.n_range_reads, len(cohort))
+        cohort.load_cufflinks()
+        eq_(client.n_range_reads, len(cohort))
+        eq_(cohort.input_fingerprints(cohort[0], "cufflinks")[0]["path"],
+            cohort[0].tumor_sample.cufflinks_path)
+    finally:
+        rmtree(temp_dir)
+
+def test_bam_region_path():
+    temp_dir = tempfile.mkdtemp()
+    try:
+        (client, cache) = make_cache(temp_dir)
+        (bam, bai, _, _) = make_bam()
+        write_file(path.join(client.directory, "bucket", "rna.bam"), bam)
+        write_file(path.join(client.directory, "bucket", "rna.bam.bai"), bai)
+        sparse_path = cache.bam_region_path("gs://bucket/rna.bam", [("1", 101, 200)])
+        ok_(sparse_path.startswith(cache.sparse_dir))
+        ok_(path.exists(sparse_path + ".bai"))
+        # Once the whole BAM is cached, it is used instead.
+        whole_path = cache.local_path("gs://bucket/rna.bam", companions=[".bai"])
+        eq_(cache.bam_region_path("gs://bucket/rna.bam", [("1", 101, 200)]), whole_path)
+    finally:
+        rmtree(temp_dir)
+
+def test_pinned_bam_regions_kept():
+    temp_dir = tempfile.mkdtemp()
+    try:
+        (client, cache) = make_cache(temp_dir)
+        (bam, bai, _, _) = make_bam()
+        write_file(path.join(client.directory, "bucket", "rna.bam"), bam)
+        write_file(path.join(client.directory, "bucket", "rna.bam.bai"), bai)
+        for i in range(3):
+            write_file(path.join(client.directory, "bucket", "%d.tsv" % i), str(i).encode() * 100)
+        sparse_path = cache.bam_region_path("gs://bucket/rna.bam", [("1", 101, 200)], pin=True)
+        utime(sparse_path, (0, 0))
+        # Room for the sparse BAM and two more objects.
+        cache.max_bytes = sum(n_bytes for (_, n_bytes, _, _) in cache.usage()) + 250
+        other_cache = GoogleStorageCache(cache.cache_dir, max_bytes=cache.max_bytes, gcio=cache.gcio)
+        for i in range(3):
+            other_cache.local_path("gs://bucket/%d.tsv" % i)
+        ok_(path.exists(sparse_path))
+        cache.unpin(sparse_path)
+        write_file(path.join(client.directory, "bucket", "3.tsv"), b"3" * 100)
+        other_cache.local_path("gs://bucket/3.tsv")
+        ok_(not path.exists(sparse_path))
+    finally:
+        rmtree(temp_dir)
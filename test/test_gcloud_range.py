@@ -0,0 +1,209 @@
+# Copyright (c) 2017. Mount Sinai School of Medicine
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import gzip
+from os import path
+from shutil import rmtree
+import random
+import struct
+import tempfile
+from unittest import SkipTest
+import zlib
+
+from nose.tools import eq_, ok_
+
+from cohorts.io.gcloud_range import (GoogleStorageRangeFile, open_gs, reg2bins, read_bai,
+                                     bai_chunks, fetch_bam_regions, BGZF_EOF)
+from cohorts.io.gcloud_storage import GoogleStorageIO, GoogleStorageFile
+
+from .test_gcloud_storage import FakeClient, write_file, read_file, CONTENTS
+
+def bgzf_block(data):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, -15)
+    compressed = compressor.compress(data) + compressor.flush()
+    header = struct.pack("<4BI2BH2BHH", 31, 139, 8, 4, 0, 0, 255, 6, 66, 67, 2,
+                         len(compressed) + 25)
+    return header + compressed + struct.pack("<II", zlib.crc32(data) & 0xFFFFFFFF, len(data))
+
+def make_bam():
+    """
+    A BAM-like file: a real header, and blocks of placeholder "alignments" for two
+    regions of chr1, separated by incompressible filler, with an index listing them.
+    """
+    rng = random.Random(1)
+    text = b"@SQ\tSN:chr1\tLN:1000000\n"
+    name = b"chr1\x00"
+    header = (b"BAM\x01" + struct.pack("<i", len(text)) + text + struct.pack("<i", 1) +
+              struct.pack("<i", len(name)) + name + struct.pack("<i", 1000000))
+    blocks = [bgzf_block(header), bgzf_block(b"A" * 1000)]
+    blocks.extend(bgzf_block(bytes(bytearray(rng.getrandbits(8) for _ in range(60000))))
+                  for _ in range(3))
+    blocks.append(bgzf_block(b"B" * 1000))
+    blocks.extend(bgzf_block(bytes(bytearray(rng.getrandbits(8) for _ in range(60000))))
+                  for _ in range(3))
+    blocks.append(BGZF_EOF)
+    offsets = [sum(len(block) for block in blocks[:i]) for i in range(len(blocks))]
+    # Region A is at [0, 16384), in bin 4681; region B at [500000, 516384), in bin 4681 + 30.
+    bins = [(4681, [(offsets[1] << 16, offsets[2] << 16)]),
+            (4681 + 30, [(offsets[5] << 16, offsets[6] << 16)])]
+    bai = b"BAI\x01" + struct.pack("<ii", 1, len(bins))
+    for (bin_number, chunks) in bins:
+        bai += struct.pack("<Ii", bin_number, len(chunks))
+        for chunk in chunks:
+            bai += struct.pack("<QQ", *chunk)
+    intervals = [offsets[1] << 16] * 30 + [offsets[5] << 16] * 2
+    bai += struct.pack("<i", len(intervals)) + struct.pack("<%dQ" % len(intervals), *intervals)
+    return (b"".join(blocks), bai, blocks, offsets)
+
+def make_pysam_bam(bam_path):
+    """
+    A real sorted and indexed BAM, written with pysam: 100bp reads with random
+    bases every 50bp along a 1Mb chr1, so it spans many BGZF blocks.
+    """
+    import pysam
+    rng = random.Random(1)
+    header = {"HD": {"VN": "1.0", "SO": "coordinate"},
+              "SQ": [{"SN": "chr1", "LN": 1000000}]}
+    with pysam.AlignmentFile(bam_path, "wb", header=header) as bam_file:
+        for (i, start) in enumerate(range(0, 1000000 - 100, 50)):
+            read = pysam.AlignedSegment()
+            read.query_name = "read%d" % i
+            read.reference_id = 0
+            read.reference_start = start
+            read.mapping_quality = 60
+            read.cigartuples = [(0, 100)]
+            read.query_sequence = "".join(rng.choice("ACGT") for _ in range(100))
+            read.query_qualities = pysam.qualitystring_to_array("I" * 100)
+            bam_file.write(read)
+    pysam.index(bam_path)
+
+def test_range_file():
+    temp_dir = tempfile.mkdtemp()
+    try:
+        client = FakeClient(temp_dir)
+        write_file(path.join(temp_dir, "bucket", "file.bin"), CONTENTS)
+        f = GoogleStorageRangeFile(GoogleStorageIO(client=client), "gs://bucket/file.bin",
+                                   block_size=1000, cache_blocks=4, read_ahead=2)
+        eq_(f.size, len(CONTENTS))
+        f.seek(5000)
+        eq_(f.read(10), CONTENTS[5000:5010])
+        eq_(f.tell(), 5010)
+        eq_(client.n_range_reads, 1)
+        # Cached.
+        eq_(f.read_range(5500, 5600), CONTENTS[5500:5600])
+        eq_(client.n_range_reads, 1)
+        # Reading on into the next block also fetches the two after it.
+        eq_(f.read_range(5900, 7100), CONTENTS[5900:7100])
+        eq_(client.n_range_reads, 2)
+        eq_(f.read_range(7500, 8500), CONTENTS[7500:8500])
+        eq_(client.n_range_reads, 2)
+        eq_(f.bytes_transferred, 4000)
+        f.seek(-6, 2)
+        eq_(f.read(), CONTENTS[-6:])
+        eq_(f.read(), b"")
+    finally:
+        rmtree(temp_dir)
+
+def test_open_gs():
+    temp_dir = tempfile.mkdtemp()
+    try:
+        client = FakeClient(temp_dir)
+        gcio = GoogleStorageIO(client=client)
+        lines = ["##fileformat=VCFv4.1\n"] + ["1\t%d\t.\tA\tT\n" % i for i in range(1000)]
+        write_file(path.join(temp_dir, "bucket", "a.vcf"), "".join(lines).encode("ascii"))
+        write_file(path.join(temp_dir, "bucket", "a.vcf.gz"), gzip.compress("".join(lines).encode("ascii")))
+        with open_gs(gcio, "gs://bucket/a.vcf") as f:
+            eq_(list(f), lines)
+        with open_gs(gcio, "gs://bucket/a.vcf.gz", decompress=True) as f:
+            eq_(list(f), lines)
+        # Read-only GoogleStorageFiles stream rather than download, and
+        # return the object's bytes as they are.
+        with GoogleStorageFile(gcio, "gs://bucket/a.vcf", "r") as f:
+            eq_(f.readline(), lines[0])
+        with GoogleStorageFile(gcio, "gs://bucket/a.vcf.gz", "rb") as f:
+            eq_(f.read(), read_file(path.join(temp_dir, "bucket", "a.vcf.gz")))
+    finally:
+        rmtree(temp_dir)
+
+def test_reg2bins():
+    eq_(reg2bins(0, 1), [0, 1, 9, 73, 585, 4681])
+    eq_(reg2bins(16384, 16385), [0, 1, 9, 73, 585, 4682])
+
+def test_bai_chunks():
+    (_, bai, _, offsets) = make_bam()
+    index = read_bai(bai)
+    eq_(len(index), 1)
+    eq_(bai_chunks(index[0], 100, 200), [(offsets[1] << 16, offsets[2] << 16)])
+    eq_(bai_chunks(index[0], 500100, 500200), [(offsets[5] << 16, offsets[6] << 16)])
+    eq_(bai_chunks(index[0], 200000, 200100), [])
+
+def test_fetch_bam_regions():
+    temp_dir = tempfile.mkdtemp()
+    try:
+        (bam, bai, blocks, offsets) = make_bam()
+        client = FakeClient(path.join(temp_dir, "gs"))
+        write_file(path.join(client.directory, "bucket", "rna.bam"), bam)
+        write_file(path.join(client.directory, "bucket", "rna.bam.bai"), bai)
+        gcio = GoogleStorageIO(client=client)
+        local_path = path.join(temp_dir, "rna.bam")
+
+        n_bytes = fetch_bam_regions(gcio, "gs://bucket/rna.bam", local_path, [("1", 101, 200)])
+        ok_(n_bytes < len(bam) / 2)
+        local_bam = read_file(local_path)
+        eq_(len(local_bam), len(bam))
+        eq_(read_file(local_path + ".bai"), bai)
+        for i in [0, 1, len(blocks) - 1]:
+            eq_(local_bam[offsets[i]:offsets[i] + len(blocks[i])], blocks[i])
+        eq_(local_bam[offsets[5]:offsets[6]], b"\x00" * (offsets[6] - offsets[5]))
+
+        # Only the missing blocks are fetched for another region.
+        n_bytes = fetch_bam_regions(gcio, "gs://bucket/rna.bam", local_path,
+                                    [("chr1", 101, 200), ("chr1", 500101, 500200)])
+        ok_(n_bytes <= len(blocks[5]) + (1 << 16))
+        local_bam = read_file(local_path)
+        eq_(local_bam[offsets[5]:offsets[6]], blocks[5])
+        eq_(fetch_bam_regions(gcio, "gs://bucket/rna.bam", local_path, [("1", 500101, 500200)]), 0)
+    finally:
+        rmtree(temp_dir)
+
+def test_fetch_bam_regions_pysam():
+    try:
+        import pysam
+    except ImportError:
+        raise SkipTest("pysam is not installed")
+    temp_dir = tempfile.mkdtemp()
+    try:
+        client = FakeClient(path.join(temp_dir, "gs"))
+        bam_path = path.join(client.directory, "bucket", "rna.bam")
+        write_file(bam_path, b"")
+        make_pysam_bam(bam_path)
+        gcio = GoogleStorageIO(client=client)
+        local_path = path.join(temp_dir, "rna.bam")
+
+        def read_names(bam_path, contig, start, end):
+            with pysam.AlignmentFile(bam_path, "rb") as bam_file:
+                return [read.query_name for read in bam_file.fetch(contig, start - 1, end)]
+
+        regions = [("chr1", 100101, 100200), ("chr1", 800101, 800200)]
+        n_bytes = fetch_bam_regions(gcio, "gs://bucket/rna.bam", local_path, regions[:1])
+        ok_(n_bytes < path.getsize(bam_path))
+        expected = read_names(bam_path, *regions[0])
+        ok_(len(expected) > 0)
+        eq_(read_names(local_path, *regions[0]), expected)
+
+        fetch_bam_regions(gcio, "gs://bucket/rna.bam", local_path, regions)
+        for region in regions:
+            eq_(read_names(local_path, *region), read_names(bam_path, *region))
+    finally:
+        rmtree(temp_dir)
@@ -0,0 +1,331 @@
+# Copyright (c) 2017. Mount Sinai School of Medicine
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Tests of Google Storage transfers against a local stand-in for the
+google-cloud-storage client, with buckets as directories.
+"""
+
+from os import listdir, makedirs, path
+from shutil import rmtree
+import tempfile
+import threading
+
+from nose.tools import eq_, ok_, raises
+
+from cohorts.io.gcloud_storage import (GoogleStorageIO, GoogleStorageFile,
+                                       GoogleStorageIOError, crc32c_of_file)
+
+class FakeBlob(object):
+    def __init__(self, bucket, name, chunk_size=None):
+        self.bucket = bucket
+        self.name = name
+        self.chunk_size = chunk_size
+        self.path = path.join(bucket.directory, name)
+        self.reload()
+
+    def reload(self, client=None):
+        exists = path.exists(self.path)
+        self.size = path.getsize(self.path) if exists else None
+        self.generation = int(path.getmtime(self.path) * 1e6) if exists else None
+        self.crc32c = crc32c_of_file(self.path) if exists else None
+
+    def download_as_bytes(self, client=None, start=None, end=None):
+        self.bucket.client.n_range_reads += 1
+        if self.bucket.client.fail_next_reads > 0:
+            self.bucket.client.fail_next_reads -= 1
+            raise self.bucket.client.failure
+        with open(self.path, "rb") as f:
+            f.seek(start)
+            return f.read(end - start + 1)
+
+    def create_resumable_upload_session(self, size=None, client=None):
+        session_url = "session://%s/%d" % (self.path, len(self.bucket.client.sessions))
+        self.bucket.client.sessions[session_url] = (self.path, bytearray())
+        return session_url
+
+class FakeResponse(object):
+    def __init__(self, status_code, headers=None):
+        self.status_code = status_code
+        self.headers = headers or {}
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise FakeHTTPError(self.status_code)
+
+class FakeSession(object):
+    """Resumable upload sessions, as the client's authorized HTTP session sees them."""
+    def __init__(self, client):
+        self.client = client
+
+    def put(self, url, data, headers):
+        (file_path, received) = self.client.sessions[url]
+        (byte_range, size) = headers["Content-Range"][len("bytes "):].split("/")
+        if byte_range != "*" and int(byte_range.split("-")[0]) == len(received):
+            received.extend(data)
+            self.client.n_uploaded_bytes += len(data)
+        if len(received) == int(size):
+            write_file(file_path, bytes(received))
+            response = FakeResponse(200)
+        elif len(received) > 0:
+            response = FakeResponse(308, {"Range": "bytes=0-%d" % (len(received) - 1)})
+        else:
+            response = FakeResponse(308)
+        if len(data) > 0 and self.client.fail_next_uploads > 0:
+            # The chunk arrived, but the response was lost.
+            self.client.fail_next_uploads -= 1
+            raise self.client.failure
+        return response
+
+class FakeBucket(object):
+    def __init__(self, client, name):
+        self.client = client
+        self.name = name
+        self.directory = path.join(client.directory, name)
+
+    def blob(self, name, chunk_size=None):
+        return FakeBlob(self, name, chunk_size=chunk_size)
+
+    def get_blob(self, name):
+        blob = self.blob(name)
+        return blob if blob.size is not None else None
+
+class FakeClient(object):
+    def __init__(self, directory):
+        self.directory = directory
+        self.n_get_bucket = 0
+        self.n_range_reads = 0
+        self.fail_next_reads = 0
+        self.fail_next_uploads = 0
+        self.failure = ConnectionError("Simulated transient failure")
+        self.sessions = {}
+        self.n_uploaded_bytes = 0
+        self._http = FakeSession(self)
+
+    def get_bucket(self, name):
+        self.n_get_bucket += 1
+        return FakeBucket(self, name)
+
+def write_file(file_path, contents):
+    if not path.exists(path.dirname(file_path)):
+        makedirs(path.dirname(file_path))
+    with open(file_path, "wb") as f:
+        f.write(contents)
+
+def read_file(file_path):
+    with open(file_path, "rb") as f:
+        return f.read()
+
+CONTENTS = bytes(bytearray(range(256))) * 41
+
+def test_crc32c_of_file():
+    temp_dir = tempfile.mkdtemp()
+    try:
+        file_path = path.join(temp_dir, "check")
+        write_file(file_path, b"123456789")
+        # The standard CRC32C check value, 0xE3069283.
+        eq_(crc32c_of_file(file_path), "4waSgw==")
+    finally:
+        rmtree(temp_dir)
+
+def test_download_slices():
+    temp_dir = tempfile.mkdtemp()
+    try:
+        client = FakeClient(path.join(temp_dir, "gs"))
+        write_file(path.join(client.directory, "bucket", "data", "file.bin"), CONTENTS)
+        gcio = GoogleStorageIO(client=client)
+        local_path = path.join(temp_dir, "file.bin")
+        eq_(gcio.download_to_path("gs://bucket/data/file.bin", local_path,
+                                  slice_size=1000, n_jobs=4), local_path)
+        eq_(read_file(local_path), CONTENTS)
+        eq_(client.n_range_reads, 11)
+        # No partial files are left behind.
+        eq_(sorted(listdir(temp_dir)), ["file.bin", "gs"])
+
+        # Bucket handles are reused.
+        gcio.download_to_path("gs://bucket/data/file.bin", local_path)
+        eq_(client.n_get_bucket, 1)
+    finally:
+        rmtree(temp_dir)
+
+def test_download_retries():
+    temp_dir = tempfile.mkdtemp()
+    try:
+        client = FakeClient(path.join(temp_dir, "gs"))
+        write_file(path.join(client.directory, "bucket", "file.bin"), CONTENTS)
+        gcio = GoogleStorageIO(client=client)
+        client.fail_next_reads = 1
+        local_path = path.join(temp_dir, "file.bin")
+        gcio.download_to_path("gs://bucket/file.bin", local_path, slice_size=1000, n_jobs=1)
+        eq_(read_file(local_path), CONTENTS)
+        eq_(client.n_range_reads, 12)
+    finally:
+        rmtree(temp_dir)
+
+class FakeHTTPError(Exception):
+    def __init__(self, code):
+        Exception.__init__(self, "HTTP %d" % code)
+        self.code = code
+
+def test_download_permanent_failure():
+    temp_dir = tempfile.mkdtemp()
+    try:
+        client = FakeClient(path.join(temp_dir, "gs"))
+        write_file(path.join(client.directory, "bucket", "file.bin"), CONTENTS)
+        gcio = GoogleStorageIO(client=client)
+        client.fail_next_reads = 1
+        client.failure = FakeHTTPError(403)
+        try:
+            gcio.download_to_path("gs://bucket/file.bin", path.join(temp_dir, "file.bin"), n_jobs=1)
+            ok_(False)
+        except GoogleStorageIOError:
+            pass
+        # Not retried.
+        eq_(client.n_range_reads, 1)
+
+        client.fail_next_reads = 1
+        client.failure = FakeHTTPError(503)
+        gcio.download_to_path("gs://bucket/file.bin", path.join(temp_dir, "file.bin"), n_jobs=1)
+        eq_(client.n_range_reads, 3)
+    finally:
+        rmtree(temp_dir)
+
+def test_concurrent_downloads():
+    temp_dir = tempfile.mkdtemp()
+    try:
+        client = FakeClient(path.join(temp_dir, "gs"))
+        write_file(path.join(client.directory, "bucket", "file.bin"), CONTENTS)
+        gcio = GoogleStorageIO(client=client)
+        local_path = path.join(temp_dir, "file.bin")
+        threads = [threading.Thread(
+            target=gcio.download_to_path, args=("gs://bucket/file.bin", local_path),
+            kwargs=dict(slice_size=1000, n_jobs=2)) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        eq_(read_file(local_path), CONTENTS)
+        eq_(sorted(listdir(temp_dir)), ["file.bin", "gs"])
+    finally:
+        rmtree(temp_dir)
+
+def test_download_resumes():
+    temp_dir = tempfile.mkdtemp()
+    try:
+        client = FakeClient(path.join(temp_dir, "gs"))
+        write_file(path.join(client.directory, "bucket", "file.bin"), CONTENTS)
+        gcio = GoogleStorageIO(client=client)
+        local_path = path.join(temp_dir, "file.bin")
+        client.fail_next_reads = 100
+        try:
+            gcio.download_to_path("gs://bucket/file.bin", local_path,
+                                  slice_size=1000, n_jobs=1, max_retries=0)
+        except GoogleStorageIOError:
+            pass
+        ok_(not path.exists(local_path))
+
+        # Let the first 5 slices through, then fail.
+        client.fail_next_reads = 0
+        download_as_bytes = FakeBlob.download_as_bytes
+        def failing_download(blob, client=None, start=None, end=None):
+            if start >= 5000:
+                raise ConnectionError("Simulated transient failure")
+            return download_as_bytes(blob, client=client, start=start, end=end)
+        FakeBlob.download_as_bytes = failing_download
+        try:
+            gcio.download_to_path("gs://bucket/file.bin", local_path,
+                                  slice_size=1000, n_jobs=1, max_retries=0)
+        except GoogleStorageIOError:
+            pass
+        finally:
+            FakeBlob.download_as_bytes = download_as_bytes
+        ok_(not path.exists(local_path))
+
+        # Only the remaining slices are downloaded.
+        client.n_range_reads = 0
+        gcio.download_to_path("gs://bucket/file.bin", local_path, slice_size=1000, n_jobs=1)
+        eq_(client.n_range_reads, 6)
+        eq_(read_file(local_path), CONTENTS)
+    finally:
+        rmtree(temp_dir)
+
+@raises(GoogleStorageIOError)
+def test_download_missing():
+    temp_dir = tempfile.mkdtemp()
+    try:
+        gcio = GoogleStorageIO(client=FakeClient(temp_dir))
+        gcio.download_to_path("gs://bucket/missing.txt", path.join(temp_dir, "missing.txt"))
+    finally:
+        rmtree(temp_dir)
+
+def test_upload_and_download_many():
+    temp_dir = tempfile.mkdtemp()
+    try:
+        client = FakeClient(path.join(temp_dir, "gs"))
+        gcio = GoogleStorageIO(client=client)
+        local_paths = [path.join(temp_dir, "local", "%d.txt" % i) for i in range(5)]
+        for (i, local_path) in enumerate(local_paths):
+            write_file(local_path, b"file %d" % i)
+        uris = ["gs://bucket/uploads/%d.txt" % i for i in range(5)]
+        gcio.upload_many(list(zip(local_paths, uris)), n_jobs=3)
+        eq_(client.n_get_bucket, 1)
+
+        download_paths = [path.join(temp_dir, "%d.txt" % i) for i in range(5)]
+        eq_(gcio.download_many(list(zip(uris, download_paths)), n_jobs=3), download_paths)
+        eq_([read_file(download_path) for download_path in download_paths],
+            [b"file %d" % i for i in range(5)])
+    finally:
+        rmtree(temp_dir)
+
+def test_upload_resumes():
+    temp_dir = tempfile.mkdtemp()
+    try:
+        client = FakeClient(path.join(temp_dir, "gs"))
+        gcio = GoogleStorageIO(client=client)
+        local_path = path.join(temp_dir, "file.bin")
+        write_file(local_path, CONTENTS)
+        client.fail_next_uploads = 2
+        gcio.upload_file(local_path, "gs://bucket/file.bin", chunk_size=1000)
+        eq_(read_file(path.join(client.directory, "bucket", "file.bin")), CONTENTS)
+        # Failed chunks aren't sent again: each upload continues from what was committed.
+        eq_(client.n_uploaded_bytes, len(CONTENTS))
+    finally:
+        rmtree(temp_dir)
+
+@raises(GoogleStorageIOError)
+def test_upload_permanent_failure():
+    temp_dir = tempfile.mkdtemp()
+    try:
+        client = FakeClient(path.join(temp_dir, "gs"))
+        gcio = GoogleStorageIO(client=client)
+        local_path = path.join(temp_dir, "file.bin")
+        write_file(local_path, CONTENTS)
+        client.failure = FakeHTTPError(403)
+        client.fail_next_uploads = 1
+        gcio.upload_file(local_path, "gs://bucket/file.bin", chunk_size=1000)
+    finally:
+        rmtree(temp_dir)
+
+def test_google_storage_file():
+    temp_dir = tempfile.mkdtemp()
+    try:
+        client = FakeClient(path.join(temp_dir, "gs"))
+        write_file(path.join(client.directory, "bucket", "notes.txt"), b"hello")
+        gcio = GoogleStorageIO(client=client)
+        with GoogleStorageFile(gcio, "gs://bucket/notes.txt", "r+") as f:
+            eq_(f.read(), "hello")
+            f.write(" world")
+        eq_(read_file(path.join(client.directory, "bucket", "notes.txt")), b"hello world")
+    finally:
+        rmtree(temp_dir)
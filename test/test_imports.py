@@ -0,0 +1,29 @@
+# Copyright (c) 2017. Mount Sinai School of Medicine
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import subprocess
+import sys
+
+from nose.tools import eq_
+
+LAZY_MODULES = ["matplotlib", "seaborn", "sqlalchemy", "vap", "pysam", "isovar",
+                "topiary", "mhctools", "lifelines", "patsy", "sklearn"]
+
+def test_import_is_lazy():
+    # Run in a fresh interpreter, since other tests import these modules.
+    code = "import json, sys; import cohorts; print(json.dumps([m for m in %r if m in sys.modules]))" % (
+        LAZY_MODULES,)
+    imported = json.loads(subprocess.check_output([sys.executable, "-c", code]).decode("utf-8"))
+    eq_(imported, [])
@@ -0,0 +1,130 @@
+# Copyright (c) 2017. Mount Sinai School of Medicine
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from nose.tools import eq_, ok_
+
+import pandas as pd
+from mhctools import BindingPrediction
+from topiary.sequence_helpers import contains_mutant_residues
+from varcode import Variant, VariantCollection
+
+from cohorts.isovar_utils import (partition_variants, isovar_cache_file_name,
+                                  parse_isovar_cache_file_name, trim_protein_sequences,
+                                  expressed_variant_index, variant_key,
+                                  mutant_binding_predictions)
+
+def test_partition_variants():
+    variants = VariantCollection([
+        Variant(contig=1, start=1000, ref="A", alt="T", ensembl=75),
+        Variant(contig=1, start=2500000, ref="A", alt="T", ensembl=75),
+        Variant(contig=2, start=1000, ref="C", alt="G", ensembl=75),
+        Variant(contig=1, start=2000, ref="G", alt="C", ensembl=75)])
+
+    by_contig = partition_variants(variants)
+    eq_(list(by_contig.keys()), [("1", 0), ("2", 0)])
+    eq_(len(by_contig[("1", 0)]), 3)
+
+    by_window = partition_variants(variants, window_size=1000000)
+    eq_(list(by_window.keys()), [("1", 0), ("1", 2), ("2", 0)])
+    eq_([len(window) for window in by_window.values()], [2, 1, 1])
+    # Windows cover every variant, in the collection's order.
+    eq_([variant for window in by_window.values() for variant in window], list(variants))
+
+def test_isovar_cache_file_name():
+    file_name = isovar_cache_file_name("union", 21, 3, 1)
+    eq_(parse_isovar_cache_file_name(file_name), dict(
+        merge_type="union",
+        protein_sequence_length=21,
+        min_variant_sequence_coverage=3,
+        max_protein_sequences_per_variant=1))
+    eq_(parse_isovar_cache_file_name("union-variants.pkl"), None)
+
+def test_trim_protein_sequences():
+    df_isovar = pd.DataFrame({
+        "chr": ["1", "1", "2"],
+        "pos": [1000, 2000, 3000],
+        "ref": ["A", "G", "C"],
+        "alt": ["T", "C", "G"],
+        "amino_acids": ["A" * 10 + "V" + "A" * 10, "A" * 15 + "V" * 6, "AAVAA"],
+        "variant_aa_interval_start": [10, 15, 2],
+        "variant_aa_interval_end": [11, 21, 3],
+        "ends_with_stop_codon": [True, False, True]})
+    trimmed = trim_protein_sequences(df_isovar, 15)
+    # Windows are centered on the variant residues, rather than cut from the right.
+    eq_(list(trimmed["pos"]), [1000, 2000, 3000])
+    eq_(list(trimmed["amino_acids"]), ["A" * 7 + "V" + "A" * 7, "A" * 5 + "V" * 6, "AAVAA"])
+    eq_(list(trimmed["variant_aa_interval_start"]), [7, 5, 2])
+    eq_(list(trimmed["variant_aa_interval_end"]), [8, 11, 3])
+    eq_(list(trimmed["ends_with_stop_codon"]), [False, False, True])
+
+def test_trim_protein_sequences_edges():
+    df_isovar = pd.DataFrame({
+        "chr": ["1", "1"],
+        "pos": [1000, 2000],
+        "ref": ["A", "G"],
+        "alt": ["T", "C"],
+        "amino_acids": ["AVAAAAAAAAAAAAAAAAAAA", "A" * 5 + "V" * 20],
+        "variant_aa_interval_start": [1, 5],
+        "variant_aa_interval_end": [2, 25],
+        "ends_with_stop_codon": [False, True]})
+    trimmed = trim_protein_sequences(df_isovar, 11)
+    # Isovar wouldn't have translated more than 5 residues after the variant.
+    eq_(list(trimmed["amino_acids"]), ["AVAAAAA", "V" * 11])
+    eq_(list(trimmed["variant_aa_interval_start"]), [1, 0])
+    eq_(list(trimmed["variant_aa_interval_end"]), [2, 11])
+    eq_(list(trimmed["ends_with_stop_codon"]), [False, False])
+
+def test_expressed_variant_index():
+    # As read back from a cached CSV: integer contigs, and NaN for empty alleles.
+    df_isovar = pd.DataFrame({
+        "chr": [1, 1, "X"],
+        "pos": [1000, 1000, 5000],
+        "ref": ["A", "A", "CT"],
+        "alt": ["T", "T", float("nan")],
+        "amino_acids": ["AVA", "AVV", "KL"]})
+    index = expressed_variant_index(df_isovar)
+    eq_(index, set([("1", 1000, "A", "T"), ("X", 5000, "CT", "")]))
+    ok_(variant_key(Variant(contig=1, start=1000, ref="A", alt="T", ensembl=75)) in index)
+    ok_(variant_key(Variant(contig=1, start=1000, ref="A", alt="G", ensembl=75)) not in index)
+
+def test_mutant_binding_predictions():
+    df_isovar = pd.DataFrame({
+        "amino_acids": ["AAAAAVAAAAA", "CCCCCCCWWW"],
+        "variant_aa_interval_start": [5, 7],
+        "variant_aa_interval_end": [6, 10]})
+    binding_predictions = []
+    for (row_id, row) in df_isovar.iterrows():
+        for length in [3, 4]:
+            for offset in range(len(row["amino_acids"]) - length + 1):
+                binding_predictions.append(BindingPrediction(
+                    source_sequence_key=row_id,
+                    source_sequence=row["amino_acids"],
+                    offset=offset,
+                    allele="HLA-A*02:01",
+                    peptide=row["amino_acids"][offset:offset + length],
+                    length=length,
+                    value=100.0 * (offset + 1),
+                    measure=None,
+                    percentile_rank=None,
+                    prediction_method_name="test"))
+    expected = [
+        prediction for prediction in binding_predictions
+        if prediction.value <= 500 and contains_mutant_residues(
+            peptide_start_in_protein=prediction.offset,
+            peptide_length=len(prediction.peptide),
+            mutation_start_in_protein=df_isovar["variant_aa_interval_start"][prediction.source_sequence_key],
+            mutation_end_in_protein=df_isovar["variant_aa_interval_end"][prediction.source_sequence_key])]
+    ok_(len(expected) > 0)
+    eq_(mutant_binding_predictions(binding_predictions, df_isovar, ic50_cutoff=500), expected)
+    eq_(mutant_binding_predictions([], df_isovar, ic50_cutoff=500), [])
@@ -0,0 +1,44 @@
+# Copyright (c) 2017. Mount Sinai School of Medicine
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import numpy as np
+import pandas as pd
+from nose.tools import eq_, ok_
+from sklearn.metrics import roc_auc_score
+
+from cohorts.model import bootstrap_auc, bootstrap_auc_scores
+
+def test_bootstrap_auc_scores():
+    random_state = np.random.RandomState(0)
+    # Few distinct values, so that resamples have ties.
+    values = random_state.randint(0, 5, size=30).astype(float)
+    labels = random_state.randint(0, 2, size=30)
+    scores = bootstrap_auc_scores(values, labels, n_bootstrap=200, random_state=1)
+
+    sample_indices = np.random.RandomState(1).randint(len(values), size=(200, len(values)))
+    expected = [roc_auc_score(labels[indices], values[indices])
+                if len(set(labels[indices])) == 2 else 0
+                for indices in sample_indices]
+    ok_(np.allclose(scores, expected))
+
+def test_bootstrap_auc_reproducible():
+    df = pd.DataFrame({"value": [1.0, 2.0, np.nan, 4.0, 5.0, 6.0],
+                       "is_benefit": [False, True, True, False, True, True]})
+    scores = bootstrap_auc(df.copy(), "value", "is_benefit", n_bootstrap=50, random_state=7)
+    eq_(len(scores), 50)
+    ok_(np.array_equal(
+        scores, bootstrap_auc(df.copy(), "value", "is_benefit", n_bootstrap=50, random_state=7)))
+
+def test_bootstrap_auc_single_class():
+    eq_(list(bootstrap_auc_scores([1.0, 2.0, 3.0], [1, 1, 1], n_bootstrap=3)), [0, 0, 0])
@@ -0,0 +1,66 @@
+# Copyright (c) 2017. Mount Sinai School of Medicine
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import numpy as np
+from nose.tools import eq_, ok_
+from lifelines.statistics import logrank_test
+from scipy.stats import mannwhitneyu
+
+from cohorts.permutation import (LogrankStatistic, logrank_permutation_test,
+                                 mann_whitney_permutation_test)
+
+def make_survival_data(n=30, seed=0):
+    random_state = np.random.RandomState(seed)
+    # Few distinct durations, so that there are ties.
+    durations = random_state.randint(1, 12, size=n)
+    events = random_state.rand(n) > 0.3
+    groups = random_state.rand(n) > 0.5
+    return durations, events, groups
+
+def test_logrank_statistic():
+    durations, events, groups = make_survival_data()
+    statistic = LogrankStatistic(durations, events)
+    expected = logrank_test(durations[groups], durations[~groups],
+                            event_observed_A=events[groups],
+                            event_observed_B=events[~groups]).test_statistic
+    ok_(np.isclose(statistic(groups), expected))
+    # A batch of labelings gives the same statistics as one labeling at a time.
+    labelings = np.random.RandomState(1).rand(5, len(groups)) > 0.5
+    ok_(np.allclose(statistic(labelings), [statistic(labeling) for labeling in labelings]))
+
+def test_logrank_permutation_test():
+    durations, events, groups = make_survival_data()
+    results = logrank_permutation_test(durations, events, groups, n_permutations=500, random_state=0)
+    eq_(results.n_permutations, 500)
+    ok_(0 < results.p_value <= 1)
+    eq_(results, logrank_permutation_test(durations, events, groups, n_permutations=500,
+                                          random_state=0, batch_size=64))
+    # Patients with unknown durations or events are left out.
+    with_missing = logrank_permutation_test(
+        np.append(durations, [np.nan, 10.0]), np.append(events.astype(np.float64), [1.0, np.nan]),
+        np.append(groups, [True, False]), n_permutations=500, random_state=0)
+    eq_(with_missing, results)
+
+def test_mann_whitney_permutation_test():
+    random_state = np.random.RandomState(0)
+    values = random_state.randn(20)
+    groups = np.array([True, False] * 10)
+    values[groups] += 2
+    results = mann_whitney_permutation_test(values, groups, n_permutations=2000, random_state=0)
+    U, _ = mannwhitneyu(values[groups], values[~groups], alternative="two-sided")
+    eq_(results.statistic, U)
+    ok_(results.p_value < 0.01)
+    less = mann_whitney_permutation_test(values, groups, n_permutations=2000, alternative="less",
+                                         random_state=0)
+    ok_(less.p_value > 0.9)
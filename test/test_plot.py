@@ -17,7 +17,8 @@ from __future__ import print_function
 import pandas as pd
 from nose.tools import eq_, ok_
 
-from cohorts.plot import mann_whitney_plot
+from cohorts.plot import mann_whitney_plot, fishers_exact_plot, roc_curve_plot
+from cohorts.survival import plot_kmf
 
 def test_mann_whitney():
     data = pd.DataFrame({"distribution": range(1, 7),
@@ -32,3 +33,19 @@ def test_mann_whitney():
         data, "condition", "distribution", alternative="greater", skip_plot=True)
     eq_(p_default, p_two)
     ok_((p_default == p_less * 2) or (p_default == p_greater * 2))
+
+def test_skip_plot():
+    data = pd.DataFrame({"distribution": range(1, 9),
+                         "condition": [True, False] * 4,
+                         "other_condition": [True, True, False, False] * 2,
+                         "os": [10, 20, 30, 40, 50, 60, 70, 80],
+                         "deceased": [True, False] * 4})
+    results = fishers_exact_plot(data, "condition", "other_condition", skip_plot=True)
+    eq_(results.plot, None)
+    ok_(0 <= results.p_value <= 1)
+    mean_auc, plot = roc_curve_plot(data, "distribution", "condition", bootstrap_samples=10, skip_plot=True)
+    eq_(plot, None)
+    results = plot_kmf(data, condition_col="distribution", censor_col="deceased", survival_col="os",
+                       skip_plot=True)
+    ok_(0 <= results.p_value <= 1)
+    eq_(len(results.desc), 2)
@@ -0,0 +1,85 @@
+# Copyright (c) 2017. Mount Sinai School of Medicine
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import print_function
+
+from os import path
+from shutil import rmtree
+from nose.tools import eq_, ok_, raises
+
+from cohorts.precompute import schedule_stages
+
+from .test_count import make_cohort, FILE_FORMAT_1
+from .data_generate import generate_vcfs
+
+def test_schedule_stages():
+    eq_(schedule_stages(["variants"]), [["variants"]])
+    eq_(schedule_stages(["nonsynonymous_effects"]),
+        [["variants"], ["effects"], ["nonsynonymous_effects"]])
+    eq_(schedule_stages(["expressed_neoantigens", "effects"]),
+        [["variants"], ["effects", "isovar"], ["expressed_neoantigens"]])
+
+@raises(ValueError)
+def test_unknown_stage():
+    schedule_stages(["variants", "bogus"])
+
+def test_precompute():
+    vcf_dir, cohort = None, None
+    try:
+        vcf_dir, cohort = make_cohort([FILE_FORMAT_1])
+        cohort.clear_caches()
+        stats = cohort.precompute(stages=["nonsynonymous_effects"]).set_index("stage")
+        eq_(stats.loc["variants", "computed"], 3)
+        eq_(stats.loc["effects", "computed"], 3)
+        # Written alongside the effects cache
+        eq_(stats.loc["nonsynonymous_effects", "skipped"], 3)
+        for patient in cohort:
+            ok_(cohort.has_cached("variant", patient.id))
+            ok_(cohort.has_cached("nonsynonymous_effect", patient.id))
+
+        # Everything is cached now, so a re-run does nothing
+        stats = cohort.precompute(stages=["effects"]).set_index("stage")
+        eq_(stats["computed"].sum(), 0)
+        eq_(stats.loc["effects", "skipped"], 3)
+    finally:
+        if cohort is not None:
+            cohort.clear_caches()
+        if vcf_dir is not None and path.exists(vcf_dir):
+            rmtree(vcf_dir)
+
+def test_cache_diff_stale_inputs():
+    vcf_dir, cohort = None, None
+    try:
+        vcf_dir, cohort = make_cohort([FILE_FORMAT_1])
+        cohort.clear_caches()
+        eq_(len(cohort.cache_diff(stages=["variants"])), 3)
+        cohort.precompute(stages=["effects"])
+        eq_(len(cohort.cache_diff(stages=["effects"])), 0)
+
+        # Rewrite one patient's VCF with fewer variants
+        patient = cohort.patient_from_id("5")
+        generate_vcfs(id_to_mutation_count={"5": 2},
+                      file_format=FILE_FORMAT_1,
+                      template_name="vcf_template_1.vcf")
+        diff = cohort.cache_diff(stages=["effects"])
+        eq_(set(diff["patient_id"]), set(["5"]))
+        eq_(set(diff["stage"]), set(["variants", "effects"]))
+        eq_(set(diff["status"]), set(["stale"]))
+        eq_(len(cohort.load_variants(patients=[patient])["5"]), 2)
+        eq_(len(cohort.cache_diff(stages=["variants"])), 0)
+    finally:
+        if cohort is not None:
+            cohort.clear_caches()
+        if vcf_dir is not None and path.exists(vcf_dir):
+            rmtree(vcf_dir)
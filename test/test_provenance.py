@@ -129,3 +129,35 @@ def test_summarize_provenance():
     finally:
         if cohort is not None:
             cohort.clear_caches()
+
+def test_verify_provenance():
+    cohort = None
+    try:
+        cohort = make_simple_cohort()
+        # Environment provenance is only generated once
+        ok_(cohort.generate_provenance() == cohort.generate_provenance())
+        ok_(cohort._provenance is not None)
+
+        df_empty = pd.DataFrame({"a": [1]})
+        cache_name = cohort.cache_names["variant"]
+        for patient_id in ["1", "4", "5"]:
+            cohort.save_to_cache(df_empty, cache_name, patient_id, "cached_file.csv")
+        with warnings.catch_warnings(record=True) as w:
+            warnings.simplefilter("always")
+            eq_(cohort.verify_provenance(), {})
+            eq_(len(w), 0)
+
+        # Alter two patients' provenance: one aggregate warning for the cache
+        for patient_id in ["1", "4"]:
+            patient_cache_dir = path.join(cohort.cache_dir, cache_name, patient_id)
+            provenance = cohort.load_provenance(patient_cache_dir)
+            provenance["pandas"] = "1.0.1"
+            cohort.save_provenance(patient_cache_dir, provenance)
+        with warnings.catch_warnings(record=True) as w:
+            warnings.simplefilter("always")
+            mismatches = cohort.verify_provenance("variant")
+            eq_(len(w), 1)
+        eq_(set(mismatches[cache_name].keys()), set(["1", "4"]))
+    finally:
+        if cohort is not None:
+            cohort.clear_caches()
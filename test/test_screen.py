@@ -0,0 +1,60 @@
+# Copyright (c) 2017. Mount Sinai School of Medicine
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import numpy as np
+import pandas as pd
+from nose.tools import eq_, ok_
+
+from cohorts.screen import adjust_p_values, screen
+
+def make_screen_df(n=40):
+    random_state = np.random.RandomState(0)
+    benefit = random_state.rand(n) > 0.5
+    return pd.DataFrame({
+        "patient_id": [str(i) for i in range(n)],
+        "benefit": benefit,
+        "os": random_state.randint(10, 1000, size=n),
+        "deceased": random_state.rand(n) > 0.3,
+        "pfs": random_state.randint(10, 500, size=n),
+        "progressed_or_deceased": random_state.rand(n) > 0.2,
+        "signal": benefit * 2.0 + random_state.randn(n),
+        "noise": random_state.randn(n),
+        "flag": random_state.rand(n) > 0.5})
+
+def test_adjust_p_values():
+    p_values = [0.01, 0.04, np.nan, 0.03]
+    ok_(np.allclose(adjust_p_values(p_values, "bonferroni"), [0.03, 0.12, np.nan, 0.09], equal_nan=True))
+    ok_(np.allclose(adjust_p_values(p_values, "fdr_bh"), [0.03, 0.04, np.nan, 0.04], equal_nan=True))
+
+def test_screen():
+    df = make_screen_df()
+    df.loc[0, "noise"] = np.nan
+    results = screen(df, ["signal", "noise", "flag"], random_state=1)
+    eq_(len(results), 3 * 6)
+    eq_(set(results.test), set(["auc", "mann_whitney", "logrank", "coxph"]))
+    tested = results.p_value.notnull()
+    ok_((results.q_value[tested] >= results.p_value[tested]).all())
+    auc = results[(results.feature == "signal") & (results.test == "auc")].iloc[0]
+    ok_(auc.ci_low <= auc.effect <= auc.ci_high)
+    ok_(auc.ci_low > 0.5)
+    # AUC rows aren't counted as tests when correcting p-values.
+    ok_(np.isnan(auc.p_value))
+    ok_(results[(results.feature == "signal") & (results.test == "mann_whitney")].iloc[0].p_value < 0.05)
+    eq_(results[(results.feature == "noise") & (results.outcome == "benefit")].n.tolist(), [39, 39])
+
+def test_screen_parallel():
+    df = make_screen_df()
+    serial = screen(df, ["signal", "noise"], outcomes=["benefit"], random_state=1)
+    parallel = screen(df, ["signal", "noise"], outcomes=["benefit"], random_state=1, n_jobs=2)
+    ok_(serial.equals(parallel))
@@ -0,0 +1,71 @@
+# Copyright (c) 2017. Mount Sinai School of Medicine
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import print_function
+
+import pickle
+from varcode import load_vcf_fast
+from nose.tools import eq_, ok_, raises
+
+from cohorts.serialization import CacheSerializer, CompactVariantCollection, CompactEffectCollection
+
+from . import data_path
+
+def load_test_variants():
+    return load_vcf_fast(data_path("vcf_template_1.vcf"))
+
+def test_legacy_pickle():
+    variants = load_test_variants()
+    serializer = CacheSerializer(compact=True)
+    eq_(serializer.loads(pickle.dumps(variants)), variants)
+
+def test_roundtrip_variants():
+    variants = load_test_variants()
+    for compact in [False, True]:
+        serializer = CacheSerializer(compact=compact)
+        loaded = serializer.loads(serializer.dumps(variants))
+        eq_(list(loaded), list(variants))
+        eq_(loaded.metadata, variants.metadata)
+
+def test_lazy_compact_variants():
+    variants = load_test_variants()
+    serializer = CacheSerializer(compact=True)
+    lazy = serializer.loads(serializer.dumps(variants), lazy=True)
+    ok_(isinstance(lazy, CompactVariantCollection))
+    eq_(len(lazy), len(variants))
+    eq_(list(lazy.materialize()), list(variants))
+
+def test_roundtrip_effects():
+    variants = load_test_variants()
+    effects = variants.effects()
+    serializer = CacheSerializer(compact=True)
+    loaded = serializer.loads(serializer.dumps(effects))
+    eq_(list(loaded), list(effects))
+
+def test_lazy_compact_effects():
+    variants = load_test_variants()
+    effects = variants.effects()
+    serializer = CacheSerializer(compact=True)
+    lazy = serializer.loads(serializer.dumps(effects), lazy=True)
+    ok_(isinstance(lazy, CompactEffectCollection))
+    eq_(len(lazy), len(effects))
+    # Effects are rebuilt from their stored classes and fields, sharing transcripts.
+    loaded = lazy.materialize()
+    eq_([effect.__class__ for effect in loaded], [effect.__class__ for effect in effects])
+    eq_(len(set(id(effect.transcript) for effect in loaded if getattr(effect, "transcript", None) is not None)),
+        len(lazy.transcripts))
+
+@raises(ValueError)
+def test_unknown_compression():
+    CacheSerializer(compression="gzip")